@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# Measures how long it takes git-submodules.py to read and to update a large
+# description file, as well as to read it from its index once indexed.
+# Usage: parse_description.py [NUMBER_OF_LINES] [RUNS]
+
+import contextlib
+import importlib.util
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+script_path = (
+    os.path.dirname(os.path.abspath(__file__))
+    + os.sep
+    + ".."
+    + os.sep
+    + "git-submodules.py"
+)
+
+spec = importlib.util.spec_from_file_location("git_submodules", script_path)
+git_submodules = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(git_submodules)
+
+def generate_description (line_count):
+    lines = []
+    index = 0
+
+    while (len(lines) < line_count):
+        lines.append('[submodule "vendor/lib' + str(index) + '"]')
+        lines.append(
+            '   source = https://example.org/lib' + str(index) + '.git'
+        )
+        lines.append(
+            '   source.mirror = git@mirror.example.org:lib' + str(index)
+        )
+        lines.append('   commit = ' + format(index, '040x'))
+        lines.append('   enable = True')
+
+        if ((index % 2) == 0):
+            lines.append('   target = commit')
+        else:
+            lines.append('   target = branch main')
+
+        lines.append('   target_overrides_commit = False')
+
+        index = index + 1
+
+    return "\n".join(lines[:line_count]) + "\n"
+
+def measure (function, runs):
+    best = None
+
+    for run in range(runs):
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+
+        if ((best is None) or (duration < best)):
+            best = duration
+
+    return best
+
+line_count = int(sys.argv[1]) if (len(sys.argv) > 1) else 50000
+runs = int(sys.argv[2]) if (len(sys.argv) > 2) else 5
+
+description = generate_description(line_count)
+work_directory = tempfile.mkdtemp()
+description_file = work_directory + os.sep + ".gitsubmodules"
+
+(submodule_list, submodule_dictionary) = (
+    git_submodules.GitSubmodule.parse_all(io.StringIO(description))
+)
+
+for submodule in submodule_list:
+    submodule.set_commit(format(len(submodule.get_path()), '040x'))
+
+def parse ():
+    git_submodules.GitSubmodule.parse_all(io.StringIO(description))
+
+def read_indexed ():
+    git_submodules.get_submodules_of(work_directory)
+
+def update ():
+    with open(description_file, 'w') as file_stream:
+        file_stream.write(description)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        git_submodules.update_submodules_desc_file(
+            work_directory,
+            submodule_dictionary,
+            []
+        )
+
+try:
+    print(
+        str(line_count)
+        + " lines, "
+        + str(len(submodule_list))
+        + " submodules, best of "
+        + str(runs)
+        + " runs:"
+    )
+    print("parse: " + format(measure(parse, runs) * 1000, '.1f') + " ms")
+    print("update: " + format(measure(update, runs) * 1000, '.1f') + " ms")
+
+    subprocess.run(['git', 'init', '--quiet', work_directory], check = True)
+
+    with open(description_file, 'w') as file_stream:
+        file_stream.write(description)
+
+    # The index is only trusted without hashing the file if the file is older.
+    os.utime(description_file, (time.time() - 60, time.time() - 60))
+    read_indexed()
+
+    print(
+        "read (indexed): "
+        + format(measure(read_indexed, runs) * 1000, '.1f')
+        + " ms"
+    )
+finally:
+    shutil.rmtree(work_directory)
@@ -7,6 +7,21 @@ import subprocess
 import fileinput
 import sys
 import itertools
+import functools
+import fcntl
+import fnmatch
+import json
+import random
+import shlex
+import signal
+import tarfile
+import tempfile
+import time
+import hashlib
+import marshal
+import threading
+import traceback
+import concurrent.futures
 
 ################################################################################
 ##### ARGUMENTS HANDLING #######################################################
@@ -34,6 +49,7 @@ def generate_variants (list_of_variant_list):
 # whatever they think is the right command is likely an accepted variant of it.
 
 add_variants = ['add']
+bundle_variants = ['bundle', 'bundles']
 desc_variants = ['desc', 'description']
 dir_variants = [
     'dir',
@@ -48,10 +64,12 @@ dir_variants = [
     'folders'
 ]
 ena_variants = ['ena', 'enabled']
+export_variants = ['export']
 for_variants = ['for', 'foreach', 'for-all']
 from_official_variants = ['from-official']
 help_variants = ['help', '-h', '--help']
 list_variants = ['list', 'ls']
+lock_variants = ['lock']
 match_target_variants = ['match-target']
 rec_variants = ['rec', 'recursive']
 rm_variants = ['rm', 'remove', 'clear', 'del', 'delete']
@@ -62,6 +80,10 @@ up_variants = ['up', 'update']
 
 aliases = dict()
 aliases['add'] = add_variants
+aliases['export'] = export_variants
+aliases['export-bundles'] = generate_variants(
+    [export_variants, bundle_variants]
+)
 aliases['foreach'] = for_variants
 aliases['foreach-enabled'] = generate_variants([for_variants, ena_variants])
 aliases['foreach-enabled-recursive'] = (
@@ -71,6 +93,7 @@ aliases['foreach-recursive'] = generate_variants([for_variants, rec_variants])
 aliases['from-official'] = from_official_variants
 aliases['help'] = help_variants
 aliases['list'] = list_variants
+aliases['lock'] = lock_variants
 aliases['match-target'] = match_target_variants
 aliases['rm'] = rm_variants
 aliases['rm-desc'] = generate_variants([rm_variants, desc_variants])
@@ -81,6 +104,78 @@ aliases['to-official'] = to_official_variants
 aliases['up-desc'] = generate_variants([up_variants, desc_variants])
 aliases['up-dir'] = generate_variants([up_variants, dir_variants])
 
+# Options are given among the parameters of a command, as either
+# "--name value" or "--name=value" (or just "--name" for flags). Only the
+# options listed in 'valued_options' and 'flag_options' are extracted, any other
+# parameter is returned untouched.
+def extract_options (parameters, valued_options, flag_options):
+    options = dict()
+    remaining_parameters = []
+    index = 0
+
+    while (index < len(parameters)):
+        parameter = parameters[index]
+        index = index + 1
+
+        (name, separator, value) = parameter.partition('=')
+
+        if (name in flag_options):
+            if (separator):
+                print(
+                    "[F] Option \"" + name + "\" does not take a value.",
+                    file = sys.stderr
+                )
+                sys.exit(-1)
+
+            options[name] = True
+        elif (name in valued_options):
+            if (not separator):
+                if (index >= len(parameters)):
+                    print(
+                        "[F] Option \"" + name + "\" requires a value.",
+                        file = sys.stderr
+                    )
+                    sys.exit(-1)
+
+                value = parameters[index]
+                index = index + 1
+
+            options[name] = value
+        else:
+            remaining_parameters.append(parameter)
+
+    return (options, remaining_parameters)
+
+def get_positive_integer_option (options, name, default_value):
+    return get_integer_option(options, name, default_value, 1, "positive")
+
+def get_non_negative_integer_option (options, name, default_value):
+    return get_integer_option(options, name, default_value, 0, "non-negative")
+
+def get_integer_option (options, name, default_value, minimum, description):
+    if (name not in options):
+        return default_value
+
+    try:
+        result = int(options[name])
+    except ValueError:
+        result = (minimum - 1)
+
+    if (result < minimum):
+        print(
+            "[F] Option \""
+            + name
+            + "\" requires a "
+            + description
+            + " integer, not \""
+            + options[name]
+            + "\".",
+            file = sys.stderr
+        )
+        sys.exit(-1)
+
+    return result
+
 ################################################################################
 ##### OS COMMANDS ##############################################################
 ################################################################################
@@ -121,875 +216,4426 @@ def resolve_absolute_path (repo_root_path, current_dir, file_or_dir):
 
     return file_or_dir
 
-def get_path_of_direct_subdirectories (path, filter_out_list):
-    result = set(next(os.walk(path))[1])
-    result = result.difference(set(filter_out_list))
+# Returns whether the directory has a '.git' entry (i.e. is the root of a
+# repository) and the paths of its subdirectories. Symbolic links to directories
+# are not considered to be subdirectories.
+def scan_directory (path):
+    is_repository = False
+    subdirectories = []
 
-    return [path + os.sep + directory for directory in result]
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if (entry.name == ".git"):
+                    is_repository = True
+                elif (entry.is_dir(follow_symlinks = False)):
+                    subdirectories.append(path + os.sep + entry.name)
+    except OSError:
+        pass
+
+    return (is_repository, subdirectories)
 
 def get_environment_variables ():
     return dict(os.environ)
 
-################################################################################
-##### GIT COMMANDS #############################################################
-################################################################################
-def git_get_current_commit_hash (repo_path):
-    git_cmd = subprocess.Popen(
-        ['git', 'rev-parse', 'HEAD'],
-        cwd = repo_path,
-        stdout = subprocess.PIPE
+# The content is written to a temporary file, which then replaces the file, so
+# that the file is never left partially written. 'content' is either a string
+# or bytes.
+def replace_file_content (file_path, content):
+    temporary_file_path = (
+        file_path
+        + ".tmp."
+        + str(os.getpid())
+        + "."
+        + str(threading.get_ident())
     )
 
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        search = re.findall(r'([a-z0-9]+)', line)
+    with open(
+        temporary_file_path,
+        ('wb' if isinstance(content, bytes) else 'w')
+    ) as file_stream:
+        file_stream.write(content)
+
+    os.replace(temporary_file_path, file_path)
+
+# Exit code reported for commands that were stopped for taking too long (as
+# with timeout(1)).
+command_timeout_exit_code = 124
+
+# Processes that were started in their own process group, and thus do not get
+# the terminal's interrupt signal (see 'interrupt_detached_processes').
+detached_processes = set()
+detached_processes_lock = threading.Lock()
+is_interrupted = threading.Event()
+
+# Runs a command and waits for it to end, returning its exit code. The command's
+# output is let through, unless the output of the current thread is being
+# buffered (see "PARALLEL EXECUTION"), in which case it is captured in the
+# buffer. With a timeout, the command runs in its own process group, so that it
+# can be stopped along with any process it started (e.g. ssh, or Git's remote
+# helpers, which would otherwise keep its output open). It is then detached
+# from the terminal: it cannot ask for credentials, and interrupting this
+# script is forwarded to it. If 'error_output' is a list, the command's error
+# output is also appended to it.
+def run_command (
+    command,
+    cwd,
+    env = None,
+    shell = False,
+    timeout = None,
+    error_output = None
+):
+    is_buffered = is_output_buffered()
+    is_teeing_errors = ((error_output is not None) and not is_buffered)
+    is_detached = (timeout is not None)
+    process = subprocess.Popen(
+        command,
+        cwd = cwd,
+        env = env,
+        shell = shell,
+        stdin = (subprocess.DEVNULL if (is_buffered or is_detached) else None),
+        stdout = (subprocess.PIPE if is_buffered else None),
+        stderr = (
+            subprocess.PIPE if (is_buffered or is_teeing_errors) else None
+        ),
+        start_new_session = is_detached
+    )
+    has_timed_out = False
 
-        if (search):
-            return search[0]
+    if (is_detached):
+        add_detached_process(process)
 
-    print(
-        "[F] Unable to find commit hash for repository in \""
-        + repo_path
-        + "\"",
-        file = sys.stderr
-    )
+    # The error output is still printed as it comes.
+    if (is_teeing_errors):
+        error_reader = threading.Thread(
+            target = tee_error_output,
+            args = (process.stderr, error_output)
+        )
+        error_reader.start()
 
-    sys.exit(-1)
+    try:
+        if (is_teeing_errors):
+            process.wait(timeout = timeout)
+        else:
+            (output, errors) = process.communicate(timeout = timeout)
+    except subprocess.TimeoutExpired:
+        has_timed_out = True
+        stop_process(process, is_detached)
+
+        if (not is_teeing_errors):
+            (output, errors) = process.communicate()
+    except KeyboardInterrupt:
+        if (is_detached):
+            interrupt_detached_processes()
+
+        raise
+    finally:
+        if (is_detached):
+            remove_detached_process(process)
+
+    if (is_teeing_errors):
+        process.wait()
+        error_reader.join()
+
+    if (is_buffered):
+        sys.stdout.write(output.decode('utf-8', 'replace'))
+        sys.stderr.write(errors.decode('utf-8', 'replace'))
+
+        if (error_output is not None):
+            error_output.append(errors.decode('utf-8', 'replace'))
+
+    if (has_timed_out):
+        print(
+            "[E] Stopped \""
+            + " ".join(command)
+            + "\" after "
+            + str(round(timeout, 1))
+            + " seconds.",
+            file = sys.stderr
+        )
 
-    return ""
+        return command_timeout_exit_code
 
-def git_get_remote_commit_hash_for (local_repo_path, remote_repo_url, target):
-    git_cmd = subprocess.Popen(
-        ['git', 'ls-remote', remote_repo_url, target],
-        cwd = local_repo_path,
-        stdout = subprocess.PIPE
-    )
+    return process.returncode
 
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        search = re.findall(r'([a-z0-9]+)', line)
+def tee_error_output (error_stream, error_output):
+    while True:
+        chunk = os.read(error_stream.fileno(), 4096)
 
-        if (search):
-            return search[0]
+        if (len(chunk) == 0):
+            break
 
-    print(
-        "[W] Unable to get remote commit hash for \""
-        + target
-        + "\" in remote \""
-        + remote_repo_url
-        + "\" (submodule \""
-        + local_repo_path
-        + "\").",
-        file = sys.stderr
-    )
+        text = chunk.decode('utf-8', 'replace')
 
-    return ""
+        sys.stderr.write(text)
+        sys.stderr.flush()
+        error_output.append(text)
 
-def git_repository_has_uncommitted_changes (repo_path):
-    git_cmd = subprocess.Popen(
-        ['git', 'update-index', '--refresh'],
-        cwd = repo_path,
-        stdout = subprocess.PIPE
-    )
+    error_stream.close()
 
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        return True
+def add_detached_process (process):
+    with detached_processes_lock:
+        detached_processes.add(process)
 
-    return False
+    # The script may have been interrupted while the process was starting.
+    if (is_interrupted.is_set()):
+        interrupt_detached_processes()
 
-def git_inflate_official_submodules (repo_path):
-    subprocess.Popen(
-        ['git', 'submodule', 'update', '--init', '--recursive'],
-        cwd = repo_path,
-        stdout = sys.stdout
-    ).wait()
+def remove_detached_process (process):
+    with detached_processes_lock:
+        detached_processes.discard(process)
 
-def git_get_official_submodule_paths (repo_path):
-    result = []
+# Forwards the terminal's interrupt signal to the processes that were detached
+# from it, which are otherwise left running (and waited for) when the user
+# interrupts this script.
+def interrupt_detached_processes ():
+    is_interrupted.set()
 
-    git_cmd = subprocess.Popen(
-        ["git submodule --quiet foreach 'echo $path'"],
-        shell = True, # This is apparently needed for echo to be defined.
-        cwd = repo_path,
-        stdout = subprocess.PIPE
-    )
+    with detached_processes_lock:
+        for process in detached_processes:
+            try:
+                os.killpg(process.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
 
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        result.append(line.strip())
+# Processes are first asked to stop, so that Git can clean up after itself.
+# 'is_process_group' tells whether the process leads its own process group, in
+# which case the whole group is stopped.
+def stop_process (process, is_process_group):
+    for stop_signal in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            if (is_process_group):
+                os.killpg(process.pid, stop_signal)
+            else:
+                process.send_signal(stop_signal)
+        except ProcessLookupError:
+            return
 
-    return result
+        try:
+            process.wait(timeout = 5)
 
-def git_shallow_submodule_init (repo_path, module_path):
-    subprocess.Popen(
-        ['git', 'submodule', 'update', '--init', module_path],
-        cwd = repo_path,
-        stdout = sys.stdout
-    ).wait()
+            return
+        except subprocess.TimeoutExpired:
+            continue
 
-def git_get_all_remotes (repo_path):
-    remote_names = []
+################################################################################
+##### NETWORK LIMITS ###########################################################
+################################################################################
+# Commands accessing the network can be given a timeout, be retried (after
+# waiting exponentially longer each time, with some randomness so that parallel
+# jobs do not retry all at once) and be bounded by a deadline for the whole run.
+# Operations that had to be given up on are recorded, so that they can be
+# reported at the end.
+class NetworkLimits:
+    def __init__ (self):
+        self.timeout = None
+        self.retries = 0
+        self.deadline = None
+        self.abandoned_operations = []
+        self.lock = threading.Lock()
+
+    def get_timeout (self):
+        return self.timeout
+
+    def get_retries (self):
+        return self.retries
+
+    # Time left before the deadline, in seconds (None if there is no deadline).
+    def get_remaining_time (self):
+        if (self.deadline is None):
+            return None
+
+        return (self.deadline - time.monotonic())
+
+    # Timeout for an attempt starting now.
+    def get_attempt_timeout (self):
+        remaining_time = self.get_remaining_time()
+
+        if (remaining_time is None):
+            return self.timeout
+
+        if (self.timeout is None):
+            return remaining_time
+
+        return min(self.timeout, remaining_time)
+
+    def get_abandoned_operations (self):
+        with self.lock:
+            return list(self.abandoned_operations)
+
+    def set_timeout (self, timeout):
+        self.timeout = timeout
+
+    def set_retries (self, retries):
+        self.retries = retries
+
+    def set_deadline (self, deadline):
+        self.deadline = deadline
+
+    def add_abandoned_operation (self, description, reason):
+        with self.lock:
+            self.abandoned_operations.append((description, reason))
+
+network_limits = NetworkLimits()
+network_retry_base_delay = 1.0
+network_retry_max_delay = 30.0
+
+# Errors worth retrying for, as they may not happen again. Others (e.g. the
+# repository or the commit not existing, or access being denied) would.
+transient_network_error_regex = re.compile(
+    r'(connection (reset|refused|timed out|closed)|could not resolve host'
+    r'|failed to connect|couldn\'t connect to server'
+    r'|temporary failure in name resolution|early eof'
+    r'|remote end hung up unexpectedly|rpc failed|unexpected disconnect'
+    r'|operation timed out|http (error )?5[0-9][0-9]'
+    r'|returned error: 5[0-9][0-9]|ssl_read|gnutls_handshake)',
+    re.IGNORECASE
+)
 
-    git_cmd = subprocess.Popen(
-        ['git', 'remote'],
-        cwd = repo_path,
-        stdout = subprocess.PIPE
+def is_transient_network_error (error_output):
+    return (
+        transient_network_error_regex.search("".join(error_output))
+        is not None
     )
 
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        remote_names.append(line.strip())
+def set_network_limits (options):
+    if ('--timeout' in options):
+        network_limits.set_timeout(
+            get_positive_integer_option(options, '--timeout', None)
+        )
 
-    result = dict()
+    if ('--retries' in options):
+        network_limits.set_retries(
+            get_non_negative_integer_option(options, '--retries', 0)
+        )
 
-    for remote_name in remote_names:
-        git_cmd = subprocess.Popen(
-            ['git', 'remote', 'get-url', '--all', remote_name],
-            cwd = repo_path,
-            stdout = subprocess.PIPE
+    if ('--deadline' in options):
+        network_limits.set_deadline(
+            time.monotonic()
+            + get_positive_integer_option(options, '--deadline', None)
         )
 
-        for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-            result[remote_name] = line.strip()
+# 'attempt' is given the timeout for the attempt and returns (is_successful,
+# has_timed_out, is_transient, result). Only attempts that timed out or failed
+# in a transient way are retried. 'prepare_retry', if any, is called before
+# each retry (e.g. to remove what a failed clone left behind). Returns the
+# result of the last attempt, or 'abandoned_result' if no attempt was made.
+def run_with_network_limits (
+    description,
+    attempt,
+    abandoned_result,
+    prepare_retry = None
+):
+    result = abandoned_result
+    has_timed_out = False
+
+    for attempt_index in range(network_limits.get_retries() + 1):
+        if (attempt_index > 0):
+            delay = (
+                min(
+                    network_retry_base_delay * (2 ** (attempt_index - 1)),
+                    network_retry_max_delay
+                )
+                * random.uniform(0.5, 1.5)
+            )
+            remaining_time = network_limits.get_remaining_time()
 
-    return result
+            if ((remaining_time is not None) and (delay >= remaining_time)):
+                break
 
-def git_add_remote (repo_path, remote_name, remote_url):
-    subprocess.Popen(
-        ['git', 'remote', 'add', remote_name, remote_url],
-        cwd = repo_path,
-    ).wait()
+            print(
+                "[W] \""
+                + description
+                + "\" failed. Retrying in "
+                + str(round(delay, 1))
+                + " seconds...",
+                file = sys.stderr
+            )
+            time.sleep(delay)
 
-    subprocess.Popen(
-        ['git', 'remote', 'set-url', remote_name, remote_url],
-        cwd = repo_path,
-    ).wait()
+            if (prepare_retry is not None):
+                prepare_retry()
 
+        timeout = network_limits.get_attempt_timeout()
 
-def git_add_to_gitignore (entry_set, root_path):
-    try:
-        with open(root_path + os.sep + ".gitignore", 'r+') as file_stream:
-            for line in file_stream:
-                entry_set.discard(line.strip())
+        if ((timeout is not None) and (timeout <= 0)):
+            break
 
-                if (len(entry_set) == 0):
-                    return
+        (is_successful, has_timed_out, is_transient, result) = attempt(timeout)
 
-            for new_entry in entry_set:
-                print(new_entry, file=file_stream)
-    except FileNotFoundError:
-        print(
-            "No \""
-            + root_path
-            + os.sep
-            + ".gitignore\" file found. It will be created."
-        )
-        with open(root_path + os.sep + ".gitignore", 'w') as file_stream:
-            for new_entry in entry_set:
-                print(new_entry, file=file_stream)
+        if (is_successful or not (has_timed_out or is_transient)):
+            return result
+    else:
+        if (has_timed_out):
+            network_limits.add_abandoned_operation(description, "timed out")
 
-def git_remove_from_gitignore (path_list, root_path):
-    kept_content = list()
+        return result
 
-    try:
-        with open(root_path + os.sep + ".gitignore", 'r') as file_stream:
-            for line in file_stream:
-                line = line.rstrip()
+    network_limits.add_abandoned_operation(description, "deadline reached")
 
-                if (line not in path_list):
-                    kept_content.append(line.rstrip())
-    except FileNotFoundError:
-        print(
-            "No \""
-            + root_path
-            + os.sep
-            + ".gitignore\" file found. Nothing to remove from it."
+    return result
+
+# If 'attempt_durations' is a list, the duration of each attempt is appended to
+# it (i.e. without the delays between retries).
+def run_network_command (
+    command,
+    cwd,
+    prepare_retry = None,
+    attempt_durations = None
+):
+    def attempt (timeout):
+        error_output = []
+        start_time = time.monotonic()
+        exit_code = run_command(
+            command,
+            cwd,
+            timeout = timeout,
+            error_output = error_output
         )
-        return
 
-    with open(root_path + os.sep + ".gitignore", 'w') as file_stream:
-        for line in kept_content:
-            print(line, file=file_stream)
+        if (attempt_durations is not None):
+            attempt_durations.append(time.monotonic() - start_time)
 
-def git_find_root_path ():
-    # from https://stackoverflow.com/questions/22081209/find-the-root-of-the-git-repository-where-the-file-lives
-    return subprocess.Popen(
-        ['git', 'rev-parse', '--show-toplevel'],
-        stdout = subprocess.PIPE
-    ).communicate()[0].rstrip().decode('utf-8')
+        return (
+            (exit_code == 0),
+            (exit_code == command_timeout_exit_code),
+            is_transient_network_error(error_output),
+            exit_code
+        )
 
-def git_is_repository_root (path):
-    return (
-        subprocess.Popen(
-            ['git', 'rev-parse', '--show-toplevel'],
-            stdout = subprocess.PIPE,
-            cwd = path
-        ).communicate()[0].rstrip().decode('utf-8') == path
+    return run_with_network_limits(
+        " ".join(command),
+        attempt,
+        command_timeout_exit_code,
+        prepare_retry
     )
 
-def git_get_default_remote (repo_path):
-    result = "origin"
-
-    git_cmd = subprocess.Popen(
-        ['git', 'config', '--get', '--global', 'checkout.defaultRemote'],
-        cwd = repo_path,
-        stdout = subprocess.PIPE
-    )
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        result = line.strip()
+# Returns True if anything was abandoned.
+def report_abandoned_operations ():
+    abandoned_operations = network_limits.get_abandoned_operations()
 
-    git_cmd = subprocess.Popen(
-        ['git', 'config', '--get', 'checkout.defaultRemote'],
-        cwd = repo_path,
-        stdout = subprocess.PIPE
-    )
-    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
-        result = line.strip()
+    for (description, reason) in abandoned_operations:
+        print(
+            "[E] Gave up on \"" + description + "\" (" + reason + ").",
+            file = sys.stderr
+        )
 
-    return result
+    return (len(abandoned_operations) > 0)
 
 ################################################################################
-##### GIT SUBMODULE CLASS ######################################################
+##### PARALLEL EXECUTION #######################################################
 ################################################################################
-class GitSubmodule:
-    def __init__ (self, path):
-        self.path = path
-        self.sources = []
-        self.named_sources = dict()
-        self.commit = None
-        self.enabled = True
-        self.target = None
-        self.target_type = "commit"
-        self.target_overrides_commit = False
+# While tasks are run in parallel, sys.stdout and sys.stderr are replaced by
+# streams that add anything printed from a worker thread to that thread's output
+# block instead. Each task's output is then printed in one go once it is done.
+output_block_of_thread = threading.local()
 
-    def get_path (self):
-        return self.path
+class BlockBufferedStream:
+    def __init__ (self, real_stream):
+        self.real_stream = real_stream
 
-    def get_sources (self):
-        return self.sources
+    def write (self, text):
+        block = getattr(output_block_of_thread, 'block', None)
 
-    def get_named_sources (self):
-        return self.named_sources
+        if (block is None):
+            return self.real_stream.write(text)
 
-    def get_commit (self):
-        return self.commit
+        block.append((self.real_stream, text))
 
-    def get_target (self):
-        if (self.get_target_type() == "commit"):
-            return self.get_commit()
-        else:
-            return self.target
+        return len(text)
 
-    def get_target_type (self):
-        return self.target_type
+    def flush (self):
+        if (not is_output_buffered()):
+            self.real_stream.flush()
 
-    def get_target_overrides_commit (self):
+def is_output_buffered ():
+    return (getattr(output_block_of_thread, 'block', None) is not None)
+
+# Runs 'function' with the output of the current thread added to 'block', so
+# that the threads a task starts can gather their output in blocks, which are
+# then added to that of the task (see 'add_output_block').
+def run_with_output_block (function, block):
+    previous_block = getattr(output_block_of_thread, 'block', None)
+    output_block_of_thread.block = block
+
+    try:
+        return function()
+    finally:
+        output_block_of_thread.block = previous_block
+
+# Adds 'block' to the output of the current thread, printing it if that output
+# is not being buffered.
+def add_output_block (block):
+    if (is_output_buffered()):
+        output_block_of_thread.block.extend(block)
+    else:
+        print_output_block(block)
+
+def print_output_block (block):
+    for (stream, text) in block:
+        stream.write(text)
+
+    for (stream, text) in block:
+        stream.flush()
+
+# A failing task (including one calling sys.exit with an error code) does not
+# interrupt the other tasks.
+def run_buffered_task (function):
+    block = []
+    has_failed = False
+    subtasks = None
+
+    output_block_of_thread.block = block
+
+    try:
+        subtasks = function()
+    except SystemExit as exit_request:
+        has_failed = (exit_request.code not in [None, 0])
+    except Exception:
+        has_failed = True
+        traceback.print_exc()
+    finally:
+        output_block_of_thread.block = None
+
+    if ((subtasks is None) or has_failed):
+        subtasks = []
+
+    return (block, has_failed, subtasks)
+
+class ParallelTask:
+    def __init__ (self, name, function):
+        self.name = name
+        self.function = function
+        self.output_block = None
+        self.subtasks = []
+
+    def get_name (self):
+        return self.name
+
+    def get_function (self):
+        return self.function
+
+    def get_output_block (self):
+        return self.output_block
+
+    def get_subtasks (self):
+        return self.subtasks
+
+    def set_output_block (self, output_block):
+        self.output_block = output_block
+
+    def set_subtasks (self, subtasks):
+        self.subtasks = subtasks
+
+# Prints the output blocks in the order the tasks were given, each task being
+# followed by its subtasks, stopping at the first task that isn't done yet.
+def print_ready_output_blocks (print_stack):
+    while (
+        (len(print_stack) > 0)
+        and (print_stack[-1].get_output_block() is not None)
+    ):
+        task = print_stack.pop()
+
+        print_output_block(task.get_output_block())
+
+        print_stack.extend(reversed(task.get_subtasks()))
+
+# 'tasks' is a list of (name, function) pairs. A task's function may return a
+# list of subtasks, which are queued as soon as that task is done (this is how
+# tasks depending on others are handled: the subtasks of a failed task are
+# never run). Output blocks are printed as soon as the task is done, or, if
+# 'is_ordered' is set, in the order in which tasks were given (subtasks coming
+# right after their parent task). Returns the names of the tasks that failed.
+def run_tasks_in_parallel (tasks, jobs, is_ordered = False):
+    failed_task_names = []
+    real_stdout = sys.stdout
+    real_stderr = sys.stderr
+
+    tasks = [ParallelTask(name, function) for (name, function) in tasks]
+    print_stack = list(reversed(tasks))
+
+    sys.stdout = BlockBufferedStream(real_stdout)
+    sys.stderr = BlockBufferedStream(real_stderr)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+            task_of_future = dict()
+
+            for task in tasks:
+                task_of_future[
+                    pool.submit(run_buffered_task, task.get_function())
+                ] = task
+
+            try:
+                while (len(task_of_future) > 0):
+                    (done_futures, ignored) = concurrent.futures.wait(
+                        task_of_future,
+                        return_when = concurrent.futures.FIRST_COMPLETED
+                    )
+
+                    for future in done_futures:
+                        task = task_of_future.pop(future)
+                        (block, has_failed, subtasks) = future.result()
+
+                        if (has_failed):
+                            failed_task_names.append(task.get_name())
+
+                        task.set_subtasks(
+                            [
+                                ParallelTask(name, function)
+                                for (name, function) in subtasks
+                            ]
+                        )
+
+                        for subtask in task.get_subtasks():
+                            task_of_future[
+                                pool.submit(
+                                    run_buffered_task,
+                                    subtask.get_function()
+                                )
+                            ] = subtask
+
+                        if (is_ordered):
+                            task.set_output_block(block)
+                            print_ready_output_blocks(print_stack)
+                        else:
+                            print_output_block(block)
+            except KeyboardInterrupt:
+                # Only this thread is interrupted: the tasks that did not start
+                # are dropped, and those that are running are interrupted.
+                for future in task_of_future:
+                    future.cancel()
+
+                interrupt_detached_processes()
+
+                raise
+    finally:
+        sys.stdout = real_stdout
+        sys.stderr = real_stderr
+
+    return failed_task_names
+
+def report_failed_tasks (failed_task_names):
+    for name in failed_task_names:
+        print("[E] Failed for \"" + name + "\".", file = sys.stderr)
+
+################################################################################
+##### PERSISTENT SHELLS ########################################################
+################################################################################
+# Instead of starting a new shell for each command, each thread can keep a shell
+# running and give it one command after the other. Each command is run in a
+# subshell, so that it cannot change the state of the shell (or make it exit),
+# with its output redirected to files. The shell then prints a line starting
+# with a marker that cannot appear in the commands' output, followed by the
+# command's exit code.
+shell_worker_of_thread = threading.local()
+shell_workers = []
+shell_workers_lock = threading.Lock()
+
+class ShellWorker:
+    def __init__ (self):
+        self.marker = "snsm-" + os.urandom(16).hex()
+        (stdout_handle, self.stdout_file) = tempfile.mkstemp()
+        (stderr_handle, self.stderr_file) = tempfile.mkstemp()
+
+        os.close(stdout_handle)
+        os.close(stderr_handle)
+
+        self.process = None
+
+    def start (self):
+        self.process = subprocess.Popen(
+            ['/bin/sh'],
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.DEVNULL
+        )
+
+    # Returns the exit code of the command, or None if the shell stopped.
+    def run (self, command, cwd, env_vars):
+        if ((self.process is None) or (self.process.poll() is not None)):
+            self.start()
+
+        script = (
+            "("
+            + "".join(
+                [
+                    "export " + name + "=" + shlex.quote(value) + "\n"
+                    for (name, value) in env_vars.items()
+                ]
+            )
+            + "cd " + shlex.quote(cwd) + " && eval " + shlex.quote(command)
+            + "\n) </dev/null >" + shlex.quote(self.stdout_file)
+            + " 2>" + shlex.quote(self.stderr_file)
+            + "\necho " + self.marker + " $?\n"
+        )
+
+        # Should the shell stop before redirecting the output, the previous
+        # command's output must not be taken for that of this one.
+        for output_file in [self.stdout_file, self.stderr_file]:
+            open(output_file, 'wb').close()
+
+        try:
+            self.process.stdin.write(script.encode('utf-8'))
+            self.process.stdin.flush()
+
+            line = self.process.stdout.readline().decode('utf-8')
+
+            while ((len(line) > 0) and (not line.startswith(self.marker))):
+                line = self.process.stdout.readline().decode('utf-8')
+        except OSError:
+            line = ""
+
+        for (output_file, stream) in [
+            (self.stdout_file, sys.stdout),
+            (self.stderr_file, sys.stderr)
+        ]:
+            try:
+                with open(output_file, 'rb') as file_stream:
+                    stream.write(
+                        file_stream.read().decode('utf-8', 'replace')
+                    )
+            except OSError:
+                pass
+
+        if (len(line) == 0):
+            self.stop()
+
+            return None
+
+        return int(line[len(self.marker):])
+
+    def stop (self):
+        if (self.process is None):
+            return
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+    def remove_files (self):
+        for output_file in [self.stdout_file, self.stderr_file]:
+            try:
+                os.remove(output_file)
+            except OSError:
+                pass
+
+def get_shell_worker ():
+    result = getattr(shell_worker_of_thread, 'worker', None)
+
+    if (result is None):
+        result = ShellWorker()
+        shell_worker_of_thread.worker = result
+
+        with shell_workers_lock:
+            shell_workers.append(result)
+
+    return result
+
+def stop_shell_workers ():
+    with shell_workers_lock:
+        for worker in shell_workers:
+            worker.stop()
+            worker.remove_files()
+
+        shell_workers.clear()
+
+    shell_worker_of_thread.worker = None
+
+################################################################################
+##### GIT METADATA #############################################################
+################################################################################
+# Reading a repository's metadata from its files avoids starting Git processes
+# for each query. All of these return None when the repository relies on
+# something not handled here (e.g. configuration includes, URL rewriting,
+# reftable, GIT_DIR being set...), in which case Git itself should be queried.
+git_config_section_regex = re.compile(
+    r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(?:[#;].*)?$'
+)
+git_config_entry_regex = re.compile(
+    r'^([A-Za-z][A-Za-z0-9-]*)\s*(?:=\s*(.*))?$'
+)
+git_object_hash_regex = re.compile(r'^(?:[0-9a-f]{40}|[0-9a-f]{64})$')
+
+# Returns the list of (section, subsection, key, value) found in a
+# configuration file, section and key being in lower case.
+def read_git_config_file (config_path):
+    result = []
+    section = None
+    subsection = None
+
+    try:
+        with open(config_path, 'r', encoding = "utf-8") as file_stream:
+            lines = file_stream.readlines()
+    except FileNotFoundError:
+        return []
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    for line in lines:
+        line = line.strip()
+
+        if ((len(line) == 0) or (line[0] in "#;")):
+            continue
+
+        search = git_config_section_regex.match(line)
+
+        if (search):
+            section = search.group(1).lower()
+            subsection = search.group(2)
+
+            if (subsection is not None):
+                subsection = re.sub(r'\\(.)', r'\1', subsection)
+            elif ("." in section):
+                (section, separator, subsection) = section.partition(".")
+
+            if (section in ["include", "includeif"]):
+                return None
+
+            continue
+
+        search = git_config_entry_regex.match(line)
+
+        if ((not search) or (section is None)):
+            return None
+
+        value = search.group(2)
+
+        if (value is None):
+            value = "true"
+        elif ('\\' in value):
+            return None
+        elif ('"' in value):
+            if (
+                (len(value) < 2)
+                or (value[0] != '"')
+                or (value[-1] != '"')
+                or ('"' in value[1:-1])
+            ):
+                return None
+
+            value = value[1:-1]
+        else:
+            value = re.split(r'[#;]', value, 1)[0].rstrip()
+
+        result.append((section, subsection, search.group(1).lower(), value))
+
+    return result
+
+# Returns (git directory, common directory) of the repository whose working
+# tree's root is 'repo_path', False if there is no '.git' entry at all.
+def read_git_directories (repo_path):
+    for variable in ['GIT_DIR', 'GIT_COMMON_DIR', 'GIT_WORK_TREE']:
+        if (variable in os.environ):
+            return None
+
+    dot_git = repo_path + os.sep + ".git"
+
+    if (os.path.isdir(dot_git)):
+        git_dir = dot_git
+    elif (os.path.isfile(dot_git)):
+        try:
+            with open(dot_git, 'r') as file_stream:
+                content = file_stream.read().strip()
+        except OSError:
+            return None
+
+        if (not content.startswith("gitdir:")):
+            return None
+
+        git_dir = content[len("gitdir:"):].strip()
+    elif (os.path.lexists(dot_git)):
+        return None
+    else:
+        return False
+
+    git_dir = os.path.normpath(os.path.join(repo_path, git_dir))
+    common_dir = git_dir
+
+    if (not os.path.isfile(git_dir + os.sep + "HEAD")):
+        return None
+
+    try:
+        with open(git_dir + os.sep + "commondir", 'r') as file_stream:
+            common_dir = os.path.normpath(
+                os.path.join(git_dir, file_stream.read().strip())
+            )
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return None
+
+    if (
+        (not os.path.isdir(common_dir + os.sep + "refs"))
+        or os.path.exists(common_dir + os.sep + "reftable")
+    ):
+        return None
+
+    # Remotes can also be defined by files in these legacy directories.
+    for legacy_dir in ["branches", "remotes"]:
+        try:
+            if (len(os.listdir(common_dir + os.sep + legacy_dir)) > 0):
+                return None
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return None
+
+    return (git_dir, common_dir)
+
+def read_git_global_config_paths ():
+    if ('GIT_CONFIG_GLOBAL' in os.environ):
+        return [os.environ['GIT_CONFIG_GLOBAL']]
+
+    home = os.path.expanduser("~")
+    xdg_config_home = os.environ.get(
+        'XDG_CONFIG_HOME',
+        home + os.sep + ".config"
+    )
+
+    return [
+        xdg_config_home + os.sep + "git" + os.sep + "config",
+        home + os.sep + ".gitconfig"
+    ]
+
+# Returns all the configuration entries that apply to the repository, from the
+# lowest to the highest priority.
+def read_git_configuration (repo_path):
+    for variable in ['GIT_CONFIG', 'GIT_CONFIG_COUNT', 'GIT_CONFIG_PARAMETERS']:
+        if (variable in os.environ):
+            return None
+
+    directories = read_git_directories(repo_path)
+
+    if (not directories):
+        return None
+
+    (git_dir, common_dir) = directories
+    config_paths = []
+
+    if ('GIT_CONFIG_NOSYSTEM' not in os.environ):
+        config_paths.append(
+            os.environ.get('GIT_CONFIG_SYSTEM', "/etc/gitconfig")
+        )
+
+    config_paths.extend(read_git_global_config_paths())
+    config_paths.append(common_dir + os.sep + "config")
+    config_paths.append(git_dir + os.sep + "config.worktree")
+
+    result = []
+
+    for config_path in config_paths:
+        entries = read_git_config_file(config_path)
+
+        if (entries is None):
+            return None
+
+        result.extend(entries)
+
+    for (section, subsection, key, value) in result:
+        if (
+            ((section == "core") and (key == "worktree"))
+            or ((section == "core") and (key == "bare") and (value != "false"))
+            or ((section == "url") and (key in ["insteadof", "pushinsteadof"]))
+            or ((section == "extensions") and (key == "refstorage"))
+        ):
+            return None
+
+    return result
+
+def read_git_reference (git_dir, common_dir, reference):
+    # Symbolic references are followed up to a depth of 5, like Git does.
+    for ignored in range(5):
+        if (
+            reference.startswith("refs/")
+            and not reference.startswith("refs/bisect/")
+            and not reference.startswith("refs/worktree/")
+            and not reference.startswith("refs/rewritten/")
+        ):
+            reference_dir = common_dir
+        else:
+            reference_dir = git_dir
+
+        try:
+            with open(
+                reference_dir + os.sep + reference.replace("/", os.sep),
+                'r'
+            ) as file_stream:
+                content = file_stream.read().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            content = None
+        except OSError:
+            return None
+
+        if (content is None):
+            break
+
+        if (content.startswith("ref:")):
+            reference = content[len("ref:"):].strip()
+            continue
+
+        if (git_object_hash_regex.match(content)):
+            return content
+
+        return None
+
+    if (content is not None):
+        return None
+
+    try:
+        with open(common_dir + os.sep + "packed-refs", 'r') as file_stream:
+            for line in file_stream:
+                fields = line.split()
+
+                if (
+                    (len(fields) == 2)
+                    and (fields[1] == reference)
+                    and git_object_hash_regex.match(fields[0])
+                ):
+                    return fields[0]
+    except FileNotFoundError:
+        pass
+    except OSError:
+        pass
+
+    return None
+
+def read_git_current_commit_hash (repo_path):
+    directories = read_git_directories(repo_path)
+
+    if (not directories):
+        return None
+
+    (git_dir, common_dir) = directories
+
+    return read_git_reference(git_dir, common_dir, "HEAD")
+
+# Remotes are listed in alphabetical order, as "git remote" does.
+def read_git_all_remotes (repo_path):
+    configuration = read_git_configuration(repo_path)
+
+    if (configuration is None):
+        return None
+
+    result = dict()
+
+    for (section, subsection, key, value) in configuration:
+        if ((section != "remote") or (subsection is None)):
+            continue
+
+        if (key == "url"):
+            result[subsection] = value
+        elif (subsection not in result):
+            result[subsection] = None
+
+    if (None in result.values()):
+        return None
+
+    return dict([(name, result[name]) for name in sorted(result)])
+
+def read_git_default_remote (repo_path):
+    configuration = read_git_configuration(repo_path)
+
+    if (configuration is None):
+        return None
+
+    result = "origin"
+
+    for (section, subsection, key, value) in configuration:
+        if (
+            (section == "checkout")
+            and (subsection is None)
+            and (key == "defaultremote")
+        ):
+            result = value
+
+    return result
+
+# Converts a .gitignore pattern (without its leading '!' nor trailing '/') into
+# a regular expression matching the paths it applies to.
+def convert_gitignore_pattern (pattern):
+    if ("/" in pattern):
+        result = ""
+        pattern = pattern.lstrip("/")
+    else:
+        result = "(?:.*/)?"
+
+    index = 0
+
+    while (index < len(pattern)):
+        if (pattern.startswith("**/", index)):
+            result = result + "(?:.*/)?"
+            index = index + 3
+        elif (pattern == (pattern[:index] + "/**")):
+            result = result + "/.*"
+            index = index + 3
+        elif (pattern[index] == "*"):
+            result = result + "[^/]*"
+            index = index + 1
+        elif (pattern[index] == "?"):
+            result = result + "[^/]"
+            index = index + 1
+        elif ((pattern[index] == "[") and ("]" in pattern[index + 2:])):
+            end = pattern.index("]", index + 2)
+            characters = pattern[index + 1:end]
+
+            if (characters[0] == "!"):
+                characters = "^" + characters[1:]
+
+            result = result + "[" + characters.replace("\\", "\\\\") + "]"
+            index = end + 1
+        elif ((pattern[index] == "\\") and (index + 1 < len(pattern))):
+            result = result + re.escape(pattern[index + 1])
+            index = index + 2
+        else:
+            result = result + re.escape(pattern[index])
+            index = index + 1
+
+    return result
+
+# Returns the rules of the .gitignore file at the root of the repository, as
+# (regular expression, is_negated) pairs. Only directories being checked
+# against these, patterns restricted to directories are treated as any other.
+def read_gitignore_rules (root_path):
+    result = []
+
+    try:
+        with open(root_path + os.sep + ".gitignore", 'r') as file_stream:
+            lines = file_stream.readlines()
+    except (FileNotFoundError, UnicodeDecodeError):
+        return []
+
+    for line in lines:
+        line = line.rstrip()
+
+        if ((len(line) == 0) or line.startswith("#")):
+            continue
+
+        is_negated = line.startswith("!")
+
+        if (is_negated):
+            line = line[1:]
+
+        line = line.rstrip("/")
+
+        if (len(line) > 0):
+            result.append(
+                (re.compile(convert_gitignore_pattern(line)), is_negated)
+            )
+
+    return result
+
+def is_ignored_by (gitignore_rules, relative_path):
+    result = False
+
+    for (rule, is_negated) in gitignore_rules:
+        if (rule.fullmatch(relative_path)):
+            result = not is_negated
+
+    return result
+
+def read_git_is_repository_root (path):
+    directories = read_git_directories(path)
+
+    if (directories is False):
+        return False
+
+    if ((directories is None) or (read_git_configuration(path) is None)):
+        return None
+
+    return True
+
+################################################################################
+##### GIT COMMANDS #############################################################
+################################################################################
+def git_get_current_commit_hash (repo_path):
+    result = read_git_current_commit_hash(repo_path)
+
+    if (result is not None):
+        return result
+
+    git_cmd = subprocess.Popen(
+        ['git', 'rev-parse', 'HEAD'],
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        search = re.findall(r'([a-z0-9]+)', line)
+
+        if (search):
+            return search[0]
+
+    print(
+        "[F] Unable to find commit hash for repository in \""
+        + repo_path
+        + "\"",
+        file = sys.stderr
+    )
+
+    sys.exit(-1)
+
+    return ""
+
+# Returns the list of (commit hash, reference) advertised by the remote, or None
+# if it could not be reached.
+def git_get_remote_references (local_repo_path, remote_repo_url):
+    def attempt (timeout):
+        error_output = []
+        result = git_list_remote_references(
+            local_repo_path,
+            remote_repo_url,
+            timeout,
+            error_output
+        )
+
+        return (
+            (result is not None),
+            (result is False),
+            is_transient_network_error(error_output),
+            result
+        )
+
+    result = run_with_network_limits(
+        "git ls-remote " + remote_repo_url,
+        attempt,
+        None
+    )
+
+    if (result is False):
+        return None
+
+    return result
+
+# Returns None if the remote could not be queried, False if it timed out. The
+# error output is appended to the 'error_output' list.
+def git_list_remote_references (
+    local_repo_path,
+    remote_repo_url,
+    timeout,
+    error_output
+):
+    result = []
+    is_detached = (timeout is not None)
+
+    git_cmd = subprocess.Popen(
+        ['git', 'ls-remote', remote_repo_url],
+        cwd = local_repo_path,
+        stdin = (
+            subprocess.DEVNULL
+            if (is_output_buffered() or is_detached)
+            else None
+        ),
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        start_new_session = is_detached
+    )
+
+    if (is_detached):
+        add_detached_process(git_cmd)
+
+    try:
+        (output, errors) = git_cmd.communicate(timeout = timeout)
+    except subprocess.TimeoutExpired:
+        stop_process(git_cmd, is_detached)
+        git_cmd.communicate()
+
+        print(
+            "[E] Stopped \"git ls-remote "
+            + remote_repo_url
+            + "\" after "
+            + str(round(timeout, 1))
+            + " seconds.",
+            file = sys.stderr
+        )
+
+        return False
+    except KeyboardInterrupt:
+        if (is_detached):
+            interrupt_detached_processes()
+
+        raise
+    finally:
+        if (is_detached):
+            remove_detached_process(git_cmd)
+
+    if (errors):
+        sys.stderr.write(errors.decode('utf-8', 'replace'))
+        error_output.append(errors.decode('utf-8', 'replace'))
+
+    if (git_cmd.returncode != 0):
+        return None
+
+    for line in output.decode('utf-8').splitlines():
+        fields = line.split()
+
+        if (len(fields) == 2):
+            result.append((fields[0], fields[1]))
+
+    return result
+
+# Matches 'target' against the references the same way "git ls-remote <url>
+# <target>" would, but using the remote references cache.
+def git_get_remote_commit_hash_for (local_repo_path, remote_repo_url, target):
+    references = get_remote_references(local_repo_path, remote_repo_url)
+
+    for (commit_hash, reference) in references:
+        if (fnmatch.fnmatchcase(reference, '*/' + target)):
+            return commit_hash
+
+    print(
+        "[W] Unable to get remote commit hash for \""
+        + target
+        + "\" in remote \""
+        + remote_repo_url
+        + "\" (submodule \""
+        + local_repo_path
+        + "\").",
+        file = sys.stderr
+    )
+
+    return ""
+
+# Deletes every reference whose name starts with 'prefix'.
+def git_delete_references (repo_path, prefix):
+    git_cmd = subprocess.Popen(
+        ['git', 'for-each-ref', '--format=delete %(refname)', prefix],
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+    (output, errors) = git_cmd.communicate()
+
+    if (len(output) == 0):
+        return
+
+    subprocess.Popen(
+        ['git', 'update-ref', '--stdin'],
+        cwd = repo_path,
+        stdin = subprocess.PIPE
+    ).communicate(output)
+
+def git_has_commit (repo_path, revision):
+    return (
+        subprocess.Popen(
+            [
+                'git',
+                'rev-parse',
+                '--verify',
+                '--quiet',
+                revision + '^{commit}'
+            ],
+            cwd = repo_path,
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL
+        ).wait()
+        == 0
+    )
+
+# Returns None if the revision does not point to any commit.
+def git_get_commit_hash_of (repo_path, revision):
+    git_cmd = subprocess.Popen(
+        ['git', 'rev-parse', '--verify', '--quiet', revision + '^{commit}'],
+        cwd = repo_path,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.DEVNULL
+    )
+
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        git_cmd.wait()
+
+        return line.strip()
+
+    git_cmd.wait()
+
+    return None
+
+# Returns None if the file is not in that commit.
+def git_read_file_at (repo_path, revision, file_path):
+    git_cmd = subprocess.Popen(
+        ['git', 'show', revision + ':' + file_path],
+        cwd = repo_path,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.DEVNULL
+    )
+
+    (output, errors) = git_cmd.communicate()
+
+    if (git_cmd.returncode != 0):
+        return None
+
+    return output.decode('utf-8', 'replace')
+
+def git_repository_has_uncommitted_changes (repo_path):
+    git_cmd = subprocess.Popen(
+        ['git', 'update-index', '--refresh'],
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        return True
+
+    return False
+
+def git_inflate_official_submodules (repo_path):
+    run_network_command(
+        ['git', 'submodule', 'update', '--init', '--recursive'],
+        repo_path
+    )
+    invalidate_repo_snapshot(repo_path)
+
+def git_get_official_submodule_paths (repo_path):
+    result = []
+
+    git_cmd = subprocess.Popen(
+        ["git submodule --quiet foreach 'echo $path'"],
+        shell = True, # This is apparently needed for echo to be defined.
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        result.append(line.strip())
+
+    return result
+
+def git_shallow_submodule_init (repo_path, module_path):
+    subprocess.Popen(
+        ['git', 'submodule', 'update', '--init', module_path],
+        cwd = repo_path,
+        stdout = sys.stdout
+    ).wait()
+
+def git_get_all_remotes (repo_path):
+    result = read_git_all_remotes(repo_path)
+
+    if (result is not None):
+        return result
+
+    remote_names = []
+
+    git_cmd = subprocess.Popen(
+        ['git', 'remote'],
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        remote_names.append(line.strip())
+
+    result = dict()
+
+    for remote_name in remote_names:
+        git_cmd = subprocess.Popen(
+            ['git', 'remote', 'get-url', '--all', remote_name],
+            cwd = repo_path,
+            stdout = subprocess.PIPE
+        )
+
+        for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+            result[remote_name] = line.strip()
+
+    return result
+
+def git_add_remote (repo_path, remote_name, remote_url):
+    run_command(['git', 'remote', 'add', remote_name, remote_url], repo_path)
+    run_command(
+        ['git', 'remote', 'set-url', remote_name, remote_url],
+        repo_path
+    )
+    invalidate_repo_snapshot(repo_path)
+
+
+def git_add_to_gitignore (entry_set, root_path):
+    try:
+        with open(root_path + os.sep + ".gitignore", 'r+') as file_stream:
+            for line in file_stream:
+                entry_set.discard(line.strip())
+
+                if (len(entry_set) == 0):
+                    return
+
+            for new_entry in entry_set:
+                print(new_entry, file=file_stream)
+    except FileNotFoundError:
+        print(
+            "No \""
+            + root_path
+            + os.sep
+            + ".gitignore\" file found. It will be created."
+        )
+        with open(root_path + os.sep + ".gitignore", 'w') as file_stream:
+            for new_entry in entry_set:
+                print(new_entry, file=file_stream)
+
+def git_remove_from_gitignore (path_list, root_path):
+    kept_content = list()
+
+    try:
+        with open(root_path + os.sep + ".gitignore", 'r') as file_stream:
+            for line in file_stream:
+                line = line.rstrip()
+
+                if (line not in path_list):
+                    kept_content.append(line.rstrip())
+    except FileNotFoundError:
+        print(
+            "No \""
+            + root_path
+            + os.sep
+            + ".gitignore\" file found. Nothing to remove from it."
+        )
+        return
+
+    with open(root_path + os.sep + ".gitignore", 'w') as file_stream:
+        for line in kept_content:
+            print(line, file=file_stream)
+
+def git_find_root_path ():
+    # from https://stackoverflow.com/questions/22081209/find-the-root-of-the-git-repository-where-the-file-lives
+    return subprocess.Popen(
+        ['git', 'rev-parse', '--show-toplevel'],
+        stdout = subprocess.PIPE
+    ).communicate()[0].rstrip().decode('utf-8')
+
+def git_is_repository_root (path):
+    result = read_git_is_repository_root(path)
+
+    if (result is not None):
+        return result
+
+    return (
+        subprocess.Popen(
+            ['git', 'rev-parse', '--show-toplevel'],
+            stdout = subprocess.PIPE,
+            cwd = path
+        ).communicate()[0].rstrip().decode('utf-8') == path
+    )
+
+def git_get_directory (repo_path):
+    directories = read_git_directories(repo_path)
+
+    if (directories):
+        return os.path.abspath(directories[0])
+
+    return subprocess.Popen(
+        ['git', 'rev-parse', '--absolute-git-dir'],
+        stdout = subprocess.PIPE,
+        cwd = repo_path
+    ).communicate()[0].rstrip().decode('utf-8')
+
+# Differs from the Git directory in linked worktrees.
+def git_get_common_directory (repo_path):
+    directories = read_git_directories(repo_path)
+
+    if (directories):
+        return os.path.abspath(directories[1])
+
+    return os.path.abspath(
+        os.path.join(
+            repo_path,
+            subprocess.Popen(
+                ['git', 'rev-parse', '--git-common-dir'],
+                stdout = subprocess.PIPE,
+                cwd = repo_path
+            ).communicate()[0].rstrip().decode('utf-8')
+        )
+    )
+
+def git_get_default_remote (repo_path):
+    result = read_git_default_remote(repo_path)
+
+    if (result is not None):
+        return result
+
+    result = "origin"
+
+    git_cmd = subprocess.Popen(
+        ['git', 'config', '--get', '--global', 'checkout.defaultRemote'],
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        result = line.strip()
+
+    git_cmd = subprocess.Popen(
+        ['git', 'config', '--get', 'checkout.defaultRemote'],
+        cwd = repo_path,
+        stdout = subprocess.PIPE
+    )
+    for line in io.TextIOWrapper(git_cmd.stdout, encoding="utf-8"):
+        result = line.strip()
+
+    return result
+
+################################################################################
+##### REPOSITORY SNAPSHOTS #####################################################
+################################################################################
+# What was queried about each repository during this run, so that it is not
+# queried again. A repository's snapshot must be invalidated by any operation
+# that changes it (clone, checkout, adding a remote...). Invalidating a
+# repository's snapshot also invalidates those of any repository it contains.
+class RepoSnapshot:
+    def __init__ (self, path):
+        self.path = path
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def get_value (self, name, query_function):
+        with self.lock:
+            if (name not in self.values):
+                self.values[name] = query_function(self.path)
+
+            return self.values[name]
+
+    def get_is_repository_root (self):
+        return self.get_value('is_repository_root', git_is_repository_root)
+
+    def get_git_directory (self):
+        return self.get_value('git_directory', git_get_directory)
+
+    def get_common_directory (self):
+        return self.get_value('common_directory', git_get_common_directory)
+
+    # Whether the repository is a worktree added to another one. Git resolves
+    # symbolic links in some of the paths it gives, but not in others.
+    def get_is_linked_worktree (self):
+        return (
+            os.path.realpath(self.get_git_directory())
+            != os.path.realpath(self.get_common_directory())
+        )
+
+    def get_current_commit_hash (self):
+        return self.get_value(
+            'current_commit_hash',
+            git_get_current_commit_hash
+        )
+
+    def get_remotes (self):
+        return dict(self.get_value('remotes', git_get_all_remotes))
+
+    def get_default_remote (self):
+        return self.get_value('default_remote', git_get_default_remote)
+
+    def get_has_uncommitted_changes (self):
+        return self.get_value(
+            'has_uncommitted_changes',
+            git_repository_has_uncommitted_changes
+        )
+
+repo_snapshot_of_path = dict()
+repo_snapshots_lock = threading.Lock()
+
+def get_repo_snapshot (path):
+    path = os.path.abspath(path)
+
+    with repo_snapshots_lock:
+        if (path not in repo_snapshot_of_path):
+            repo_snapshot_of_path[path] = RepoSnapshot(path)
+
+        return repo_snapshot_of_path[path]
+
+def invalidate_repo_snapshot (path):
+    path = os.path.abspath(path)
+
+    with repo_snapshots_lock:
+        for snapshot_path in list(repo_snapshot_of_path):
+            if (
+                (snapshot_path == path)
+                or snapshot_path.startswith(path + os.sep)
+            ):
+                del repo_snapshot_of_path[snapshot_path]
+
+################################################################################
+##### REMOTE REFERENCES CACHE ##################################################
+################################################################################
+# Lists of references advertised by each remote URL, so that a remote is only
+# queried once per run regardless of how many lookups are done on it. The
+# cache can also be stored in the root repository's Git directory, entries
+# being reused by later runs until they are older than a given time to live.
+remote_references_of_url = dict()
+remote_references_latency_of_url = dict()
+remote_references_lock_of_url = dict()
+remote_references_lock = threading.Lock()
+
+def get_remote_references_cache_file (root_path):
+    return (
+        get_repo_snapshot(root_path).get_git_directory()
+        + os.sep
+        + "git-submodules"
+        + os.sep
+        + "remote-references.json"
+    )
+
+# Returns an empty list if the remote could not be reached.
+def get_remote_references (local_repo_path, remote_repo_url):
+    references = query_remote_references(local_repo_path, remote_repo_url)
+
+    if (references is None):
+        return []
+
+    return references
+
+def get_remote_references_lock_of (remote_repo_url):
+    with remote_references_lock:
+        if (remote_repo_url not in remote_references_lock_of_url):
+            remote_references_lock_of_url[remote_repo_url] = threading.Lock()
+
+        return remote_references_lock_of_url[remote_repo_url]
+
+# Actually asks the remote, recording how long it took to answer. To be called
+# with the remote's lock held.
+def refresh_remote_references (local_repo_path, remote_repo_url):
+    start_time = time.monotonic()
+    references = git_get_remote_references(local_repo_path, remote_repo_url)
+
+    remote_references_latency_of_url[remote_repo_url] = (
+        time.monotonic() - start_time
+    )
+    remote_references_of_url[remote_repo_url] = (time.time(), references)
+
+# Relative paths to local repositories depend on the directory Git is run from,
+# so remotes are known by the absolute path these resolve to.
+def resolve_remote_url (local_repo_path, remote_repo_url):
+    if (
+        is_remote_source_url(remote_repo_url)
+        or os.path.isabs(remote_repo_url)
+    ):
+        return remote_repo_url
+
+    return os.path.normpath(
+        os.path.abspath(local_repo_path) + os.sep + remote_repo_url
+    )
+
+# Returns None if the remote could not be reached.
+def query_remote_references (local_repo_path, remote_repo_url):
+    remote_repo_url = resolve_remote_url(local_repo_path, remote_repo_url)
+
+    with get_remote_references_lock_of(remote_repo_url):
+        if (remote_repo_url not in remote_references_of_url):
+            refresh_remote_references(local_repo_path, remote_repo_url)
+
+        (fetch_time, references) = remote_references_of_url[remote_repo_url]
+
+    return references
+
+# Returns the references (as query_remote_references does) along with how long
+# the remote took to list them. Remotes whose references were only loaded from
+# the cache file are asked again, so that the latency is never that of the
+# cache.
+def query_remote_references_latency (local_repo_path, remote_repo_url):
+    remote_repo_url = resolve_remote_url(local_repo_path, remote_repo_url)
+
+    with get_remote_references_lock_of(remote_repo_url):
+        if (remote_repo_url not in remote_references_latency_of_url):
+            refresh_remote_references(local_repo_path, remote_repo_url)
+
+        (fetch_time, references) = remote_references_of_url[remote_repo_url]
+
+        return (
+            references,
+            remote_references_latency_of_url[remote_repo_url]
+        )
+
+def load_remote_references_cache (root_path, time_to_live):
+    cache_file = get_remote_references_cache_file(root_path)
+    oldest_valid_time = time.time() - time_to_live
+
+    try:
+        with open(cache_file, 'r') as file_stream:
+            entries = json.load(file_stream)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        print(
+            "[W] Ignoring unreadable remote references cache \""
+            + cache_file
+            + "\".",
+            file = sys.stderr
+        )
+        return
+
+    for remote_repo_url in entries:
+        (fetch_time, references) = entries[remote_repo_url]
+
+        if (fetch_time >= oldest_valid_time):
+            remote_references_of_url[remote_repo_url] = (
+                fetch_time,
+                [tuple(entry) for entry in references]
+            )
+
+# Unreachable remotes are not stored, so that they are tried again next time.
+def save_remote_references_cache (root_path):
+    cache_file = get_remote_references_cache_file(root_path)
+    entries = dict()
+
+    for remote_repo_url in remote_references_of_url:
+        (fetch_time, references) = remote_references_of_url[remote_repo_url]
+
+        if (references is not None):
+            entries[remote_repo_url] = (fetch_time, references)
+
+    ensure_directory_exists(os.path.dirname(cache_file))
+    replace_file_content(cache_file, json.dumps(entries))
+
+################################################################################
+##### OBJECT CACHE #############################################################
+################################################################################
+# Clones can borrow objects from bare mirrors of their sources, kept in a cache
+# directory shared by any number of workspaces. Each mirror is updated at most
+# once per run, and is then given to 'git clone' as a reference, so that only
+# the objects missing from it are fetched from the source. Cloned repositories
+# keep relying on the mirrors' objects (through Git's alternates), which is why
+# the mirrors are never pruned.
+updated_cache_mirrors = dict()
+cache_mirror_lock_of_path = dict()
+cache_mirror_lock = threading.Lock()
+
+class CloneOptions:
+    def __init__ (self):
+        self.cache_directory = None
+        self.staging_directory = None
+        self.is_incremental = False
+        self.is_racing_sources = False
+        self.is_using_declared_order = False
+        self.bundle_of_path = None
+        self.is_using_worktrees = False
+
+    def get_cache_directory (self):
+        return self.cache_directory
+
+    # When set, each source is fetched once into a mirror in this directory,
+    # and submodules are then cloned from that mirror instead of the source.
+    def get_staging_directory (self):
+        return self.staging_directory
+
+    def get_is_incremental (self):
+        return self.is_incremental
+
+    def get_is_racing_sources (self):
+        return self.is_racing_sources
+
+    def get_is_using_declared_order (self):
+        return self.is_using_declared_order
+
+    def get_is_using_worktrees (self):
+        return self.is_using_worktrees
+
+    def get_is_using_bundles (self):
+        return (self.bundle_of_path is not None)
+
+    # Returns the (commit, bundle file, bundle reference) triple to populate the
+    # repository at 'repository_dir' from, or None if there is none (see
+    # "BUNDLES").
+    def get_bundle_of (self, repository_dir):
+        return self.bundle_of_path.get(os.path.normpath(repository_dir))
+
+    def set_cache_directory (self, cache_directory):
+        self.cache_directory = cache_directory
+
+    def set_staging_directory (self, staging_directory):
+        self.staging_directory = staging_directory
+
+    def set_is_incremental (self, is_incremental):
+        self.is_incremental = is_incremental
+
+    def set_is_racing_sources (self, is_racing_sources):
+        self.is_racing_sources = is_racing_sources
+
+    def set_is_using_declared_order (self, is_using_declared_order):
+        self.is_using_declared_order = is_using_declared_order
+
+    def set_bundle_of_path (self, bundle_of_path):
+        self.bundle_of_path = bundle_of_path
+
+    def set_is_using_worktrees (self, is_using_worktrees):
+        self.is_using_worktrees = is_using_worktrees
+
+# Options shared by all commands cloning submodules.
+def get_clone_options (options, root_path):
+    result = CloneOptions()
+
+    if ('--cache-dir' in options):
+        result.set_cache_directory(os.path.abspath(options['--cache-dir']))
+    elif (len(os.environ.get('SNSM_CACHE_DIR', "")) > 0):
+        result.set_cache_directory(
+            os.path.abspath(os.environ['SNSM_CACHE_DIR'])
+        )
+
+    result.set_is_incremental('--incremental' in options)
+    result.set_is_racing_sources('--race-sources' in options)
+    result.set_is_using_declared_order('--declared-order' in options)
+    result.set_is_using_worktrees('--use-worktrees' in options)
+
+    if ('--from-bundles' in options):
+        result.set_bundle_of_path(
+            load_bundle_index(
+                os.path.abspath(options['--from-bundles']),
+                root_path
+            )
+        )
+
+    if ('--share-fetches' in options):
+        if (result.get_cache_directory() is not None):
+            result.set_staging_directory(result.get_cache_directory())
+        else:
+            result.set_staging_directory(
+                get_repo_snapshot(root_path).get_git_directory()
+                + os.sep
+                + "git-submodules"
+                + os.sep
+                + "staging"
+            )
+
+    return result
+
+# Local paths are not worth mirroring: Git already hardlinks their objects.
+def is_remote_source_url (source_url):
+    return (
+        ("://" in source_url)
+        or (re.match(r'^[^/:]+:', source_url) is not None)
+    )
+
+# Mirrors are identified by the source URL as written, as sources are everywhere
+# else: whether "x" and "x.git" are the same repository is up to each server.
+# The readable part of the name only helps finding a mirror by hand.
+def get_cache_mirror_path (cache_directory, source_url):
+    readable_name = re.sub(
+        r'[^A-Za-z0-9._-]',
+        "_",
+        re.sub(
+            r'\.git$',
+            "",
+            source_url.rstrip("/").rsplit("/", 1)[-1].rsplit(":", 1)[-1]
+        )
+    )
+
+    return (
+        cache_directory
+        + os.sep
+        + readable_name
+        + "-"
+        + hashlib.sha1(source_url.encode('utf-8')).hexdigest()[:16]
+        + ".git"
+    )
+
+# Returns the path to an up-to-date mirror of the source, or None if there
+# is none (in which case the source is simply cloned without any reference).
+def get_cache_mirror (cache_directory, source_url):
+    if ((cache_directory is None) or (not is_remote_source_url(source_url))):
+        return None
+
+    mirror_path = get_cache_mirror_path(cache_directory, source_url)
+
+    with cache_mirror_lock:
+        if (mirror_path not in cache_mirror_lock_of_path):
+            cache_mirror_lock_of_path[mirror_path] = threading.Lock()
+
+        mirror_lock = cache_mirror_lock_of_path[mirror_path]
+
+    with mirror_lock:
+        if (mirror_path not in updated_cache_mirrors):
+            ensure_directory_exists(cache_directory)
+
+            # Other processes may be using the same cache directory.
+            with open(mirror_path + ".lock", 'w') as lock_stream:
+                fcntl.flock(lock_stream, fcntl.LOCK_EX)
+
+                updated_cache_mirrors[mirror_path] = update_cache_mirror(
+                    mirror_path,
+                    source_url
+                )
+
+        if (not updated_cache_mirrors[mirror_path]):
+            return None
+
+    return mirror_path
+
+def update_cache_mirror (mirror_path, source_url):
+    if (os.path.isdir(mirror_path)):
+        print("Updating cache mirror \"" + mirror_path + "\"...")
+
+        return (
+            run_network_command(
+                ['git', 'fetch', '--quiet', source_url, '+refs/*:refs/*'],
+                mirror_path
+            )
+            == 0
+        )
+
+    print(
+        "Creating cache mirror \""
+        + mirror_path
+        + "\" for \""
+        + source_url
+        + "\"..."
+    )
+
+    temporary_path = mirror_path + ".tmp." + str(os.getpid())
+
+    run_command(['rm', '-rf', temporary_path], None)
+
+    if (
+        run_network_command(
+            ['git', 'clone', '--quiet', '--mirror', source_url, temporary_path],
+            None,
+            functools.partial(run_command, ['rm', '-rf', temporary_path], None)
+        )
+        != 0
+    ):
+        run_command(['rm', '-rf', temporary_path], None)
+
+        return False
+
+    run_command(
+        ['git', 'config', 'gc.pruneExpire', 'never'],
+        temporary_path
+    )
+    os.replace(temporary_path, mirror_path)
+
+    return True
+
+# Mirrors staged in the root repository's Git directory are only kept for the
+# run: clones made from them have their own copy of the objects. Those staged
+# in the cache directory are kept like any other cache mirror.
+def remove_staging_mirrors (clone_options):
+    staging_directory = clone_options.get_staging_directory()
+
+    if (
+        (staging_directory is None)
+        or (staging_directory == clone_options.get_cache_directory())
+    ):
+        return
+
+    for mirror_path in updated_cache_mirrors:
+        if (os.path.dirname(mirror_path) != staging_directory):
+            continue
+
+        # Other processes may be using the same mirrors.
+        with open(mirror_path + ".lock", 'w') as lock_stream:
+            fcntl.flock(lock_stream, fcntl.LOCK_EX)
+
+            run_command(['rm', '-rf', mirror_path], None)
+            os.remove(mirror_path + ".lock")
+
+    # Unless another run is still using it.
+    try:
+        os.rmdir(staging_directory)
+    except OSError:
+        pass
+
+################################################################################
+##### WORKTREES ################################################################
+################################################################################
+# Submodules using the same sources (wherever they are in the tree of
+# submodules) can share a single repository: the first of them to be handled
+# becomes its primary local copy, and the others are added to it as worktrees
+# instead of being cloned, once it is ready. Worktrees are always on a detached
+# HEAD, as a branch cannot be checked out in two worktrees at once. Shallow and
+# partial clones are not shared.
+primary_local_copy_of_sources = dict()
+primary_local_copy_lock = threading.Lock()
+
+# Returns the path of the primary local copy for the submodule's sources, and
+# an event set once that copy is ready. 'repository_dir' becomes that primary
+# local copy if there is none yet. As worktrees share their remotes, sources
+# must be written exactly the same way, and named sources have the same names.
+def claim_primary_local_copy (submodule, repository_dir):
+    named_sources = submodule.get_named_sources()
+    sources_key = (
+        frozenset(submodule.get_sources()),
+        frozenset(named_sources.items())
+    )
+
+    if (
+        (len(submodule.get_sources()) == 0)
+        or submodule.get_is_shallow_or_partial()
+    ):
+        return (repository_dir, None)
+
+    with primary_local_copy_lock:
+        if (sources_key not in primary_local_copy_of_sources):
+            primary_local_copy_of_sources[sources_key] = (
+                repository_dir,
+                threading.Event()
+            )
+
+        return primary_local_copy_of_sources[sources_key]
+
+################################################################################
+##### SOURCE STATISTICS ########################################################
+################################################################################
+# How each source fared when cloning or fetching from it, kept in the root
+# repository's Git directory so that later runs can try the most reliable and
+# quickest sources first. Older attempts weigh less and less, so that the
+# statistics follow changes in which sources are best (e.g. when working from
+# another site). Clones and fetches are kept apart, their durations having
+# little in common. Each entry is [attempts, failures, latency], 'latency'
+# being the weighted average duration of successful attempts (None if none).
+# Only the network operation itself is accounted for: clones made from mirrors
+# and failed checkouts are not the source's doing.
+source_statistics_of_url = dict()
+source_statistics_lock = threading.Lock()
+source_statistics_decay = 0.9
+
+def get_source_statistics_file (root_path):
+    return (
+        get_repo_snapshot(root_path).get_git_directory()
+        + os.sep
+        + "git-submodules"
+        + os.sep
+        + "source-statistics.json"
+    )
+
+def load_source_statistics (root_path):
+    statistics_file = get_source_statistics_file(root_path)
+
+    try:
+        with open(statistics_file, 'r') as file_stream:
+            entries = json.load(file_stream)
+    except FileNotFoundError:
+        return
+    except ValueError:
+        print(
+            "[W] Ignoring unreadable source statistics \""
+            + statistics_file
+            + "\".",
+            file = sys.stderr
+        )
+        return
+
+    with source_statistics_lock:
+        for source in entries:
+            # Entries from older versions did not tell clones and fetches apart.
+            if (isinstance(entries[source], dict)):
+                source_statistics_of_url[source] = dict(entries[source])
+
+def save_source_statistics (root_path):
+    statistics_file = get_source_statistics_file(root_path)
+
+    with source_statistics_lock:
+        content = json.dumps(source_statistics_of_url)
+
+    ensure_directory_exists(os.path.dirname(statistics_file))
+    replace_file_content(statistics_file, content)
+
+# 'operation' is either "clone" or "fetch". 'attempt_durations' are those given
+# by 'run_network_command': nothing is recorded if no attempt was made.
+def record_source_attempt (source, operation, is_successful, attempt_durations):
+    if (len(attempt_durations) == 0):
+        return
+
+    duration = attempt_durations[-1]
+
+    with source_statistics_lock:
+        statistics = source_statistics_of_url.setdefault(source, dict())
+        (attempts, failures, latency) = statistics.get(
+            operation,
+            [0.0, 0.0, None]
+        )
+
+        attempts = (attempts * source_statistics_decay) + 1.0
+        failures = failures * source_statistics_decay
+
+        if (not is_successful):
+            failures = failures + 1.0
+        elif (latency is None):
+            latency = duration
+        else:
+            latency = (
+                (latency * source_statistics_decay)
+                + (duration * (1.0 - source_statistics_decay))
+            )
+
+        statistics[operation] = [attempts, failures, latency]
+
+# Sources are ordered by failure rate, then by latency. Sources that never
+# succeeded come after those that did, unless they failed more often.
+def rank_sources (sources, operation):
+    def get_rank (source):
+        (attempts, failures, latency) = source_statistics_of_url.get(
+            source,
+            dict()
+        ).get(operation, [0.0, 0.0, None])
+        failure_rate = (failures / attempts) if (attempts > 0) else 0.0
+
+        return (
+            round(failure_rate, 2),
+            (float('inf') if (latency is None) else latency)
+        )
+
+    with source_statistics_lock:
+        ranks = [get_rank(source) for source in sources]
+
+    return [
+        source
+        for (rank, index, source) in sorted(
+            zip(ranks, range(len(sources)), sources)
+        )
+    ]
+
+################################################################################
+##### SOURCE SELECTION #########################################################
+################################################################################
+# Sources are normally tried according to how they fared in previous runs
+# (see "SOURCE STATISTICS"), or in the order in which they are declared if
+# requested. When racing them, all of them are first asked for their
+# references at the same time (through the remote references cache), and those
+# advertising what is to be checked out come first, the quickest to answer
+# first. Unreachable sources come last. The declared order only breaks ties.
+def get_ordered_sources (
+    submodule,
+    repository_dir,
+    target,
+    clone_options,
+    operation
+):
+    sources = submodule.get_sources()
+
+    if (len(sources) < 2):
+        return list(sources)
+
+    if (clone_options.get_is_racing_sources()):
+        return race_sources(submodule, repository_dir, target, sources)
+
+    if (clone_options.get_is_using_declared_order()):
+        return list(sources)
+
+    return rank_sources(sources, operation)
+
+# Names under which sources would advertise the target: its hash for a commit,
+# or its full reference name.
+def get_advertised_names_of (submodule, target):
+    if (
+        (target == submodule.get_commit())
+        or (git_object_hash_regex.match(target) is not None)
+    ):
+        return set([target])
+
+    if (submodule.get_target_type() == "tag"):
+        return set(["refs/tags/" + target, "refs/tags/" + target + "^{}"])
+
+    return set(["refs/heads/" + target])
+
+# Returns (rank, latency), rank being 0 if the source advertises the target, 1
+# if it does not, and 2 if it could not be reached. Sources already asked
+# during the run are not asked again: the latency is the one measured then.
+def probe_source (repository_dir, source, advertised_names):
+    (references, latency) = query_remote_references_latency(
+        repository_dir,
+        source
+    )
+
+    if (references is None):
+        return (2, latency)
+
+    for (commit_hash, reference) in references:
+        if (
+            (commit_hash in advertised_names)
+            or (reference in advertised_names)
+        ):
+            return (0, latency)
+
+    return (1, latency)
+
+def race_sources (submodule, repository_dir, target, sources):
+    advertised_names = get_advertised_names_of(submodule, target)
+    output_blocks = [[] for source in sources]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers = len(sources)
+    ) as pool:
+        probes = list(
+            pool.map(
+                lambda source, output_block: run_with_output_block(
+                    functools.partial(
+                        probe_source,
+                        repository_dir,
+                        source,
+                        advertised_names
+                    ),
+                    output_block
+                ),
+                sources,
+                output_blocks
+            )
+        )
+
+    # Keeps the output of the probes with that of the submodule.
+    for output_block in output_blocks:
+        add_output_block(output_block)
+
+    result = [
+        source
+        for (probe, index, source) in sorted(
+            zip(probes, range(len(sources)), sources)
+        )
+    ]
+
+    print(
+        "Sources of submodule \""
+        + submodule.get_path()
+        + "\", in the order they will be tried: "
+        + ", ".join(["\"" + source + "\"" for source in result])
+        + "."
+    )
+
+    return result
+
+################################################################################
+##### DESCRIPTION FILE SYNTAX ##################################################
+################################################################################
+# Each line of a description file is classified by a single match against this
+# expression: the name of the outer group that matched (i.e. the match's
+# 'lastgroup') is the kind of line. It is used both to read and to update
+# description files.
+description_line_regex = re.compile(
+    r'^\s*(?:'
+    r'(?P<submodule>\[submodule\s*"(?P<submodule_path>.+)"\])'
+    r'|(?P<source>source\s*=\s*(?P<source_url>[^\s].*[^\s]))'
+    r'|(?P<named_source>'
+        r'source\.(?P<named_source_name>[^\s]+)\s*=\s*'
+        r'(?P<named_source_url>[^\s].*[^\s])'
+    r')'
+    r'|(?P<commit>commit\s*=\s*(?P<commit_value>[^\s].*[^\s]))'
+    r'|(?P<target>'
+        r'target\s*=\s*'
+        r'(?P<target_value>commit|(?:branch\s+[^\s]+)|(?:tag\s+[^\s]+))'
+    r')'
+    r'|(?P<enable>enable\s*=\s*(?P<enable_value>[^\s].*[^\s]))'
+    r'|(?P<target_overrides_commit>'
+        r'target_overrides_commit\s*=\s*'
+        r'(?P<target_overrides_commit_value>[^\s].*[^\s])'
+    r')'
+    r'|(?P<depth>depth\s*=\s*(?P<depth_value>[1-9][0-9]*)\s*$)'
+    r'|(?P<filter>filter\s*=\s*(?P<filter_value>[^\s]+)\s*$)'
+    r')'
+)
+
+def is_true_value (value):
+    return (value.lower() in ["true", "t", "yes", "y", "1"])
+
+################################################################################
+##### GIT SUBMODULE CLASS ######################################################
+################################################################################
+class GitSubmodule:
+    def __init__ (self, path):
+        self.path = path
+        self.sources = []
+        self.named_sources = dict()
+        self.commit = None
+        self.enabled = True
+        self.target = None
+        self.target_type = "commit"
+        self.target_overrides_commit = False
+        self.depth = None
+        self.filter = None
+
+    def get_path (self):
+        return self.path
+
+    def get_sources (self):
+        return self.sources
+
+    def get_named_sources (self):
+        return self.named_sources
+
+    def get_commit (self):
+        return self.commit
+
+    def get_target (self):
+        if (self.get_target_type() == "commit"):
+            return self.get_commit()
+        else:
+            return self.target
+
+    def get_target_type (self):
+        return self.target_type
+
+    def get_target_overrides_commit (self):
         return self.target_overrides_commit
 
-    def get_is_enabled (self):
-        return self.enabled
+    def get_is_enabled (self):
+        return self.enabled
+
+    # Number of commits to clone (all if None).
+    def get_depth (self):
+        return self.depth
+
+    # Object filter used for partial clones (e.g. "blob:none"), if any.
+    def get_filter (self):
+        return self.filter
+
+    def disable (self):
+        self.enabled = False
+
+    def add_source (self, source):
+        if (not (source in self.get_sources())):
+            self.sources.append(source)
+
+    def add_named_source (self, name, source):
+        self.named_sources[name] = source
+
+    def set_commit (self, commit):
+        self.commit = commit
+
+    def set_target_type (self, target_type):
+        self.target_type = target_type
+
+    def set_target (self, target):
+        self.target = target
+
+    def set_target_overrides_commit (self, target_overrides_commit):
+        self.target_overrides_commit = target_overrides_commit
+
+    def set_depth (self, depth):
+        self.depth = depth
+
+    def set_filter (self, filter_spec):
+        self.filter = filter_spec
+
+    def print_to (self, file_stream):
+        print('[submodule "' + self.get_path() + '"]', file = file_stream)
+
+        for source in self.get_sources():
+            print('   source = ' + source, file = file_stream)
+
+        named_sources = self.get_named_sources()
+
+        for name in named_sources:
+            print(
+                '   source.' + name + ' = ' + named_sources[name],
+                file = file_stream
+            )
+
+        print('   commit = ' + str(self.get_commit()), file = file_stream)
+        print('   enable = ' + str(self.get_is_enabled()), file = file_stream)
+
+        if (self.get_target_type() == "commit"):
+            print( '   target = commit', file = file_stream)
+        else:
+            print(
+                '   target = '
+                + self.get_target_type()
+                + ' '
+                + str(self.get_target()),
+                file = file_stream
+            )
+
+        print(
+            '   target_overrides_commit = '
+            + str(self.get_target_overrides_commit()),
+            file = file_stream
+        )
+
+        if (self.get_depth() is not None):
+            print('   depth = ' + str(self.get_depth()), file = file_stream)
+
+        if (self.get_filter() is not None):
+            print('   filter = ' + self.get_filter(), file = file_stream)
+
+    # Compact form of the submodule, only made of built-in types.
+    def to_record (self):
+        return (
+            self.path,
+            list(self.sources),
+            list(self.named_sources.items()),
+            self.commit,
+            self.enabled,
+            self.target,
+            self.target_type,
+            self.target_overrides_commit,
+            self.depth,
+            self.filter
+        )
+
+    def from_record (record):
+        result = GitSubmodule(record[0])
+
+        result.sources = list(record[1])
+        result.named_sources = dict(record[2])
+        result.commit = record[3]
+        result.enabled = record[4]
+        result.target = record[5]
+        result.target_type = record[6]
+        result.target_overrides_commit = record[7]
+        result.depth = record[8]
+        result.filter = record[9]
+
+        return result
+
+    def add_environment_variables (self, env_vars):
+        env_vars['SNSM_COMMIT'] = self.get_commit()
+        env_vars['SNSM_ENABLED'] = "1" if self.get_is_enabled() else "0"
+        env_vars['SNSM_SOURCES'] = "\n".join(self.get_sources())
+        env_vars['SNSM_NAMED_SOURCES'] = (
+            "\n".join(
+                [
+                    name + " " + source
+                    for (name, source) in self.get_named_sources().items()
+                ]
+            )
+        )
+        env_vars['SNSM_TARGET_TYPE'] = self.get_target_type()
+        env_vars['SNSM_TARGET'] = self.get_target()
+        env_vars['SNSM_TARGET_OVERRIDES_COMMIT'] = (
+            "1" if self.get_target_overrides_commit() else "0"
+        )
+
+        if (env_vars['SNSM_COMMIT'] is None):
+            env_vars['SNSM_COMMIT'] = ''
+
+        if (self.get_target() is None):
+            env_vars['SNSM_TARGET'] = env_vars['SNSM_COMMIT']
+
+    # Returns what to check out, and whether new commits should then be merged
+    # into it. Targets resolved by a loaded lock file are replaced by the
+    # commit they were resolved to.
+    def get_checkout_target (self, force_target, repository_dir):
+        if (self.get_target_overrides_commit() or force_target):
+            locked_commit = get_locked_commit(repository_dir, self)
+
+            if (locked_commit is not None):
+                return (locked_commit, False)
+
+            return (self.get_target(), (self.get_target_type() == "branch"))
+
+        return (self.get_commit(), False)
+
+    # Whether the local copy already is what updating it would produce. This is
+    # never the case when following a branch, as it may have moved since.
+    def get_is_local_copy_up_to_date (self, root_dir, force_target):
+        repository_dir = root_dir + os.sep + self.get_path()
+        repo_snapshot = get_repo_snapshot(repository_dir)
+        (target, should_merge) = self.get_checkout_target(
+            force_target,
+            repository_dir
+        )
+
+        if ((target is None) or (not repo_snapshot.get_is_repository_root())):
+            return False
+
+        (reference, refspec) = self.get_target_reference(target)
+
+        if (reference.startswith("refs/remotes/")):
+            return False
+
+        if (reference != target):
+            target = git_get_commit_hash_of(repository_dir, reference)
+
+        if (target != repo_snapshot.get_current_commit_hash()):
+            return False
+
+        remotes = repo_snapshot.get_remotes()
+        named_sources = self.get_named_sources()
+
+        for name in named_sources:
+            if (remotes.get(name) != named_sources[name]):
+                return False
+
+        return True
+
+    def clone_repository (self, root_dir, force_target, clone_options):
+        repository_dir = root_dir + os.sep + self.get_path()
+        ensure_directory_exists(repository_dir)
+
+        if (clone_options.get_is_using_bundles()):
+            self.clone_from_bundle(
+                root_dir,
+                clone_options.get_bundle_of(repository_dir)
+            )
+
+            return
+
+        (target, should_merge) = self.get_checkout_target(
+            force_target,
+            repository_dir
+        )
+
+        repo_snapshot = get_repo_snapshot(repository_dir)
+
+        if (repo_snapshot.get_is_repository_root()):
+            checkout_command = ['git', 'checkout', target]
+
+            if (repo_snapshot.get_is_linked_worktree()):
+                checkout_command = [
+                    'git',
+                    'checkout',
+                    '--detach',
+                    self.get_target_reference(target)[0]
+                ]
+                should_merge = False
+
+            if (self.get_has_target_locally(repository_dir, target)):
+                print(
+                    "\""
+                    + target
+                    + "\" is already available for submodule \""
+                    + self.get_path()
+                    + "\". Nothing to fetch."
+                )
+            elif (
+                not self.fetch_target(
+                    repository_dir,
+                    target,
+                    get_ordered_sources(
+                        self,
+                        repository_dir,
+                        target,
+                        clone_options,
+                        "fetch"
+                    )
+                )
+            ):
+                print(
+                    "[W] Could not fetch \""
+                    + target
+                    + "\" for submodule \""
+                    + self.get_path()
+                    + "\" from any of its sources.",
+                    file = sys.stderr
+                )
+
+            checkout_result = run_command(checkout_command, repository_dir)
+
+            invalidate_repo_snapshot(repository_dir)
+
+            if (checkout_result == 0):
+                print("Submodule \"" + self.get_path() + "\" checked out.")
+                if (should_merge):
+                    print("Merging any new commits into the local branch...")
+                    run_command(['git', 'merge'], repository_dir)
+                    invalidate_repo_snapshot(repository_dir)
+
+                named_sources = self.get_named_sources()
+
+                for name in named_sources:
+                    git_add_remote(repository_dir, name, named_sources[name])
+
+                return
+            else:
+                print(
+                    "Target commit not available with current source for"
+                    + " submodule \""
+                    + self.get_path()
+                    + "\". Resetting local copy."
+                )
+
+                run_command(['rm', '-rf', self.get_path()], root_dir)
+                invalidate_repo_snapshot(repository_dir)
+                ensure_directory_exists(repository_dir)
+
+        for source in get_ordered_sources(
+            self,
+            repository_dir,
+            target,
+            clone_options,
+            "clone"
+        ):
+            print(
+                "Cloning submodule \""
+                + self.get_path()
+                + "\" from \""
+                + source
+                + "\"..."
+            )
+
+            attempt_durations = []
+            clone_result = self.clone_from_source(
+                source,
+                root_dir,
+                target,
+                clone_options,
+                attempt_durations
+            )
+
+            invalidate_repo_snapshot(repository_dir)
+            record_source_attempt(
+                source,
+                "clone",
+                (clone_result == 0),
+                attempt_durations
+            )
+
+            if (clone_result != 0):
+                print("Failed at Git clone.")
+
+                continue
+
+            checkout_result = run_command(
+                ['git', 'checkout', target],
+                repository_dir
+            )
+
+            invalidate_repo_snapshot(repository_dir)
+
+            if (checkout_result == 0):
+                if (should_merge):
+                    print("Merging any new commits into the local branch...")
+                    run_command(['git', 'merge'], repository_dir)
+                    invalidate_repo_snapshot(repository_dir)
+                print("Done.")
+
+                named_sources = self.get_named_sources()
+
+                for name in named_sources:
+                    git_add_remote(repository_dir, name, named_sources[name])
+
+                return
+            else:
+                print(
+                    "Failed at Git checkout \""
+                    + target
+                    + "\" from source \""
+                    + source
+                    + "\"."
+                )
+
+                run_command(['rm', '-rf', self.get_path()], root_dir)
+                invalidate_repo_snapshot(repository_dir)
+                ensure_directory_exists(repository_dir)
+
+                print("Removed cloned repository.")
+
+                continue
+
+        print(
+            "[F] Could not clone submodule \""
+            + self.get_path()
+            + "\" into \""
+            + repository_dir
+            +"\".",
+            file = sys.stderr
+        )
+        sys.exit(-1)
+
+    # Adds the local copy as a worktree of 'primary_dir', the primary local copy
+    # of the same sources (see "WORKTREES"), after fetching the target there if
+    # needed. The local copy is cloned instead if that fails.
+    def add_worktree (self, root_dir, force_target, primary_dir, clone_options):
+        repository_dir = root_dir + os.sep + self.get_path()
+        (target, should_merge) = self.get_checkout_target(
+            force_target,
+            repository_dir
+        )
+
+        if (not get_repo_snapshot(primary_dir).get_is_repository_root()):
+            print("Cloning \"" + repository_dir + "\"...")
+
+            self.clone_repository(root_dir, force_target, clone_options)
+
+            return
+
+        if (
+            (not self.get_has_target_locally(primary_dir, target))
+            and not self.fetch_target(
+                primary_dir,
+                target,
+                get_ordered_sources(
+                    self,
+                    primary_dir,
+                    target,
+                    clone_options,
+                    "fetch"
+                )
+            )
+        ):
+            print(
+                "[W] Could not fetch \""
+                + target
+                + "\" for submodule \""
+                + self.get_path()
+                + "\" from any of its sources.",
+                file = sys.stderr
+            )
+
+        print(
+            "Adding submodule \""
+            + self.get_path()
+            + "\" as a worktree of \""
+            + primary_dir
+            + "\"..."
+        )
+
+        ensure_directory_exists(repository_dir)
+
+        worktree_result = run_command(
+            [
+                'git',
+                'worktree',
+                'add',
+                '--detach',
+                repository_dir,
+                self.get_target_reference(target)[0]
+            ],
+            primary_dir
+        )
+
+        invalidate_repo_snapshot(repository_dir)
+
+        if (worktree_result != 0):
+            print("Failed at Git worktree. Cloning it instead.")
+
+            run_command(['rm', '-rf', self.get_path()], root_dir)
+            run_command(['git', 'worktree', 'prune'], primary_dir)
+            invalidate_repo_snapshot(repository_dir)
+
+            self.clone_repository(root_dir, force_target, clone_options)
+
+            return
+
+        print("Done.")
+
+        named_sources = self.get_named_sources()
+
+        for name in named_sources:
+            git_add_remote(repository_dir, name, named_sources[name])
+
+    # Populates (or updates) the local copy from the (commit, bundle file,
+    # bundle reference) triple 'bundle', without any network access, then
+    # points its remotes to the sources.
+    def clone_from_bundle (self, root_dir, bundle):
+        repository_dir = root_dir + os.sep + self.get_path()
+
+        if (bundle is None):
+            print(
+                "[F] No bundle was exported for submodule \""
+                + self.get_path()
+                + "\".",
+                file = sys.stderr
+            )
+            sys.exit(-1)
+
+        (commit, bundle_file, bundle_reference) = bundle
+
+        if (not get_repo_snapshot(repository_dir).get_is_repository_root()):
+            run_command(['git', 'init', '--quiet'], repository_dir)
+            invalidate_repo_snapshot(repository_dir)
+
+        if (git_has_commit(repository_dir, commit)):
+            print(
+                "\""
+                + commit
+                + "\" is already available for submodule \""
+                + self.get_path()
+                + "\". Nothing to fetch."
+            )
+        else:
+            print(
+                "Fetching submodule \""
+                + self.get_path()
+                + "\" from bundle \""
+                + bundle_file
+                + "\"..."
+            )
+
+            fetch_result = run_command(
+                ['git', 'fetch', bundle_file, bundle_reference],
+                repository_dir
+            )
+
+            if (fetch_result != 0):
+                print(
+                    "[F] Could not fetch from bundle \""
+                    + bundle_file
+                    + "\".",
+                    file = sys.stderr
+                )
+                sys.exit(-1)
+
+        checkout_result = run_command(
+            ['git', 'checkout', commit],
+            repository_dir
+        )
+
+        invalidate_repo_snapshot(repository_dir)
+
+        if (checkout_result != 0):
+            print(
+                "[F] Could not check out commit \""
+                + commit
+                + "\" for submodule \""
+                + self.get_path()
+                + "\".",
+                file = sys.stderr
+            )
+            sys.exit(-1)
+
+        print("Submodule \"" + self.get_path() + "\" checked out.")
+
+        if (len(self.get_sources()) > 0):
+            git_add_remote(repository_dir, 'origin', self.get_sources()[0])
+
+        named_sources = self.get_named_sources()
+
+        for name in named_sources:
+            git_add_remote(repository_dir, name, named_sources[name])
+
+    # Returns the exit code of the clone.
+    # The duration of each attempt at cloning from the source itself is appended
+    # to 'attempt_durations' (see "SOURCE STATISTICS").
+    def clone_from_source (
+        self,
+        source,
+        root_dir,
+        target,
+        clone_options,
+        attempt_durations
+    ):
+        repository_dir = root_dir + os.sep + self.get_path()
+
+        # An interrupted clone may leave a partial repository behind.
+        def prepare_retry ():
+            run_command(['rm', '-rf', self.get_path()], root_dir)
+            ensure_directory_exists(repository_dir)
+
+        # Mirrors hold full histories, which shallow and partial clones are
+        # meant to avoid.
+        if (self.get_is_shallow_or_partial()):
+            result = run_network_command(
+                ['git', 'clone']
+                + self.get_shallow_or_partial_clone_options()
+                + [source, self.get_path()],
+                root_dir,
+                prepare_retry,
+                attempt_durations
+            )
+
+            if (
+                (result == 0)
+                and (self.get_depth() is not None)
+                and not git_has_commit(
+                    repository_dir,
+                    self.get_target_reference(target)[0]
+                )
+            ):
+                self.fetch_target(repository_dir, target, ['origin'])
+
+            return result
+
+        staging_mirror_path = get_cache_mirror(
+            clone_options.get_staging_directory(),
+            source
+        )
+
+        if (staging_mirror_path is not None):
+            result = run_command(
+                ['git', 'clone', staging_mirror_path, self.get_path()],
+                root_dir
+            )
+
+            if (result == 0):
+                run_command(
+                    ['git', 'remote', 'set-url', 'origin', source],
+                    repository_dir
+                )
+
+            return result
+
+        clone_command = ['git', 'clone']
+        mirror_path = get_cache_mirror(
+            clone_options.get_cache_directory(),
+            source
+        )
+
+        if (mirror_path is not None):
+            clone_command.extend(['--reference', mirror_path])
+            # Most of the objects then come from the mirror.
+            attempt_durations = None
+
+        clone_command.extend([source, self.get_path()])
+
+        return run_network_command(
+            clone_command,
+            root_dir,
+            prepare_retry,
+            attempt_durations
+        )
+
+    def get_is_shallow_or_partial (self):
+        return (
+            (self.get_depth() is not None)
+            or (self.get_filter() is not None)
+        )
+
+    def get_shallow_or_partial_clone_options (self):
+        result = []
+
+        if (self.get_depth() is not None):
+            # Otherwise, only the default branch would be fetched.
+            result.extend(
+                ['--depth', str(self.get_depth()), '--no-single-branch']
+            )
+
+        if (self.get_filter() is not None):
+            result.append('--filter=' + self.get_filter())
+
+        return result
+
+    # Shallow clones do not necessarily contain the commit (or branch, or tag)
+    # to check out, in which case it is fetched from 'origin' specifically.
+    # Returns the local reference under which the commit, branch, or tag to
+    # check out can be found, and the refspec fetching it there (i.e. where
+    # 'git checkout' expects it).
+    def get_target_reference (self, target):
+        if (
+            (target == self.get_commit())
+            or (git_object_hash_regex.match(target) is not None)
+        ):
+            return (target, target)
+
+        if (self.get_target_type() == "tag"):
+            return (
+                "refs/tags/" + target,
+                "+refs/tags/" + target + ":refs/tags/" + target
+            )
+
+        return (
+            "refs/remotes/origin/" + target,
+            "+refs/heads/" + target + ":refs/remotes/origin/" + target
+        )
+
+    # Branches are never considered available, as they may have moved since.
+    def get_has_target_locally (self, repository_dir, target):
+        (reference, refspec) = self.get_target_reference(target)
+
+        return (
+            (not reference.startswith("refs/remotes/"))
+            and git_has_commit(repository_dir, reference)
+        )
+
+    # Namespace of the references under which everything a source provides is
+    # fetched when it does not send a commit by itself. Local copies may share
+    # their references (see 'get_bundle_reference').
+    def get_fetched_references (self):
+        return (
+            "refs/git-submodules/fetch/"
+            + hashlib.sha1(self.get_path().encode('utf-8')).hexdigest()
+            + "/"
+        )
+
+    # Fetches only the commit, branch, or tag to check out, from the first of
+    # 'sources' providing it. Returns False if none did.
+    def fetch_target (self, repository_dir, target, sources):
+        (reference, refspec) = self.get_target_reference(target)
+        fetch_command = ['git', 'fetch']
+
+        # Shallow repositories are kept so, but others are not made shallow.
+        if (
+            (self.get_depth() is not None)
+            and os.path.exists(
+                get_repo_snapshot(repository_dir).get_git_directory()
+                + os.sep
+                + "shallow"
+            )
+        ):
+            fetch_command.extend(['--depth', str(self.get_depth())])
+
+        for source in sources:
+            print(
+                "Fetching \""
+                + target
+                + "\" for submodule \""
+                + self.get_path()
+                + "\" from \""
+                + source
+                + "\"..."
+            )
+
+            attempt_durations = []
+            fetch_result = run_network_command(
+                fetch_command + [source, refspec],
+                repository_dir,
+                attempt_durations = attempt_durations
+            )
+
+            # Sources may refuse to send a commit they do not advertise, which
+            # may then still come along with their branches and tags. Without
+            # refspecs, only HEAD would be fetched from a URL. These are
+            # fetched under temporary references, which are removed once the
+            # commit is found (or not).
+            if (
+                (fetch_result not in [0, command_timeout_exit_code])
+                and (reference == refspec)
+            ):
+                print(
+                    "Fetching all branches and tags from \""
+                    + source
+                    + "\" instead..."
+                )
+
+                fetched_references = self.get_fetched_references()
+
+                try:
+                    fetch_result = run_network_command(
+                        fetch_command
+                        + [
+                            source,
+                            "+refs/heads/*:" + fetched_references + "heads/*",
+                            "+refs/tags/*:" + fetched_references + "tags/*"
+                        ],
+                        repository_dir,
+                        attempt_durations = attempt_durations
+                    )
+                finally:
+                    git_delete_references(repository_dir, fetched_references)
+
+                if (
+                    (fetch_result == 0)
+                    and not git_has_commit(repository_dir, reference)
+                ):
+                    print(
+                        "[W] \""
+                        + source
+                        + "\" does not provide \""
+                        + target
+                        + "\".",
+                        file = sys.stderr
+                    )
+
+                    fetch_result = -1
+
+            record_source_attempt(
+                source,
+                "fetch",
+                (fetch_result == 0),
+                attempt_durations
+            )
+
+            if (fetch_result == 0):
+                return True
+
+        return False
+
+    def clear_repository (self, root_dir):
+        print("Clearing submodule \"" + self.get_path() + "\"...")
+
+        subprocess.Popen(['rm', '-rf', self.get_path()], cwd = root_dir).wait()
+        invalidate_repo_snapshot(root_dir + os.sep + self.get_path())
+
+        print("Done.")
+
+    def update_description (self, root_dir):
+        repository_dir = root_dir + os.sep + self.get_path()
+
+        if (not os.path.exists(repository_dir)):
+            print(
+                "[E] Submodule \""
+                + self.get_path()
+                + "\" has no directory to update its description from. Skipped."
+            )
+
+            return
+
+        repo_snapshot = get_repo_snapshot(repository_dir)
+
+        if (not repo_snapshot.get_is_repository_root()):
+            print(
+                "[E] The directory for submodule \""
+                + self.get_path()
+                + "\" is not a Git repository and thus cannot be used to update"
+                + " its description. Skipped.",
+                file = sys.stderr
+            )
+
+            return
+
+
+        self.set_commit(repo_snapshot.get_current_commit_hash())
+
+        remotes = repo_snapshot.get_remotes()
+        default_remote = repo_snapshot.get_default_remote()
+        for source_name in remotes:
+            if (source_name == default_remote):
+                self.add_source(remotes[source_name])
+            else:
+                self.add_named_source(source_name, remotes[source_name])
+
+    def check_description (self, root_dir):
+        repository_dir = root_dir + os.sep + self.get_path()
+        is_the_same = True
+
+        if (not os.path.exists(repository_dir)):
+            print(
+                "Submodule \""
+                + self.get_path()
+                + "\" has no directory to compare to."
+            )
+
+            return
+
+        repo_snapshot = get_repo_snapshot(repository_dir)
+
+        if (not repo_snapshot.get_is_repository_root()):
+            print(
+                "The directory for submodule \""
+                + self.get_path()
+                + "\" is not a Git repository."
+            )
+
+            return
+
+        currently_used_hash = repo_snapshot.get_current_commit_hash()
+
+        if (currently_used_hash != self.get_commit()):
+            is_the_same = False
+
+            print(
+                "Submodule \""
+                + self.get_path()
+                + "\" is configured to use commit \""
+                + self.get_commit()
+                + "\" but its local clone is on commit \""
+                + currently_used_hash
+                + "\"."
+            )
+
+        locked_commit = get_locked_commit(repository_dir, self)
+
+        if (locked_commit is not None):
+            if (locked_commit != currently_used_hash):
+                print(
+                    "In submodule \""
+                    + self.get_path()
+                    + "\", the \""
+                    + self.get_target()
+                    + "\" "
+                    + self.get_target_type()
+                    + " is locked on commit \""
+                    + locked_commit
+                    + "\", which is not the one the local clone is on."
+                )
+        elif (self.get_target_type() != "commit"):
+            for source in self.get_sources():
+                remote_hash = git_get_remote_commit_hash_for(
+                    repository_dir,
+                    source,
+                    self.get_target()
+                )
+
+                if (remote_hash != currently_used_hash):
+                    print(
+                        "In submodule \""
+                        + self.get_path()
+                        + "\", the local \""
+                        + self.get_target()
+                        + "\" "
+                        + self.get_target_type()
+                        + " does not point to the same commit as on source \""
+                        + source
+                        + "\""
+                    )
+
+        remotes = repo_snapshot.get_remotes()
+        named_sources = self.get_named_sources()
+        default_remote = repo_snapshot.get_default_remote()
+
+        for remote_name in remotes:
+            if (remote_name == default_remote):
+                if (remotes[remote_name] not in self.get_sources()):
+                    is_the_same = False
+
+                    print(
+                        "The local clone of the submodule \""
+                        + self.get_path()
+                        + "\" uses a default source not listed as an anonymous"
+                        + " one in .gitsubmodules: \""
+                        + remotes[remote_name]
+                        + "\"."
+                    )
+            elif (remote_name not in named_sources):
+                is_the_same = False
+
+                print(
+                    "The local clone of the submodule \""
+                    + self.get_path()
+                    + "\" has a source not registered in .gitsubmodules: \""
+                    + remotes[remote_name]
+                    + "\" (\""
+                    + remote_name
+                    + "\")."
+                )
+        for source_name in named_sources:
+            if (source_name not in remotes):
+                is_the_same = False
+
+                print(
+                    "The local clone of the submodule \""
+                    + self.get_path()
+                    + "\" is missing source \""
+                    + source_name
+                    + "\"."
+                )
+            elif (named_sources[source_name] != remotes[source_name]):
+                is_the_same = False
 
-    def disable (self):
-        self.enabled = False
+                print(
+                    "The local clone of the submodule \""
+                    + self.get_path()
+                    + "\" considers source \""
+                    + source_name
+                    + "\" to be \""
+                    + remotes[source_name]
+                    + "\" instead of \""
+                    + named_sources[source_name]
+                    + "\""
+                )
 
-    def add_source (self, source):
-        if (not (source in self.get_sources())):
-            self.sources.append(source)
+        if (is_the_same):
+            if (repo_snapshot.get_has_uncommitted_changes()):
+                print(
+                    "The configuration for the \""
+                    + self.get_path()
+                    + "\" submodule is up-to-date, but there are uncommitted"
+                    + " changes in its repository."
+                )
+            else:
+                print(
+                    "The configuration for the \""
+                    + self.get_path()
+                    + "\" submodule is up-to-date."
+                )
 
-    def add_named_source (self, name, source):
-        self.named_sources[name] = source
+    def parse_all (file_stream):
+        result_as_list = list()
+        result_as_dict = dict()
 
-    def set_commit (self, commit):
-        self.commit = commit
+        submodule = None
 
-    def set_target_type (self, target_type):
-        self.target_type = target_type
+        for line in file_stream:
+            token = description_line_regex.match(line)
 
-    def set_target (self, target):
-        self.target = target
+            if (token is None):
+                continue
 
-    def set_target_overrides_commit (self, target_overrides_commit):
-        self.target_overrides_commit = target_overrides_commit
+            kind = token.lastgroup
 
-    def print_to (self, file_stream):
-        print('[submodule "' + self.get_path() + '"]', file = file_stream)
+            if (kind == "submodule"):
+                path = token.group('submodule_path').strip(os.sep)
 
-        for source in self.get_sources():
-            print('   source = ' + source, file = file_stream)
+                if (path in result_as_dict):
+                   submodule = result_as_dict[path]
+                else:
+                   submodule = GitSubmodule(path)
+                   result_as_dict[path] = submodule
+                   result_as_list.append(submodule)
 
-        named_sources = self.get_named_sources()
+                continue
 
-        for name in named_sources:
-            print(
-                '   source.' + name + ' = ' + named_sources[name],
-                file = file_stream
-            )
+            if (not submodule):
+                continue
 
-        print('   commit = ' + str(self.get_commit()), file = file_stream)
-        print('   enable = ' + str(self.get_is_enabled()), file = file_stream)
+            if (kind == "source"):
+                submodule.add_source(token.group('source_url'))
+            elif (kind == "named_source"):
+                submodule.add_named_source(
+                    token.group('named_source_name'),
+                    token.group('named_source_url')
+                )
+            elif (kind == "commit"):
+                submodule.set_commit(token.group('commit_value'))
+            elif (kind == "target"):
+                target = token.group('target_value').split()
 
-        if (target_type == "commit"):
-            print( '   target = commit', file = file_stream)
-        else:
-            print(
-                '   target = '
-                + self.get_target_type()
-                + ' '
-                + str(self.get_target()),
-                file = file_stream
-            )
+                submodule.set_target_type(target[0])
 
-        print(
-            '   target_overrides_commit = '
-            + str(self.get_target_overrides_commit()),
-            file = file_stream
-        )
+                if (target[0] != "commit"):
+                    submodule.set_target(target[1])
+            elif (kind == "enable"):
+                if (not is_true_value(token.group('enable_value'))):
+                    submodule.disable()
+            elif (kind == "target_overrides_commit"):
+                if (
+                    is_true_value(token.group('target_overrides_commit_value'))
+                ):
+                    submodule.set_target_overrides_commit(True)
+            elif (kind == "depth"):
+                submodule.set_depth(int(token.group('depth_value')))
+            elif (kind == "filter"):
+                submodule.set_filter(token.group('filter_value'))
 
+        return (result_as_list, result_as_dict)
 
-    def add_environment_variables (self, env_vars):
-        env_vars['SNSM_COMMIT'] = self.get_commit()
-        env_vars['SNSM_ENABLED'] = "1" if self.get_is_enabled() else "0"
-        env_vars['SNSM_SOURCES'] = "\n".join(self.get_sources())
-        env_vars['SNSM_NAMED_SOURCES'] = (
-            "\n".join(
-                [
-                    name + " " + source
-                    for (name, source) in self.get_named_sources().items()
-                ]
+################################################################################
+##### DESCRIPTION INDEX ########################################################
+################################################################################
+# The parsed description file of a repository is kept in its Git directory, so
+# that it does not need to be parsed again until it changes. The index is
+# (version, size, modification time, SHA-1, time of writing, records), records
+# being the result of GitSubmodule.to_record for each submodule. Should the
+# file's size or modification time differ, or the file have been modified too
+# close to the writing of the index to be sure it hasn't changed since, its
+# content is hashed to check whether the index can still be used.
+description_index_version = 2
+
+# Returns None if the repository's Git directory can't be found without Git.
+def get_description_index_file (repository_path):
+    directories = read_git_directories(repository_path)
+
+    if (not directories):
+        return None
+
+    return (
+        directories[0]
+        + os.sep
+        + "git-submodules"
+        + os.sep
+        + "description.index"
+    )
+
+def read_description_index (index_file):
+    if (index_file is None):
+        return None
+
+    try:
+        with open(index_file, 'rb') as file_stream:
+            index = marshal.loads(file_stream.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if (
+        (not isinstance(index, tuple))
+        or (len(index) != 6)
+        or (index[0] != description_index_version)
+    ):
+        return None
+
+    return index
+
+def is_description_index_up_to_date (index, file_status):
+    return (
+        (index is not None)
+        and (index[1] == file_status.st_size)
+        and (index[2] == file_status.st_mtime_ns)
+        and ((index[4] - file_status.st_mtime_ns) > 2000000000)
+    )
+
+def write_description_index (index_file, file_status, content_hash, records):
+    if (index_file is None):
+        return
+
+    try:
+        ensure_directory_exists(os.path.dirname(index_file))
+        replace_file_content(
+            index_file,
+            marshal.dumps(
+                (
+                    description_index_version,
+                    file_status.st_size,
+                    file_status.st_mtime_ns,
+                    content_hash,
+                    time.time_ns(),
+                    records
+                )
             )
         )
-        env_vars['SNSM_TARGET_TYPE'] = self.get_target_type()
-        env_vars['SNSM_TARGET'] = self.get_target()
-        env_vars['SNSM_TARGET_OVERRIDES_COMMIT'] = (
-            "1" if self.get_target_overrides_commit() else "0"
-        )
+    except OSError:
+        pass
 
-        if (env_vars['SNSM_COMMIT'] is None):
-            env_vars['SNSM_COMMIT'] = ''
+################################################################################
+##### DESCRIPTION DOCUMENT #####################################################
+################################################################################
+# Lossless model of a description file, used to update it: the lines before the
+# first section, then the sections (a "[submodule ...]" line and all the lines
+# up to the next one). Lines are kept as they are unless they get replaced, so
+# comments, unknown parameters and ordering are all preserved.
+class DescriptionSection:
+    def __init__ (self, path, header_line):
+        self.path = path
+        self.lines = []
+        self.last_line_of = dict()
+        self.sources = set()
 
-        if (self.get_target() is None):
-            env_vars['SNSM_TARGET'] = env_vars['SNSM_COMMIT']
+        self.add_line(header_line, None)
 
-    def clone_repository (self, root_dir, force_target):
-        repository_dir = root_dir + os.sep + self.get_path()
-        ensure_directory_exists(repository_dir)
+    def get_path (self):
+        return self.path
 
-        should_merge = True
+    def get_lines (self):
+        return self.lines
 
-        if (self.get_target_overrides_commit() or force_target):
-            target = self.get_target()
-        else:
-            target = self.get_commit()
-            should_merge = False
+    # Index of the last line setting a given parameter, named sources being
+    # identified as ('source', NAME).
+    def get_last_line_of (self, parameter):
+        return self.last_line_of.get(parameter, -1)
 
-        if (self.get_target_type() != "branch"):
-            should_merge = False
+    def has_source (self, source):
+        return (source in self.sources)
 
-        if (git_is_repository_root(repository_dir)):
-            git_process = subprocess.Popen(
-                ['git', 'fetch', '--all'],
-                cwd = repository_dir
-            )
+    def add_line (self, line, token):
+        self.lines.append(line)
 
-            git_process = subprocess.Popen(
-                ['git', 'checkout', target],
-                cwd = repository_dir
+        if (token is None):
+            return
+
+        kind = token.lastgroup
+
+        if (kind == "source"):
+            self.sources.add(token.group('source_url'))
+        elif (kind == "named_source"):
+            self.last_line_of[('source', token.group('named_source_name'))] = (
+                len(self.lines) - 1
             )
+        elif (kind != "submodule"):
+            self.last_line_of[kind] = len(self.lines) - 1
 
-            git_process.wait()
+    def set_line (self, index, line):
+        self.lines[index] = line
 
-            if (git_process.returncode == 0):
-                print("Submodule \"" + self.get_path() + "\" checked out.")
-                if (should_merge):
-                    print("Merging any new commits into the local branch...")
-                    subprocess.Popen(
-                        ['git', 'merge'],
-                        cwd = repository_dir
-                    )
+    # Added lines are placed right after the section's header, the first line
+    # of 'lines' coming first.
+    def insert_lines (self, lines):
+        self.lines[1:1] = lines
 
-                named_sources = self.get_named_sources()
+        for parameter in self.last_line_of:
+            self.last_line_of[parameter] = (
+                self.last_line_of[parameter] + len(lines)
+            )
 
-                for name in named_sources:
-                    git_add_remote(repository_dir, name, named_sources[name])
+class DescriptionDocument:
+    def __init__ (self):
+        self.preamble = []
+        self.sections = []
+        self.sections_of_path = dict()
 
-                return
-            else:
-                print(
-                    "Target commit not available with current source for"
-                    + " submodule \""
-                    + self.get_path()
-                    + "\". Resetting local copy."
+    def parse (file_stream):
+        result = DescriptionDocument()
+        section = None
+
+        for line in file_stream:
+            line = line.rstrip("\n")
+            token = description_line_regex.match(line)
+
+            if ((token is not None) and (token.lastgroup == "submodule")):
+                section = DescriptionSection(
+                    token.group('submodule_path').strip(os.sep),
+                    line
                 )
+                result.add_section(section)
+            elif (section is None):
+                result.preamble.append(line)
+            else:
+                section.add_line(line, token)
 
-                subprocess.Popen(
-                    ['rm', '-rf', self.get_path()],
-                    cwd = root_dir
-                ).wait()
-                ensure_directory_exists(repository_dir)
+        return result
 
-        for source in self.get_sources():
-            print(
-                "Cloning submodule \""
-                + self.get_path()
-                + "\" from \""
-                + source
-                + "\"..."
-            )
+    def add_section (self, section):
+        self.sections.append(section)
 
-            git_process = subprocess.Popen(
-                ['git', 'clone', source, self.get_path()],
-                cwd = root_dir
+        if (section.get_path() not in self.sections_of_path):
+            self.sections_of_path[section.get_path()] = []
+
+        self.sections_of_path[section.get_path()].append(section)
+
+    def remove_sections_of (self, paths):
+        paths = set(paths)
+
+        self.sections = [
+            section
+            for section in self.sections
+            if (section.get_path() not in paths)
+        ]
+
+        for path in paths:
+            self.sections_of_path.pop(path, None)
+
+    # When a submodule is described by multiple sections, the last line setting
+    # a parameter is the one replaced, and missing parameters are added to the
+    # last section.
+    def update_sections_of (self, path, submodule):
+        if (path not in self.sections_of_path):
+            self.add_section(
+                DescriptionSection(path, "[submodule \"" + path + "\"]")
             )
 
-            git_process.wait()
+        sections = self.sections_of_path[path]
+        named_sources = submodule.get_named_sources()
 
-            if (git_process.returncode != 0):
+        if (submodule.get_target_type() == "commit"):
+            target_line = "   target = commit"
+        else:
+            target_line = (
+                "   target = "
+                + submodule.get_target_type()
+                + " "
+                + submodule.get_target()
+            )
 
-                print("Failed at Git clone.")
+        # (parameter, line) pairs, in the order in which missing ones are added.
+        # Anonymous sources have no parameter as they are never replaced.
+        parameter_lines = [
+            (
+                ('source', name),
+                "   source." + name + " = " + named_sources[name]
+            )
+            for name in named_sources
+        ]
+        parameter_lines.extend(
+            [
+                (None, "   source = " + source)
+                for source in submodule.get_sources()
+                if not any([section.has_source(source) for section in sections])
+            ]
+        )
+        parameter_lines.append(('target', target_line))
+        parameter_lines.append(
+            (
+                'target_overrides_commit',
+                "   target_overrides_commit = "
+                + str(submodule.get_target_overrides_commit())
+            )
+        )
+        parameter_lines.append(
+            ('enable', "   enable = " + str(submodule.get_is_enabled()))
+        )
 
-                continue
+        if (submodule.get_depth() is not None):
+            parameter_lines.append(
+                ('depth', "   depth = " + str(submodule.get_depth()))
+            )
 
-            git_process = subprocess.Popen(
-                ['git', 'checkout', target],
-                cwd = repository_dir
+        if (submodule.get_filter() is not None):
+            parameter_lines.append(
+                ('filter', "   filter = " + submodule.get_filter())
             )
+        parameter_lines.append(
+            ('commit', "   commit = " + submodule.get_commit())
+        )
 
-            git_process.wait()
+        new_lines = []
 
-            if (git_process.returncode == 0):
-                if (should_merge):
-                    print("Merging any new commits into the local branch...")
-                    subprocess.Popen(
-                        ['git', 'merge'],
-                        cwd = repository_dir
-                    )
-                print("Done.")
+        for (parameter, line) in parameter_lines:
+            if (
+                (parameter is None)
+                or not self.replace_last_line_of(sections, parameter, line)
+            ):
+                new_lines.append(line)
 
-                named_sources = self.get_named_sources()
+        sections[-1].insert_lines(new_lines)
 
-                for name in named_sources:
-                    git_add_remote(repository_dir, name, named_sources[name])
+    def replace_last_line_of (self, sections, parameter, line):
+        for section in reversed(sections):
+            index = section.get_last_line_of(parameter)
 
-                return
-            else:
-                print(
-                    "Failed at Git checkout \""
-                    + target
-                    + "\" from source \""
-                    + source
-                    + "\"."
+            if (index != -1):
+                section.set_line(index, line)
+
+                return True
+
+        return False
+
+    def to_text (self):
+        lines = list(self.preamble)
+
+        for section in self.sections:
+            lines.extend(section.get_lines())
+
+        return "".join([line + "\n" for line in lines])
+
+################################################################################
+##### SUBMODULE TREE ###########################################################
+################################################################################
+# The whole tree of submodules (each submodule's own description file being
+# read from its local clone) can be gathered in one go before traversing it.
+# Entries are listed parents first, in the order of the description files.
+class SubmoduleTreeEntry:
+    def __init__ (self, submodule, parents, name, position):
+        self.submodule = submodule
+        self.parents = parents
+        self.name = name
+        self.position = position
+        self.children = []
+
+    def get_submodule (self):
+        return self.submodule
+
+    # Absolute paths of the repositories containing this submodule, starting
+    # with the root repository.
+    def get_parents (self):
+        return self.parents
+
+    def get_parent (self):
+        return self.parents[-1]
+
+    def get_absolute_path (self):
+        return self.parents[-1] + os.sep + self.submodule.get_path()
+
+    # Path relative to the root repository.
+    def get_name (self):
+        return self.name
+
+    # Indices leading to this submodule in each description file.
+    def get_position (self):
+        return self.position
+
+    def get_children (self):
+        return self.children
+
+    def add_child (self, entry):
+        self.children.append(entry)
+
+# Returns the list of all entries, followed by the list of entries at the top
+# of the tree (those of 'submodule_dictionary'). Unless 'is_recursive' is set,
+# no other description file is read.
+def get_submodule_tree (submodule_dictionary, root_directory, is_recursive):
+    result = []
+    top_entries = []
+
+    for (index, submodule_path) in enumerate(submodule_dictionary):
+        entry = SubmoduleTreeEntry(
+            submodule_dictionary[submodule_path],
+            [root_directory],
+            submodule_path,
+            (index,)
+        )
+
+        top_entries.append(entry)
+
+    pending_entries = list(reversed(top_entries))
+
+    while (len(pending_entries) > 0):
+        entry = pending_entries.pop()
+
+        result.append(entry)
+
+        if (not is_recursive):
+            continue
+
+        (ignored_list, own_submodules) = get_submodules_of(
+            entry.get_absolute_path()
+        )
+        parents = entry.get_parents() + [entry.get_absolute_path()]
+
+        for (index, submodule_path) in enumerate(own_submodules):
+            entry.add_child(
+                SubmoduleTreeEntry(
+                    own_submodules[submodule_path],
+                    parents,
+                    entry.get_name() + os.sep + submodule_path,
+                    entry.get_position() + (index,)
                 )
+            )
 
-                subprocess.Popen(
-                    ['rm', '-rf', self.get_path()],
-                    cwd = root_dir
-                ).wait()
-                ensure_directory_exists(repository_dir)
+        pending_entries.extend(reversed(entry.get_children()))
 
-                print("Removed cloned repository.")
+    return (result, top_entries)
 
-                continue
+# Returns the entries of the tree below 'top_entries' in the same order as
+# 'get_submodule_tree', leaving out disabled submodules along with their own.
+def get_enabled_entries (top_entries):
+    result = []
+    pending_entries = list(reversed(top_entries))
+
+    while (len(pending_entries) > 0):
+        entry = pending_entries.pop()
+
+        if (not entry.get_submodule().get_is_enabled()):
+            continue
+
+        result.append(entry)
+        pending_entries.extend(reversed(entry.get_children()))
+
+    return result
+
+################################################################################
+##### LOCK FILE ################################################################
+################################################################################
+# The commit each branch or tag target of the whole tree of submodules resolved
+# to can be recorded in a ".gitsubmodules.lock" file, next to the root
+# repository's description file, so that these commits are checked out (or
+# checked against) later on without asking any source about the target again.
+# Each line holds the commit, the target's type, the target, and the path of
+# the submodule relative to the root repository. Commit targets need no
+# resolving, but are listed too, so that the file describes the whole tree.
+lock_file_header = (
+    "# Generated by the \"lock\" command. Each line is: commit, target type,"
+    + " target, path.\n"
+)
+
+# Indexed by the absolute path of the submodules, as (target type, target,
+# commit). None unless a lock file was loaded.
+locked_commit_of_path = None
+unlocked_paths = set()
+unlocked_paths_lock = threading.Lock()
+
+def get_lock_file (root_path):
+    return root_path + os.sep + ".gitsubmodules.lock"
+
+def load_lock_file (root_path):
+    global locked_commit_of_path
+
+    lock_file = get_lock_file(root_path)
 
+    try:
+        with open(lock_file, 'r') as file_stream:
+            lines = file_stream.read().splitlines()
+    except FileNotFoundError:
         print(
-            "[F] Could not clone submodule \""
-            + self.get_path()
-            + "\" into \""
-            + repository_dir
-            +"\".",
+            "[F] No \""
+            + lock_file
+            + "\" file found. Use the \"lock\" command to create it.",
             file = sys.stderr
         )
         sys.exit(-1)
 
-    def clear_repository (self, root_dir):
-        print("Clearing submodule \"" + self.get_path() + "\"...")
-
-        subprocess.Popen(['rm', '-rf', self.get_path()], cwd = root_dir).wait()
+    locked_commit_of_path = dict()
 
-        print("Done.")
+    for line in lines:
+        if ((len(line.strip()) == 0) or line.startswith("#")):
+            continue
 
-    def update_description (self, root_dir):
-        repository_dir = root_dir + os.sep + self.get_path()
+        fields = line.split(" ", 3)
 
-        if (not os.path.exists(repository_dir)):
+        if (
+            (len(fields) < 4)
+            or (git_object_hash_regex.match(fields[0]) is None)
+        ):
             print(
-                "[E] Submodule \""
-                + self.get_path()
-                + "\" has no directory to update its description from. Skipped."
+                "[F] Invalid line in \"" + lock_file + "\": \"" + line + "\".",
+                file = sys.stderr
             )
+            sys.exit(-1)
 
-            return
+        (commit, target_type, target, path) = fields
 
-        if (not git_is_repository_root(repository_dir)):
-            print(
-                "[E] The directory for submodule \""
-                + self.get_path()
-                + "\" is not a Git repository and thus cannot be used to update"
-                + " its description. Skipped.",
-                file = sys.stderr
-            )
+        locked_commit_of_path[os.path.normpath(root_path + os.sep + path)] = (
+            target_type,
+            target,
+            commit
+        )
 
-            return
+# 'entries' is a list of (submodule tree entry, commit) pairs.
+def write_lock_file (root_path, entries):
+    lines = [lock_file_header]
+
+    for (entry, commit) in entries:
+        submodule = entry.get_submodule()
+
+        lines.append(
+            commit
+            + " "
+            + submodule.get_target_type()
+            + " "
+            + submodule.get_target()
+            + " "
+            + entry.get_name()
+            + "\n"
+        )
 
+    replace_file_content(get_lock_file(root_path), "".join(lines))
 
-        self.set_commit(git_get_current_commit_hash(repository_dir))
+# Returns None if no lock file was loaded, if 'submodule' follows a commit, or
+# if the lock file does not (or no longer) resolve its target, the latter being
+# reported once.
+def get_locked_commit (repository_dir, submodule):
+    if (
+        (locked_commit_of_path is None)
+        or (submodule.get_target_type() == "commit")
+    ):
+        return None
 
-        remotes = git_get_all_remotes(repository_dir)
-        default_remote = git_get_default_remote(repository_dir)
-        for source_name in remotes:
-            if (source_name == default_remote):
-                self.add_source(remotes[source_name])
-            else:
-                self.add_named_source(source_name, remotes[source_name])
+    path = os.path.normpath(repository_dir)
+    locked_commit = locked_commit_of_path.get(path)
 
-    def check_description (self, root_dir):
-        repository_dir = root_dir + os.sep + self.get_path()
-        is_the_same = True
+    if (
+        (locked_commit is not None)
+        and (locked_commit[0] == submodule.get_target_type())
+        and (locked_commit[1] == submodule.get_target())
+    ):
+        return locked_commit[2]
 
-        if (not os.path.exists(repository_dir)):
-            print(
-                "Submodule \""
-                + self.get_path()
-                + "\" has no directory to compare to."
-            )
+    with unlocked_paths_lock:
+        if (path in unlocked_paths):
+            return None
 
-            return
+        unlocked_paths.add(path)
 
-        if (not git_is_repository_root(repository_dir)):
-            print(
-                "The directory for submodule \""
-                + self.get_path()
-                + "\" is not a Git repository."
-            )
+    print(
+        "[W] The lock file does not resolve the \""
+        + submodule.get_target()
+        + "\" "
+        + submodule.get_target_type()
+        + " of submodule \""
+        + submodule.get_path()
+        + "\". Its sources will be asked instead. Use the \"lock\" command to"
+        + " refresh the lock file.",
+        file = sys.stderr
+    )
 
-            return
+    return None
 
-        currently_used_hash = git_get_current_commit_hash(repository_dir)
+# Returns None if none of the sources advertise the target. Annotated tags are
+# resolved to the commit they point to.
+def resolve_target_commit (submodule, local_repo_path):
+    if (submodule.get_target_type() == "commit"):
+        return submodule.get_commit()
 
-        if (currently_used_hash != self.get_commit()):
-            is_the_same = False
+    if (submodule.get_target_type() == "tag"):
+        reference_names = [
+            "refs/tags/" + submodule.get_target() + "^{}",
+            "refs/tags/" + submodule.get_target()
+        ]
+    else:
+        reference_names = ["refs/heads/" + submodule.get_target()]
 
-            print(
-                "Submodule \""
-                + self.get_path()
-                + "\" is configured to use commit \""
-                + self.get_commit()
-                + "\" but its local clone is on commit \""
-                + currently_used_hash
-                + "\"."
-            )
+    for source in submodule.get_sources():
+        references = query_remote_references(local_repo_path, source)
 
-        if (self.get_target_type() != "commit"):
-            for source in self.get_sources():
-                remote_hash = git_get_remote_commit_hash_for(
-                    repository_dir,
-                    source,
-                    self.get_target()
-                )
+        if (references is None):
+            continue
 
-                if (remote_hash != currently_used_hash):
-                    print(
-                        "In submodule \""
-                        + self.get_path()
-                        + "\", the local \""
-                        + self.get_target()
-                        + "\" "
-                        + self.get_target_type()
-                        + " does not point to the same commit as on source \""
-                        + source
-                        + "\""
-                    )
+        commit_of_reference = dict(
+            [(reference, commit) for (commit, reference) in references]
+        )
 
-        remotes = git_get_all_remotes(repository_dir)
-        named_sources = self.get_named_sources()
-        default_remote = git_get_default_remote(repository_dir)
+        for reference in reference_names:
+            if (reference in commit_of_reference):
+                return commit_of_reference[reference]
 
-        for remote_name in remotes:
-            if (remote_name == default_remote):
-                if (remotes[remote_name] not in self.get_sources()):
-                    is_the_same = False
+    return None
 
-                    print(
-                        "The local clone of the submodule \""
-                        + self.get_path()
-                        + "\" uses a default source not listed as an anonymous"
-                        + " one in .gitsubmodules: \""
-                        + remotes[remote_name]
-                        + "\"."
-                    )
-            elif (remote_name not in named_sources):
-                is_the_same = False
+def lock_submodule (entry, resolved_commits):
+    submodule = entry.get_submodule()
 
-                print(
-                    "The local clone of the submodule \""
-                    + self.get_path()
-                    + "\" has a source not registered in .gitsubmodules: \""
-                    + remotes[remote_name]
-                    + "\" (\""
-                    + remote_name
-                    + "\")."
-                )
-        for source_name in named_sources:
-            if (source_name not in remotes):
-                is_the_same = False
+    if (
+        (submodule.get_target_type() == "commit")
+        and not submodule.get_commit()
+    ):
+        print(
+            "[E] Submodule \""
+            + entry.get_name()
+            + "\" follows a commit, but its description does not give any.",
+            file = sys.stderr
+        )
+        sys.exit(-1)
 
-                print(
-                    "The local clone of the submodule \""
-                    + self.get_path()
-                    + "\" is missing source \""
-                    + source_name
-                    + "\"."
-                )
-            elif (named_sources[source_name] != remotes[source_name]):
-                is_the_same = False
+    commit = resolve_target_commit(submodule, entry.get_parent())
 
-                print(
-                    "The local clone of the submodule \""
-                    + self.get_path()
-                    + "\" considers source \""
-                    + source_name
-                    + "\" to be \""
-                    + remotes[source_name]
-                    + "\" instead of \""
-                    + named_sources[source_name]
-                    + "\""
-                )
+    if (commit is None):
+        print(
+            "[E] None of the sources of submodule \""
+            + entry.get_name()
+            + "\" advertise its \""
+            + submodule.get_target()
+            + "\" "
+            + submodule.get_target_type()
+            + ".",
+            file = sys.stderr
+        )
+        sys.exit(-1)
 
-        if (is_the_same):
-            if (git_repository_has_uncommitted_changes(repository_dir)):
-                print(
-                    "The configuration for the \""
-                    + self.get_path()
-                    + "\" submodule is up-to-date, but there are uncommitted"
-                    + " changes in its repository."
-                )
-            else:
-                print(
-                    "The configuration for the \""
-                    + self.get_path()
-                    + "\" submodule is up-to-date."
-                )
+    resolved_commits[entry.get_name()] = commit
 
-    def parse_all (file_stream):
-        result_as_list = list()
-        result_as_dict = dict()
+    print(
+        "Submodule \""
+        + entry.get_name()
+        + "\" locked on commit \""
+        + commit
+        + "\"."
+    )
 
-        submodule = None
+# Returns the paths (relative to 'root_path') of the submodules whose target
+# could not be resolved, in which case the lock file is left as it was.
+# Disabled submodules, and those they contain, are not locked. Nested
+# description files are read from the local copies, which should thus be
+# up-to-date.
+def apply_lock_to (submodule_dictionary, root_path, jobs):
+    (all_entries, top_entries) = get_submodule_tree(
+        submodule_dictionary,
+        root_path,
+        True # = is_recursive
+    )
+    all_entries = get_enabled_entries(top_entries)
+    resolved_commits = dict()
+
+    failed_paths = run_tasks_in_parallel(
+        [
+            (
+                entry.get_name(),
+                functools.partial(lock_submodule, entry, resolved_commits)
+            )
+            for entry in all_entries
+        ],
+        jobs,
+        True # = is_ordered
+    )
 
-        for line in file_stream:
-            search = re.findall(r'^\s*\[submodule\s*"(.+)"\]', line)
+    if (len(failed_paths) == 0):
+        write_lock_file(
+            root_path,
+            [
+                (entry, resolved_commits[entry.get_name()])
+                for entry in all_entries
+            ]
+        )
 
-            if search:
-                path = search[0].strip(os.sep)
+    return failed_paths
 
-                if (path in result_as_dict):
-                   submodule = result_as_dict[path]
-                else:
-                   submodule = GitSubmodule(search[0].strip(os.sep))
-                   result_as_dict[path] = submodule
-                   result_as_list.append(submodule)
+################################################################################
+##### BUNDLES ##################################################################
+################################################################################
+# The described commit of each submodule of the whole tree can be exported as
+# a Git bundle, so that the tree can then be populated without any network
+# access (see the "--from-bundles" option of "update-directory"). The bundle
+# of a submodule is written at its path (relative to the root repository) in
+# the export directory, with a ".bundle" extension. The export directory's
+# "bundles.index" file lists, on each line, the bundled commit and the path of
+# the submodule. Bundles only hold one reference, pointing to that commit.
+bundle_index_header = (
+    "# Generated by the \"export-bundles\" command. Each line is: commit,"
+    + " path.\n"
+)
 
-                continue
+def get_bundle_file (directory, name):
+    return directory + os.sep + name + ".bundle"
 
-            if (not submodule):
-                continue
+def get_bundle_index_file (directory):
+    return directory + os.sep + "bundles.index"
 
-            search = re.findall(r'^\s*source\s*=\s*([^\s].*[^\s])\s*', line)
+# 'git bundle' only bundles references, so a temporary one is created in the
+# local copy. Worktrees sharing their references with other local copies may be
+# bundled at the same time, hence a reference specific to each submodule.
+def get_bundle_reference (name):
+    return (
+        "refs/git-submodules/bundle/"
+        + hashlib.sha1(name.encode('utf-8')).hexdigest()
+    )
 
-            if (search):
-                submodule.add_source(search[0])
+# Returns the (commit, bundle file, bundle reference) triples of the index,
+# indexed by the absolute path of the submodules once populated under
+# 'root_path'.
+def load_bundle_index (directory, root_path):
+    index_file = get_bundle_index_file(directory)
+    result = dict()
 
-                continue
+    try:
+        with open(index_file, 'r') as file_stream:
+            lines = file_stream.read().splitlines()
+    except FileNotFoundError:
+        print(
+            "[F] No \""
+            + index_file
+            + "\" file found. Use the \"export-bundles\" command to create it.",
+            file = sys.stderr
+        )
+        sys.exit(-1)
+
+    for line in lines:
+        if ((len(line.strip()) == 0) or line.startswith("#")):
+            continue
 
-            search = re.findall(
-                r'^\s*source\.([^\s]+)\s*=\s*([^\s].*[^\s])\s*',
-                line
+        fields = line.split(" ", 1)
+
+        if (
+            (len(fields) < 2)
+            or (git_object_hash_regex.match(fields[0]) is None)
+        ):
+            print(
+                "[F] Invalid line in \"" + index_file + "\": \"" + line + "\".",
+                file = sys.stderr
             )
-            if search:
-                (name, url) = search[0]
-                submodule.add_named_source(name, url)
+            sys.exit(-1)
 
-                continue
+        (commit, name) = fields
 
-            search = re.findall(r'^\s*commit\s*=\s*([^\s].*[^\s])\s*', line)
+        result[os.path.normpath(root_path + os.sep + name)] = (
+            commit,
+            get_bundle_file(directory, name),
+            get_bundle_reference(name)
+        )
 
-            if search:
-                submodule.set_commit(search[0])
+    return result
 
-                continue
+def export_submodule_bundle (entry, directory, exported_commits):
+    submodule = entry.get_submodule()
+    repository_dir = entry.get_absolute_path()
+    commit = submodule.get_commit()
+    bundle_file = get_bundle_file(directory, entry.get_name())
+
+    if (
+        (commit is None)
+        or (not get_repo_snapshot(repository_dir).get_is_repository_root())
+        or (not git_has_commit(repository_dir, commit))
+    ):
+        print(
+            "[E] The local copy of submodule \""
+            + entry.get_name()
+            + "\" does not have its described commit. Use"
+            + " \"update-directory\" first.",
+            file = sys.stderr
+        )
+        sys.exit(-1)
 
-            search = re.findall(r'^\s*target\s*=\s*(commit|(?:branch\s+[^\s]+)|(?:tag\s+[^\s]+))\s*', line)
+    print(
+        "Bundling commit \""
+        + commit
+        + "\" of submodule \""
+        + entry.get_name()
+        + "\"..."
+    )
 
-            if search:
-                target = search[0].split()
+    ensure_directory_exists(os.path.dirname(bundle_file))
 
-                submodule.set_target_type(target[0])
+    bundle_reference = get_bundle_reference(entry.get_name())
 
-                if (target[0] != "commit"):
-                    submodule.set_target(target[1])
+    run_command(['git', 'update-ref', bundle_reference, commit], repository_dir)
 
-                continue
+    try:
+        result = run_command(
+            ['git', 'bundle', 'create', bundle_file, bundle_reference],
+            repository_dir
+        )
+    finally:
+        run_command(
+            ['git', 'update-ref', '-d', bundle_reference],
+            repository_dir
+        )
 
-            search = re.findall(r'^\s*enable\s*=\s*([^\s].*[^\s])\s*', line)
+    if (result != 0):
+        print(
+            "[E] Could not bundle submodule \"" + entry.get_name() + "\".",
+            file = sys.stderr
+        )
+        sys.exit(-1)
 
-            if search:
-                enable_param_val = search[0].lower()
-                if (
-                    not (
-                        (enable_param_val == "true")
-                        or (enable_param_val == "t")
-                        or (enable_param_val == "yes")
-                        or (enable_param_val == "y")
-                        or (enable_param_val == "1")
-                    )
-                ):
-                    submodule.disable()
+    exported_commits[entry.get_name()] = commit
 
-                continue
+    print("Written \"" + bundle_file + "\".")
 
-            search = re.findall(
-                r'^\s*target_overrides_commit\s*=\s*([^\s].*[^\s])\s*',
-                line
+# Returns the paths (relative to 'root_path') of the submodules that could not
+# be bundled. The index only lists those that were. Disabled submodules, and
+# those they contain, are not bundled.
+def apply_export_bundles_to (submodule_dictionary, root_path, directory, jobs):
+    (all_entries, top_entries) = get_submodule_tree(
+        submodule_dictionary,
+        root_path,
+        True # = is_recursive
+    )
+    all_entries = get_enabled_entries(top_entries)
+    exported_commits = dict()
+
+    ensure_directory_exists(directory)
+
+    failed_paths = run_tasks_in_parallel(
+        [
+            (
+                entry.get_name(),
+                functools.partial(
+                    export_submodule_bundle,
+                    entry,
+                    directory,
+                    exported_commits
+                )
             )
+            for entry in all_entries
+        ],
+        jobs,
+        True # = is_ordered
+    )
 
-            if search:
-                enable_param_val = search[0].lower()
+    lines = [bundle_index_header]
 
-                if (
-                    (enable_param_val == "true")
-                    or (enable_param_val == "t")
-                    or (enable_param_val == "yes")
-                    or (enable_param_val == "y")
-                    or (enable_param_val == "1")
-                ):
-                    submodule.set_target_overrides_commit(True)
+    for entry in all_entries:
+        if (entry.get_name() in exported_commits):
+            lines.append(
+                exported_commits[entry.get_name()]
+                + " "
+                + entry.get_name()
+                + "\n"
+            )
 
-                continue
+    replace_file_content(get_bundle_index_file(directory), "".join(lines))
 
-        return (result_as_list, result_as_dict)
+    return failed_paths
 
 ################################################################################
-##### GENERAL ##################################################################
+##### TREE EXPORT ##############################################################
 ################################################################################
-def get_submodules_of (repository_path):
-    try:
-        with open(repository_path + os.sep + ".gitsubmodules", 'r') as file_stream:
-            return GitSubmodule.parse_all(file_stream)
+# The files of the whole tree of submodules, at their described commits, can
+# be exported without any Git metadata, either into a directory or as a single
+# tar archive. Each submodule is archived by 'git archive' from its local copy
+# or, failing that, from the mirror of one of its sources in the object cache
+# (see "OBJECT CACHE"), and the description files of submodules of submodules
+# are read from these repositories at the exported commits, so the tree does
+# not need to be checked out. Archives are extracted as they are produced. For
+# tar archives, each submodule is first archived in a temporary file, then
+# appended to the output as soon as no other submodule is being appended.
+class TreeExport:
+    def __init__ (self, directory, tar_stream, cache_directory):
+        self.directory = directory
+        self.tar_stream = tar_stream
+        self.cache_directory = cache_directory
+        self.tar_stream_lock = threading.Lock()
+
+    # None when exporting as a tar archive.
+    def get_directory (self):
+        return self.directory
+
+    # None when exporting into a directory.
+    def get_tar_stream (self):
+        return self.tar_stream
+
+    def get_cache_directory (self):
+        return self.cache_directory
+
+    # Returns None if neither the local copy nor any cached mirror has the
+    # submodule's commit.
+    def get_repository_of (self, submodule, local_copy_path):
+        candidates = []
+
+        if (get_repo_snapshot(local_copy_path).get_is_repository_root()):
+            candidates.append(local_copy_path)
+
+        if (self.get_cache_directory() is not None):
+            for source in submodule.get_sources():
+                mirror_path = get_cache_mirror_path(
+                    self.get_cache_directory(),
+                    source
+                )
 
-    except FileNotFoundError:
-        return ([], dict())
+                if (os.path.isdir(mirror_path)):
+                    candidates.append(mirror_path)
 
-def update_submodules_desc_file (
-    repository_path,
-    dict_of_submodules,
-    paths_to_remove
-):
-    config_lines = []
-    last_submodule_line_of = dict()
-    last_commit_line_of = dict()
-    last_enable_line_of = dict()
-    last_target_line_of = dict()
-    last_target_overrides_commit_line_of = dict()
-    last_named_source_line_of = dict()
-    missing_sources = dict()
+        for path in candidates:
+            if (git_has_commit(path, submodule.get_commit())):
+                return path
+
+        return None
 
-    for submodule in dict_of_submodules:
-        last_submodule_line_of[submodule] = -1
-        last_commit_line_of[submodule] = -1
-        last_target_line_of[submodule] = -1
-        last_target_overrides_commit_line_of[submodule] = -1
-        last_enable_line_of[submodule] = -1
+    # Returns the exit code of 'archive_command'.
+    def add_archive (self, archive_command, repository_path):
+        with tempfile.TemporaryFile() as error_file:
+            if (self.get_tar_stream() is None):
+                result = self.extract_archive(
+                    archive_command,
+                    repository_path,
+                    error_file
+                )
+            else:
+                result = self.append_archive(
+                    archive_command,
+                    repository_path,
+                    error_file
+                )
 
-        last_named_source_line_of[submodule] = dict()
+            error_file.seek(0)
+            sys.stderr.write(error_file.read().decode('utf-8', 'replace'))
 
-        for source_name in dict_of_submodules[submodule].get_named_sources():
-            last_named_source_line_of[submodule][source_name] = -1
+        return result
 
-        missing_sources[submodule] = dict_of_submodules[submodule].get_sources()
+    def extract_archive (self, archive_command, repository_path, error_file):
+        process = subprocess.Popen(
+            archive_command,
+            cwd = repository_path,
+            stdout = subprocess.PIPE,
+            stderr = error_file
+        )
 
-    submodule_path = None
-    read = True
+        try:
+            with tarfile.open(fileobj = process.stdout, mode = 'r|') as archive:
+                # Filters were added to Python 3.12, then to older releases.
+                if (hasattr(tarfile, 'tar_filter')):
+                    archive.extractall(self.get_directory(), filter = 'tar')
+                else:
+                    archive.extractall(self.get_directory())
+        except tarfile.ReadError:
+            # 'git archive' failed before writing anything.
+            pass
+        finally:
+            process.stdout.close()
+
+        return process.wait()
+
+    def append_archive (self, archive_command, repository_path, error_file):
+        with tempfile.TemporaryFile() as archive_file:
+            result = subprocess.Popen(
+                archive_command,
+                cwd = repository_path,
+                stdout = archive_file,
+                stderr = error_file
+            ).wait()
+
+            if (result != 0):
+                return result
+
+            archive_file.seek(0)
+
+            with tarfile.open(fileobj = archive_file, mode = 'r|') as archive:
+                with self.tar_stream_lock:
+                    for member in archive:
+                        self.get_tar_stream().addfile(
+                            member,
+                            archive.extractfile(member)
+                        )
+
+        return result
+
+# Task exporting a submodule. It returns the tasks exporting the submodules
+# described at the exported commit.
+def export_submodule (submodule, name, root_path, tree_export):
+    commit = submodule.get_commit()
+    repository_path = None
+
+    if (commit is not None):
+        repository_path = tree_export.get_repository_of(
+            submodule,
+            root_path + os.sep + name
+        )
 
-    try:
-        with open(repository_path + os.sep + ".gitsubmodules", 'r') as file_stream:
-            for line in file_stream:
-                if (read):
-                    config_lines.append(line.rstrip())
+    if (repository_path is None):
+        print(
+            "[E] Neither the local copy nor the cache have the described commit"
+            + " of submodule \""
+            + name
+            + "\".",
+            file = sys.stderr
+        )
+        sys.exit(-1)
 
-                search = re.findall(r'^\s*\[submodule\s*"(.+)"\]', line)
+    print(
+        "Exporting commit \""
+        + commit
+        + "\" of submodule \""
+        + name
+        + "\" from \""
+        + repository_path
+        + "\"..."
+    )
 
-                if (search):
-                    submodule_path = search[0].strip(os.sep)
+    export_result = tree_export.add_archive(
+        ['git', 'archive', '--format=tar', '--prefix=' + name + "/", commit],
+        repository_path
+    )
 
-                    if (submodule_path in paths_to_remove):
-                        read = False
-                        config_lines = config_lines[:-1]
-                        continue
+    if (export_result != 0):
+        print(
+            "[E] Could not export submodule \"" + name + "\".",
+            file = sys.stderr
+        )
+        sys.exit(-1)
 
-                    if (not read):
-                        read = True
-                        config_lines.append(line.rstrip())
+    description = git_read_file_at(repository_path, commit, ".gitsubmodules")
 
-                    last_submodule_line_of[submodule_path] = (
-                        len(config_lines) - 1
-                    )
-                    continue
+    if (description is None):
+        return []
 
-                if (not read):
-                    continue
+    (own_list, own_submodules) = GitSubmodule.parse_all(
+        io.StringIO(description)
+    )
 
-                if (not submodule_path):
-                    continue
+    return get_export_tasks(
+        own_submodules,
+        root_path,
+        name + os.sep,
+        tree_export
+    )
 
-                if (submodule_path not in dict_of_submodules):
-                    continue
+def get_export_tasks (
+    submodule_dictionary,
+    root_path,
+    name_prefix,
+    tree_export
+):
+    tasks = []
 
-                search = re.findall(r'^\s*source\s*=\s*([^\s].*[^\s])\s*', line)
+    for submodule_path in submodule_dictionary:
+        submodule = submodule_dictionary[submodule_path]
 
-                if (search):
-                    if (
-                        (submodule_path in missing_sources)
-                        and search[0] in missing_sources[submodule_path]
-                    ):
-                        missing_sources[submodule_path].remove(search[0])
-                    continue
+        if (not submodule.get_is_enabled()):
+            print(
+                "Skipping disabled submodule \""
+                + name_prefix
+                + submodule_path
+                + "\"."
+            )
+            continue
 
-                search = re.findall(
-                    r'^\s*source.([^\s]+)\s*=\s*([^\s].*[^\s])\s*',
-                    line
+        tasks.append(
+            (
+                name_prefix + submodule_path,
+                functools.partial(
+                    export_submodule,
+                    submodule,
+                    name_prefix + submodule_path,
+                    root_path,
+                    tree_export
                 )
+            )
+        )
 
-                if (search):
-                    (name, source) = search[0]
-                    last_named_source_line_of[submodule_path][name] = (
-                        len(config_lines) - 1
-                    )
-                    continue
+    return tasks
 
-                search = re.findall(r'^\s*commit\s*=\s*([^\s].*[^\s])\s*', line)
+# Returns the paths (relative to 'root_path') of the submodules that could not
+# be exported. The submodules of those are not exported either.
+def apply_export_to (submodule_dictionary, root_path, tree_export, jobs):
+    return run_tasks_in_parallel(
+        get_export_tasks(submodule_dictionary, root_path, "", tree_export),
+        jobs,
+        True # = is_ordered
+    )
 
-                if (search):
-                    last_commit_line_of[submodule_path] = len(config_lines) - 1
-                    continue
+################################################################################
+##### GENERAL ##################################################################
+################################################################################
+def get_submodules_of (repository_path):
+    description_file = repository_path + os.sep + ".gitsubmodules"
+    index_file = get_description_index_file(repository_path)
 
-                search = re.findall(r'^\s*target\s*=\s*(commit|(?:branch\s+[^\s]+)|(?:tag\s+[^\s]+))\s*', line)
+    try:
+        with open(description_file, 'rb') as file_stream:
+            file_status = os.fstat(file_stream.fileno())
+            index = read_description_index(index_file)
 
-                if (search):
-                    last_target_line_of[submodule_path] = len(config_lines) - 1
-                    continue
+            if (is_description_index_up_to_date(index, file_status)):
+                records = index[5]
+            else:
+                content = file_stream.read()
+                content_hash = hashlib.sha1(content).hexdigest()
 
-                search = re.findall(
-                    r'^\s*target_overrides_commit\s*=\s*([^\s].*[^\s])\s*',
-                    line
+                if ((index is not None) and (index[3] == content_hash)):
+                    records = index[5]
+                else:
+                    (submodule_list, submodule_dictionary) = (
+                        GitSubmodule.parse_all(
+                            io.TextIOWrapper(io.BytesIO(content))
+                        )
+                    )
+                    records = [
+                        submodule.to_record() for submodule in submodule_list
+                    ]
+
+                write_description_index(
+                    index_file,
+                    file_status,
+                    content_hash,
+                    records
                 )
 
-                if (search):
-                    last_target_overrides_commit_line_of[submodule_path] = (
-                        len(config_lines) - 1
-                    )
-                    continue
+    except FileNotFoundError:
+        return ([], dict())
+
+    result_as_list = [GitSubmodule.from_record(record) for record in records]
+    result_as_dict = dict(
+        [(submodule.get_path(), submodule) for submodule in result_as_list]
+    )
 
-                search = re.findall(r'^\s*enable\s*=\s*([^\s].*[^\s])\s*', line)
+    return (result_as_list, result_as_dict)
 
-                if (search):
-                    last_enable_line_of[submodule_path] = len(config_lines) - 1
-                    continue
+def update_submodules_desc_file (
+    repository_path,
+    dict_of_submodules,
+    paths_to_remove
+):
+    description_file = repository_path + os.sep + ".gitsubmodules"
 
+    try:
+        with open(description_file, 'r') as file_stream:
+            document = DescriptionDocument.parse(file_stream)
     except FileNotFoundError:
         print(
             "No \""
@@ -998,7 +4644,10 @@ def update_submodules_desc_file (
             + ".gitsubmodules\" file found. It will be created."
         )
 
-    #### Existing Lines Replacement ############################################
+        document = DescriptionDocument()
+
+    document.remove_sections_of(paths_to_remove)
+
     for submodule_path in dict_of_submodules:
         submodule = dict_of_submodules[submodule_path]
 
@@ -1010,199 +4659,220 @@ def update_submodules_desc_file (
             )
             continue
 
-        if (last_submodule_line_of[submodule_path] == -1):
-            continue
+        document.update_sections_of(submodule_path, submodule)
 
-        if (last_commit_line_of[submodule_path] != -1):
-            config_lines[last_commit_line_of[submodule_path]] = (
-                "   commit = " + submodule.get_commit()
-            )
+    replace_file_content(description_file, document.to_text())
 
-        if (last_enable_line_of[submodule_path] != -1):
-            config_lines[last_enable_line_of[submodule_path]] = (
-                "   enable = " + str(submodule.get_is_enabled())
-            )
+def restrict_dictionary_to (dict_of_submodules, list_of_paths):
+    if (list_of_paths == []):
+        return dict_of_submodules
 
-        if (last_target_overrides_commit_line_of[submodule_path] != -1):
-            config_lines[
-                last_target_overrides_commit_line_of[submodule_path]
-            ] = (
-                "   target_overrides_commit = "
-                + str(submodule.get_target_overrides_commit())
-            )
+    result = dict()
 
-        if (last_target_line_of[submodule_path] != -1):
-            if (submodule.get_target_type() == "commit"):
-                target_line = "   target = commit"
-            else:
-                target_line = (
-                    "   target = "
-                    + submodule.get_target_type()
-                    + " "
-                    + submodule.get_target()
-                )
+    for path in list_of_paths:
+        if (path not in dict_of_submodules):
+            print("[F] Unknown submodule \"" + path + "\".", file = sys.stderr)
 
-            config_lines[last_target_line_of[submodule_path]] = target_line
+            sys.exit(-1)
 
-        named_sources = submodule.get_named_sources()
-        for source_name in named_sources:
-            if (last_named_source_line_of[submodule_path][source_name] != -1):
-                config_lines[
-                    last_named_source_line_of[submodule_path][source_name]
-                ] = (
-                    "   source."
-                    + source_name
-                    + " = "
-                    + named_sources[source_name]
+            return dict()
+        else:
+            if (not dict_of_submodules[path].get_is_enabled()):
+                print(
+                    "[E] Ignoring disabled submodule \""
+                    + path
+                    + "\".",
+                    file = sys.stderr
                 )
 
-    #### Lines Addition ########################################################
-    for submodule_path in dict_of_submodules:
-        submodule = dict_of_submodules[submodule_path]
+                continue
 
-        if (submodule.get_commit() == None):
-            # Info about this submodule being skipped was already printed.
-            continue
+            result[path] = dict_of_submodules[path]
 
-        write_index = last_submodule_line_of[submodule_path]
-        offset = 0
+    return result
 
-        if (write_index == -1):
-            config_lines.append("[submodule \"" + submodule_path + "\"]")
-            write_index = len(config_lines)
-        else:
-            write_index = write_index + 1
+# In incremental mode, local copies that already match their description are
+# left as they are (their own submodules are still handled).
+def update_local_copy (submodule, force_target, root_path, clone_options):
+    repo_path = root_path + os.sep + submodule.get_path()
+    (primary_path, primary_ready) = (repo_path, None)
 
-        if (last_commit_line_of[submodule_path] == -1):
-            config_lines.insert(
-                write_index,
-                "   commit = " + submodule.get_commit()
-            )
-            offset = offset + 1
+    if (clone_options.get_is_using_worktrees()):
+        (primary_path, primary_ready) = claim_primary_local_copy(
+            submodule,
+            repo_path
+        )
+
+    if (primary_path != repo_path):
+        print(
+            "Waiting for \""
+            + primary_path
+            + "\", which uses the same sources as \""
+            + repo_path
+            + "\"..."
+        )
+        primary_ready.wait()
 
-        if (last_enable_line_of[submodule_path]  == -1):
-            config_lines.insert(
-                write_index,
-                "   enable = " + str(submodule.get_is_enabled())
+    try:
+        if (
+            clone_options.get_is_incremental()
+            and submodule.get_is_local_copy_up_to_date(root_path, force_target)
+        ):
+            print(
+                "\""
+                + repo_path
+                + "\" already matches its description. Skipped."
             )
-            offset = offset + 1
 
+            return
 
-        if (last_target_overrides_commit_line_of[submodule_path] == -1):
-            config_lines.insert(
-                write_index,
-                "   target_overrides_commit = "
-                + str(submodule.get_target_overrides_commit())
+        if (
+            (primary_path != repo_path)
+            and not get_repo_snapshot(repo_path).get_is_repository_root()
+        ):
+            submodule.add_worktree(
+                root_path,
+                force_target,
+                primary_path,
+                clone_options
             )
-            offset = offset + 1
+        else:
+            print("Cloning \"" + repo_path + "\"...")
 
-        if (last_target_line_of[submodule_path] == -1):
-            if (submodule.get_target_type() == "commit"):
-                target_line = "   target = commit"
-            else:
-                target_line = (
-                    "   target = "
-                    + submodule.get_target_type()
-                    + " "
-                    + submodule.get_target()
-                )
-            config_lines.insert(write_index, target_line)
-            offset = offset + 1
+            submodule.clone_repository(root_path, force_target, clone_options)
+    finally:
+        if ((primary_path == repo_path) and (primary_ready is not None)):
+            primary_ready.set()
 
-        # Reverse the source order, as the additions are done in reverse.
-        for source in reversed(missing_sources[submodule_path]):
-            config_lines.insert(
-                write_index,
-                "   source = " + source
-            )
-            offset = offset + 1
+    # Official Git submodules are not bundled, and would have to be fetched.
+    if (clone_options.get_is_using_bundles()):
+        print(
+            "Done. Official Git submodules in \""
+            + repo_path
+            + "\" are left as they are when using bundles."
+        )
 
-        named_sources = submodule.get_named_sources()
+        return
 
-        for source_name in named_sources:
-            last_index = last_named_source_line_of[submodule_path][source_name]
-            new_line = (
-            )
-
-            if (last_named_source_line_of[submodule_path][source_name] == -1):
-                config_lines.insert(
-                    write_index,
-                    (
-                        "   source."
-                        + source_name
-                        + " = "
-                        + named_sources[source_name]
-                    )
-                )
-                offset = offset + 1
+    print(
+        "Done. Handling any official Git submodules in \""
+        + repo_path
+        + "\"..."
+    )
+    git_inflate_official_submodules(repo_path)
 
-        for other_submodule_path in last_submodule_line_of:
-            if (last_submodule_line_of[other_submodule_path] > write_index):
-                last_submodule_line_of[other_submodule_path] = (
-                    last_submodule_line_of[other_submodule_path] + offset
-                )
+def clone_submodule_recursively (
+    submodule,
+    force_target,
+    root_path,
+    clone_options
+):
+    repo_path = root_path + os.sep + submodule.get_path()
 
-    with open(repository_path + os.sep + ".gitsubmodules", 'w') as file_stream:
-        for line in config_lines:
-            print(line, file = file_stream)
+    update_local_copy(submodule, force_target, root_path, clone_options)
 
-def restrict_dictionary_to (dict_of_submodules, list_of_paths):
-    if (list_of_paths == []):
-        return dict_of_submodules
+    print("Done. Recursing clone in \"" + repo_path + "\"...")
 
-    result = dict()
+    (recursive_list, recursive_dictionary) = get_submodules_of(repo_path)
 
-    for path in list_of_paths:
-        if (path not in dict_of_submodules):
-            print("[F] Unknown submodule \"" + path + "\".", file = sys.stderr)
+    apply_clone_to(recursive_dictionary, False, repo_path, 1, clone_options)
 
-            sys.exit(-1)
+    print ("Recursive clone in \"" + repo_path + "\" completed.")
 
-            return dict()
-        else:
-            if (not dict_of_submodules[path].get_is_enabled()):
-                print(
-                    "[E] Ignoring disabled submodule \""
-                    + path
-                    + "\".",
-                    file = sys.stderr
-                )
+# Task used when cloning in parallel: instead of recursing, it returns the
+# tasks cloning the submodule's own submodules, so that these can start as soon
+# as the submodule is checked out, alongside the remaining ones.
+def clone_submodule (
+    submodule,
+    force_target,
+    root_path,
+    name_prefix,
+    clone_options
+):
+    repo_path = root_path + os.sep + submodule.get_path()
 
-                continue
+    update_local_copy(submodule, force_target, root_path, clone_options)
 
-            result[path] = dict_of_submodules[path]
+    print("Done. Queuing recursive clone in \"" + repo_path + "\".")
 
-    return result
+    (recursive_list, recursive_dictionary) = get_submodules_of(repo_path)
+
+    return get_clone_tasks(
+        recursive_dictionary,
+        False,
+        repo_path,
+        name_prefix + submodule.get_path() + os.sep,
+        clone_options
+    )
+
+def get_clone_tasks (
+    submodule_dictionary,
+    force_target,
+    root_path,
+    name_prefix,
+    clone_options
+):
+    tasks = []
 
-def apply_clone_to (submodule_dictionary, force_target, root_path):
     for submodule_path in submodule_dictionary:
-        if (not submodule_dictionary[submodule_path].get_is_enabled()):
+        submodule = submodule_dictionary[submodule_path]
+
+        if (not submodule.get_is_enabled()):
             print("Skipping disabled submodule \"" + submodule_path + "\".")
             continue
 
-        repo_path = root_path + os.sep + submodule_path
-
-        print("Cloning \"" + repo_path + "\"...")
-
-        submodule_dictionary[submodule_path].clone_repository(
-            root_path,
-            force_target
+        tasks.append(
+            (
+                name_prefix + submodule_path,
+                functools.partial(
+                    clone_submodule,
+                    submodule,
+                    force_target,
+                    root_path,
+                    name_prefix,
+                    clone_options
+                )
+            )
         )
 
-        print(
-            "Done. Handling any official Git submodules in \""
-            + repo_path
-            + "\"..."
+    return tasks
+
+# Returns the paths (relative to 'root_path') of the submodules that could not
+# be cloned. With a single job, failing to clone a submodule is fatal instead.
+def apply_clone_to (
+    submodule_dictionary,
+    force_target,
+    root_path,
+    jobs,
+    clone_options
+):
+    if (jobs > 1):
+        return run_tasks_in_parallel(
+            get_clone_tasks(
+                submodule_dictionary,
+                force_target,
+                root_path,
+                "", # = name_prefix
+                clone_options
+            ),
+            jobs
         )
-        git_inflate_official_submodules(repo_path)
 
-        print("Done. Recursing clone in \"" + repo_path + "\"...")
+    for submodule_path in submodule_dictionary:
+        submodule = submodule_dictionary[submodule_path]
 
-        (recursive_list, recursive_dictionary) = get_submodules_of(repo_path)
+        if (not submodule.get_is_enabled()):
+            print("Skipping disabled submodule \"" + submodule_path + "\".")
+            continue
 
-        apply_clone_to(recursive_dictionary, False, repo_path)
+        clone_submodule_recursively(
+            submodule,
+            force_target,
+            root_path,
+            clone_options
+        )
 
-        print ("Recursive clone in \"" + repo_path + "\" completed.")
+    return []
 
 
 def apply_clear_to (submodule_dictionary, root_path):
@@ -1215,13 +4885,37 @@ def apply_clear_to (submodule_dictionary, root_path):
 
         print("Cleared \"" + root_path + os.sep + submodule_path + "\"...")
 
-def apply_check_to (submodule_dictionary, root_path):
+def check_submodule (submodule, root_path):
+    if (not submodule.get_is_enabled()):
+        print("Skipping disabled submodule \"" + submodule.get_path() + "\".")
+        return
+
+    submodule.check_description(root_path)
+
+# Returns the paths of the submodules that could not be checked. With multiple
+# jobs, the reports are still printed in the order of the description.
+def apply_check_to (submodule_dictionary, root_path, jobs):
+    if (jobs > 1):
+        return run_tasks_in_parallel(
+            [
+                (
+                    submodule_path,
+                    functools.partial(
+                        check_submodule,
+                        submodule_dictionary[submodule_path],
+                        root_path
+                    )
+                )
+                for submodule_path in submodule_dictionary
+            ],
+            jobs,
+            True # = is_ordered
+        )
+
     for submodule_path in submodule_dictionary:
-        if (not submodule_dictionary[submodule_path].get_is_enabled()):
-            print("Skipping disabled submodule \"" + submodule_path + "\".")
-            continue
+        check_submodule(submodule_dictionary[submodule_path], root_path)
 
-        submodule_dictionary[submodule_path].check_description(root_path)
+    return []
 
 def apply_update_desc_to (submodule_dictionary, root_path):
     for submodule_path in submodule_dictionary:
@@ -1237,74 +4931,231 @@ def apply_update_desc_to (submodule_dictionary, root_path):
 
         print("Done (not written yet).")
 
+# Only tells if the directory is a repository when it is not to be descended
+# into, as that does not require listing its content.
+def explore_directory (path, should_descend):
+    if (not should_descend):
+        return (os.path.lexists(path + os.sep + ".git"), [])
+
+    return scan_directory(path)
+
+# Returns the directories to explore among 'search_paths', a list of
+# (path, depth) pairs, as (path, depth, should_descend) triples.
+def get_exploration_targets (
+    search_paths,
+    filter_out,
+    gitignore_rules,
+    root_path,
+    max_depth
+):
+    result = []
+
+    for (path, depth) in search_paths:
+        if (path in filter_out):
+            continue
+
+        relative_path = os.path.relpath(path, root_path).replace(os.sep, "/")
+
+        # Paths explicitly searched (depth 0) are explored even if ignored.
+        should_descend = (
+            ((max_depth is None) or (depth < max_depth))
+            and (
+                (depth == 0)
+                or relative_path.startswith("..")
+                or not is_ignored_by(gitignore_rules, relative_path)
+            )
+        )
+
+        result.append((path, depth, should_descend))
+
+    return result
+
+# Directories are explored one depth level at a time, each level being explored
+# in parallel. Directories ignored by the root repository's .gitignore, or at
+# 'max_depth', are checked but not descended into.
 def list_all_non_submodule_subrepositories (
     submodules_dictionary,
     search_paths,
-    root_path
+    root_path,
+    max_depth,
+    jobs
 ):
-    filter_out = [root_path + os.sep + path for path in submodules_dictionary]
-    exploration_targets = search_paths
+    filter_out = set(
+        [root_path + os.sep + path for path in submodules_dictionary]
+    )
+    gitignore_rules = read_gitignore_rules(root_path)
+    result = []
 
-    while (len(exploration_targets) > 0):
-        candidate = exploration_targets.pop()
+    exploration_targets = get_exploration_targets(
+        search_paths,
+        filter_out,
+        gitignore_rules,
+        root_path,
+        max_depth
+    )
 
-        if (candidate in filter_out):
-            continue
-        elif (git_is_repository_root(candidate)):
-            print(candidate)
-        else:
-            exploration_targets.extend(
-                get_path_of_direct_subdirectories(candidate, [".git"])
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as pool:
+        while (len(exploration_targets) > 0):
+            explorations = pool.map(
+                explore_directory,
+                [target[0] for target in exploration_targets],
+                [target[2] for target in exploration_targets]
             )
+            search_paths = []
+
+            for (
+                (path, depth, should_descend),
+                (is_repository, subdirectories)
+            ) in zip(exploration_targets, explorations):
+                if (is_repository):
+                    result.append(path)
+                else:
+                    search_paths.extend(
+                        [(path, depth + 1) for path in subdirectories]
+                    )
 
-def apply_foreach_to(
-    submodule_dictionary,
-    is_recursive,
+            exploration_targets = get_exploration_targets(
+                search_paths,
+                filter_out,
+                gitignore_rules,
+                root_path,
+                max_depth
+            )
+
+    for path in sorted(result):
+        print(path)
+
+# Runs the command for a single submodule, returning the tasks for its own
+# submodules. A non-zero exit code (or None if the persistent shell running the
+# command stopped) is added to 'failed_commands' along with the submodule's
+# position, so that failures can be reported in the order of the description
+# files.
+def foreach_submodule (
+    entry,
     is_enabled_only,
-    traversed_submodules,
     command,
-    root_directory
+    use_persistent_shells,
+    root_directory,
+    failed_commands
 ):
-    for submodule_path in submodule_dictionary:
-        submodule = submodule_dictionary[submodule_path]
+    penv = dict()
+    penv['SNSM_ROOT'] = root_directory
+    penv['SNSM_ABSOLUTE_PATH'] = entry.get_absolute_path()
+    penv['SNSM_PATH'] = entry.get_submodule().get_path()
+    penv['SNSM_PARENT'] = entry.get_parent()
+    penv['SNSM_PARENTS'] = '\n'.join(entry.get_parents())
 
-        if (is_enabled_only and (not submodule.get_is_enabled())):
-            continue
+    entry.get_submodule().add_environment_variables(penv)
+
+    if (use_persistent_shells):
+        exit_code = get_shell_worker().run(command, penv['SNSM_PARENT'], penv)
+    else:
+        env_vars = get_environment_variables()
+        env_vars.update(penv)
 
-        penv = get_environment_variables()
-        penv['SNSM_ROOT'] = root_directory
-        penv['SNSM_ABSOLUTE_PATH'] = (
-            traversed_submodules[-1] + os.sep + submodule_path
+        exit_code = run_command(
+            [command],
+            penv['SNSM_PARENT'],
+            env = env_vars,
+            shell = True
         )
-        penv['SNSM_PATH'] = submodule_path
-        penv['SNSM_PARENT'] = traversed_submodules[-1]
-        penv['SNSM_PARENTS'] = '\n'.join(traversed_submodules)
 
-        submodule.add_environment_variables(penv)
+    if (exit_code != 0):
+        failed_commands.append(
+            (entry.get_position(), entry.get_name(), exit_code)
+        )
 
-        subprocess.Popen(
-            [command],
-            cwd = penv['SNSM_PARENT'],
-            shell = True,
-            env = penv
-        ).wait()
+    return get_foreach_tasks(
+        entry.get_children(),
+        is_enabled_only,
+        command,
+        use_persistent_shells,
+        root_directory,
+        failed_commands
+    )
 
-        if (is_recursive):
-            (ignored_list, submodules_own_submodules) = get_submodules_of(
-                penv['SNSM_PATH']
-            )
+def get_foreach_tasks (
+    entries,
+    is_enabled_only,
+    command,
+    use_persistent_shells,
+    root_directory,
+    failed_commands
+):
+    result = []
 
-            next_traversed_submodules = traversed_submodules.copy()
-            next_traversed_submodules.append(penv['SNSM_PATH'])
+    for entry in entries:
+        if (is_enabled_only and (not entry.get_submodule().get_is_enabled())):
+            continue
 
-            apply_foreach_to(
-                submodules_own_submodules,
-                True,
-                is_enabled_only,
-                next_traversed_submodules,
-                command,
-                root_directory
+        result.append(
+            (
+                entry.get_name(),
+                functools.partial(
+                    foreach_submodule,
+                    entry,
+                    is_enabled_only,
+                    command,
+                    use_persistent_shells,
+                    root_directory,
+                    failed_commands
+                )
             )
+        )
+
+    return result
+
+# Returns the (path, exit code) of each command that did not succeed, in the
+# order of the description files, followed by the paths of the submodules for
+# which the command could not be run at all (with None as exit code). The
+# description files of all submodules are read beforehand, and a submodule's own
+# submodules are only handled once its command has been run.
+def apply_foreach_to (
+    submodule_dictionary,
+    is_recursive,
+    is_enabled_only,
+    command,
+    use_persistent_shells,
+    root_directory,
+    jobs,
+    is_ordered
+):
+    failed_commands = []
+    (all_entries, top_entries) = get_submodule_tree(
+        submodule_dictionary,
+        root_directory,
+        is_recursive
+    )
+    tasks = get_foreach_tasks(
+        top_entries,
+        is_enabled_only,
+        command,
+        use_persistent_shells,
+        root_directory,
+        failed_commands
+    )
+
+    try:
+        if (jobs > 1):
+            failed_paths = run_tasks_in_parallel(tasks, jobs, is_ordered)
+        else:
+            failed_paths = []
+            pending_tasks = list(reversed(tasks))
+
+            while (len(pending_tasks) > 0):
+                (name, function) = pending_tasks.pop()
+
+                pending_tasks.extend(reversed(function()))
+    finally:
+        stop_shell_workers()
+
+    return (
+        [
+            (name, exit_code)
+            for (position, name, exit_code) in sorted(failed_commands)
+        ]
+        + [(name, None) for name in failed_paths]
+    )
 
 ################################################################################
 ##### HELP #####################################################################
@@ -1334,6 +5185,28 @@ def handle_generic_help (invocation):
     )
     print("")
     print("################")
+    print("COMMAND export")
+    print(
+        "PARAMETERS one local path to a directory (or, with --tar, to a tar"
+        " file, '-' being the standard output)."
+    )
+    print(
+        "EFFECT writes the files of each submodule, at its described commit,"
+        " for the whole tree of submodules, without any Git metadata."
+    )
+    print("OPTIONS --cache-dir DIR, --jobs N, --tar")
+    print("")
+    print("################")
+    print("COMMAND export-bundles")
+    print("PARAMETERS one local path to a directory.")
+    print(
+        "EFFECT writes a Git bundle of the described commit of each submodule,"
+        " for the whole tree of submodules, in that directory. See"
+        " 'update-directory --from-bundles'."
+    )
+    print("OPTIONS --jobs N")
+    print("")
+    print("################")
     print("COMMAND foreach")
     print(
         "PARAMETERS list of local paths to Git repositories and a shell"
@@ -1344,6 +5217,7 @@ def handle_generic_help (invocation):
         "EFFECT executes the shell command for each submodule. See"
         " 'help foreach' for more details."
     )
+    print("OPTIONS --jobs N, --persistent-shells, --unordered")
     print("")
     print("################")
     print("COMMAND foreach-enabled")
@@ -1356,6 +5230,7 @@ def handle_generic_help (invocation):
         "EFFECT executes the shell command for each submodule, provided they"
         " are enabled. See 'help foreach' for more details."
     )
+    print("OPTIONS --jobs N, --persistent-shells, --unordered")
     print("")
     print("################")
     print("COMMAND foreach-enabled-recursive")
@@ -1369,6 +5244,7 @@ def handle_generic_help (invocation):
         " are enabled. The execution recurses into each such submodule. See"
         " 'help foreach' for more details."
     )
+    print("OPTIONS --jobs N, --persistent-shells, --unordered")
     print("")
     print("################")
     print("COMMAND foreach-recursive")
@@ -1381,6 +5257,7 @@ def handle_generic_help (invocation):
         "EFFECT executes the shell command for each submodule. The execution"
         " recurses into each submodule. See 'help foreach' for more details."
     )
+    print("OPTIONS --jobs N, --persistent-shells, --unordered")
     print("")
     print("################")
     print("COMMAND from-official")
@@ -1407,6 +5284,18 @@ def handle_generic_help (invocation):
     print("EFFECT lists all submodules in those directories.")
     print("")
     print("################")
+    print("COMMAND lock")
+    print("PARAMETERS none.")
+    print(
+        "EFFECT writes the commit the target of each submodule currently points"
+        " to, for the whole tree of submodules, in the .gitsubmodules.lock"
+        " file."
+    )
+    print(
+        "OPTIONS --deadline SECONDS, --jobs N, --retries N, --timeout SECONDS"
+    )
+    print("")
+    print("################")
     print("COMMAND match-target")
     print(
         "PARAMETERS list of paths to submodules. All described submodules are"
@@ -1418,6 +5307,11 @@ def handle_generic_help (invocation):
         " 'target_overrides_commit' parameter, then updates the submodule's"
         " description so that it matches the updated local copy."
     )
+    print(
+        "OPTIONS --cache-dir DIR, --deadline SECONDS, --declared-order,"
+        " --incremental, --jobs N, --race-sources, --retries N,"
+        " --share-fetches, --timeout SECONDS, --use-worktrees"
+    )
     print("")
     print("################")
     print("COMMAND from-official")
@@ -1464,6 +5358,7 @@ def handle_generic_help (invocation):
         " given."
     )
     print("EFFECT lists subfolders eligible to become submodules.")
+    print("OPTIONS --jobs N, --max-depth N")
     print("")
     print("################")
     print("COMMAND status")
@@ -1471,7 +5366,11 @@ def handle_generic_help (invocation):
         "PARAMETERS list of paths to submodules. All described submodules are"
         " selected if no path is given."
     )
-    print("EFFECT compares description and local copy of the submodules.")
+    print("EFFECT compares description and local copy of the submodules.")
+    print(
+        "OPTIONS --deadline SECONDS, --jobs N, --locked, --ref-cache-ttl"
+        " SECONDS, --retries N, --timeout SECONDS"
+    )
     print("")
     print("################")
     print("COMMAND to-official")
@@ -1502,6 +5401,12 @@ def handle_generic_help (invocation):
         "EFFECT updates the local copy of the submodules to match the"
         " description file."
     )
+    print(
+        "OPTIONS --cache-dir DIR, --deadline SECONDS, --declared-order,"
+        " --from-bundles DIR, --incremental, --jobs N, --locked,"
+        " --race-sources, --retries N, --share-fetches, --timeout SECONDS,"
+        " --use-worktrees"
+    )
 
 def handle_help_command (invocation, parameters):
     if (len(parameters) > 1):
@@ -1542,6 +5447,63 @@ def handle_help_command (invocation, parameters):
 
         return
 
+    if (command in aliases['export']):
+        print(
+            "PARAMETERS one local path to a directory (or, with --tar, to a tar"
+            " file, '-' being the standard output)."
+        )
+        print(
+            "EFFECT writes the files of each enabled submodule, including those"
+            " of submodules, at its described commit, without any Git"
+            " metadata. Each submodule is archived by 'git archive' from its"
+            " local copy or, if it does not have the commit, from a cached"
+            " mirror of one of its sources. The description files of"
+            " submodules of submodules are read at the exported commits, so"
+            " these do not need to be checked out. Files are written at the"
+            " path of their submodule relative to the root repository. The root"
+            " repository's own files are not exported."
+        )
+        print(
+            "OPTION --cache-dir DIR also looks for the commits in the mirrors"
+            " kept in DIR by 'update-directory --cache-dir'. Defaults to the"
+            " SNSM_CACHE_DIR environment variable, if set."
+        )
+        print(
+            "OPTION --jobs N exports up to N submodules in parallel. The output"
+            " is still printed in the order of the description files."
+        )
+        print(
+            "OPTION --tar writes a single tar archive instead of a directory."
+            " Messages are written on the standard error if the archive is"
+            " written on the standard output."
+        )
+        print("EXAMPLE export ../build/sources")
+        print("EXAMPLE export --jobs 8 --tar - | tar -x -C /build")
+        print("ALIASES " + ', '.join(aliases['export']) + ".")
+
+        return
+
+    if (command in aliases['export-bundles']):
+        print("PARAMETERS one local path to a directory.")
+        print(
+            "EFFECT writes, in that directory, a Git bundle of the described"
+            " commit of each enabled submodule, including those of submodules,"
+            " taken from their local copy, as well as a bundles.index file"
+            " listing them. The bundle of a submodule is written at its path"
+            " (relative to the root repository) with a .bundle extension. The"
+            " directory can then be given to 'update-directory --from-bundles'"
+            " to populate the submodules without any network access."
+        )
+        print(
+            "OPTION --jobs N writes up to N bundles in parallel. The output is"
+            " still printed in the order of the description files."
+        )
+        print("EXAMPLE export-bundles /media/usb/bundles")
+        print("EXAMPLE export-bundles --jobs 8 ../bundles")
+        print("ALIASES " + ', '.join(aliases['export-bundles']) + ".")
+
+        return
+
     if (command in aliases['foreach']):
         print(
             "PARAMETERS list of local paths to Git repositories and a shell"
@@ -1552,7 +5514,9 @@ def handle_help_command (invocation, parameters):
             "EFFECT executes the shell command for each submodule. The command"
             " is executed from the parent repository and a number of"
             " environment variables are declared for each execution, as"
-            " described below (according to what is in the description file):"
+            " described below (according to what is in the description file)."
+            " The submodules for which the command failed are listed at the"
+            " end, along with the command's exit code:"
         )
         print("ENVVAR SNSM_COMMIT is the commit for this submodule.")
         print(
@@ -1593,7 +5557,31 @@ def handle_help_command (invocation, parameters):
             "ENVVAR SNSM_PARENTS is a newline separated list of absolute path"
             " to each of the parent repositories."
         )
+        print(
+            "OPTION --jobs N executes the command for up to N submodules in"
+            " parallel. The output of each command is printed as a single"
+            " block, in the order of the description file (a submodule's own"
+            " submodules coming right after it). With the recursive variants,"
+            " the command is executed for a submodule's own submodules only"
+            " after it was executed for that submodule."
+        )
+        print(
+            "OPTION --unordered prints the output of each command as soon as it"
+            " is done instead."
+        )
+        print(
+            "OPTION --persistent-shells keeps one shell running per job and"
+            " has it execute the command for each submodule in a subshell,"
+            " instead of starting a new shell each time. Only the SNSM_*"
+            " variables are set anew for each execution. The output of each"
+            " command is printed once it is done, even without --jobs."
+        )
         print("EXAMPLE foreach ./my/src/local_clone \"echo $SNSM_PATH\"")
+        print("EXAMPLE foreach --jobs 8 \"git fetch\"")
+        print(
+            "EXAMPLE foreach --persistent-shells \"git -C $SNSM_PATH"
+            " rev-parse HEAD\""
+        )
         print("ALIASES " + ', '.join(aliases['foreach']) + ".")
 
         return
@@ -1674,6 +5662,46 @@ def handle_help_command (invocation, parameters):
 
         return
 
+    if (command in aliases['lock']):
+        print("PARAMETERS none.")
+        print(
+            "EFFECT asks the sources of each enabled submodule, including those"
+            " of submodules, which commit its branch or tag target points to,"
+            " and writes these commits in the .gitsubmodules.lock file, next to"
+            " the root repository's .gitsubmodules file. Each source is only"
+            " asked once. Commit targets are listed as they are. The"
+            " descriptions of submodules of submodules are read from their"
+            " local copy. If any target cannot be resolved, the lock file is"
+            " left as it was. See the --locked option of 'status' and"
+            " 'update-directory'."
+        )
+        print(
+            "OPTION --jobs N resolves up to N targets in parallel. Defaults to"
+            " 8."
+        )
+        print(
+            "OPTION --timeout SECONDS stops any network operation (clone,"
+            " fetch, ls-remote...) taking longer than SECONDS. Operations"
+            " limited this way (or by --deadline) cannot ask for credentials."
+        )
+        print(
+            "OPTION --retries N retries network operations that timed out or"
+            " failed for a possibly temporary reason (e.g. connection reset)"
+            " up to N times, waiting about 1, 2, 4... seconds (up to 30) in"
+            " between."
+        )
+        print(
+            "OPTION --deadline SECONDS does not start (or retry) any network"
+            " operation once SECONDS have passed since the start, and stops"
+            " those still running. Operations given up on because of a timeout"
+            " or of the deadline are listed at the end."
+        )
+        print("EXAMPLE lock")
+        print("EXAMPLE lock --jobs 16 --timeout 30")
+        print("ALIASES " + ', '.join(aliases['lock']) + ".")
+
+        return
+
     if (command in aliases['match-target']):
         print(
             "PARAMETERS list of paths to submodules. All described submodules"
@@ -1685,7 +5713,71 @@ def handle_help_command (invocation, parameters):
             " 'target_overrides_commit' parameter, then updates the submodule's"
             " description so that it matches the updated local copy."
         )
+        print(
+            "OPTION --cache-dir DIR keeps a bare mirror of each remote source"
+            " in DIR, updated once per run, and clones with it as a reference"
+            " so that only the objects it lacks are downloaded. Clones keep"
+            " relying on the mirror's objects, so DIR must not be removed."
+            " Defaults to the SNSM_CACHE_DIR environment variable, if set."
+        )
+        print(
+            "OPTION --declared-order tries the sources of each submodule in the"
+            " order of the description file. Otherwise, the sources that"
+            " failed the least, then the quickest, in previous runs (as"
+            " recorded in the root repository's Git directory) are tried"
+            " first."
+        )
+        print(
+            "OPTION --incremental leaves alone the submodules whose local copy"
+            " is already on the commit (or tag) to check out and has all of"
+            " the named sources as remotes. Their own submodules are still"
+            " handled. Submodules following a branch are always updated."
+        )
+        print(
+            "OPTION --jobs N clones up to N submodules in parallel. The output"
+            " of each submodule is printed as a single block once it is done,"
+            " and a submodule failing does not stop the others."
+        )
+        print(
+            "OPTION --race-sources asks all of a submodule's sources for their"
+            " references at the same time before cloning or fetching, then"
+            " tries first those that have what is to be checked out, quickest"
+            " first, the declared order only breaking ties."
+        )
+        print(
+            "OPTION --share-fetches fetches each remote source only once, into"
+            " a mirror in the root repository's Git directory (or in the"
+            " --cache-dir directory), then clones every submodule using that"
+            " source from the mirror, before pointing its 'origin' remote back"
+            " to the source. Mirrors in the root repository's Git directory"
+            " are removed once the command is done."
+        )
+        print(
+            "OPTION --timeout SECONDS stops any network operation (clone,"
+            " fetch, ls-remote...) taking longer than SECONDS. Operations"
+            " limited this way (or by --deadline) cannot ask for credentials."
+        )
+        print(
+            "OPTION --retries N retries network operations that timed out or"
+            " failed for a possibly temporary reason (e.g. connection reset)"
+            " up to N times, waiting about 1, 2, 4... seconds (up to 30) in"
+            " between."
+        )
+        print(
+            "OPTION --deadline SECONDS does not start (or retry) any network"
+            " operation once SECONDS have passed since the start, and stops"
+            " those still running. Operations given up on because of a timeout"
+            " or of the deadline are listed at the end."
+        )
+        print(
+            "OPTION --use-worktrees clones only once the submodules using the"
+            " same sources (and source names), even in different description"
+            " files, and adds the others as worktrees of that clone, on a"
+            " detached HEAD. Shallow and partial clones are not shared. The"
+            " clone must be kept, as the worktrees depend on it."
+        )
         print("EXAMPLE match-target")
+        print("EXAMPLE match-target --jobs 8")
         print("EXAMPLE match-target ./*")
         print("EXAMPLE match-target ./my/src/local_clone")
         print("ALIASES " + ', '.join(aliases['match-target']) + ".")
@@ -1715,14 +5807,62 @@ def handle_help_command (invocation, parameters):
 
     if (command in aliases['seek']):
         # TODO
+        print(
+            "OPTION --jobs N explores up to N folders in parallel. By default,"
+            " as many as Python's thread pools use."
+        )
+        print(
+            "OPTION --max-depth N does not look further than N folders below"
+            " the given paths (or the root repository)."
+        )
+        print(
+            "Folders ignored by the root repository's .gitignore file are"
+            " listed if they are repositories, but not explored."
+        )
         print("EXAMPLE seek /my/src/")
+        print("EXAMPLE seek --max-depth 3")
         print("ALIASES " + ', '.join(aliases['seek']) + ".")
 
         return
 
     if (command in aliases['status']):
         # TODO
+        print(
+            "OPTION --jobs N checks up to N submodules in parallel. The reports"
+            " are still printed in the order of the description file."
+        )
+        print(
+            "OPTION --locked compares the local copy of submodules following a"
+            " branch or tag to the commit this target is locked on in the"
+            " .gitsubmodules.lock file (see 'lock'), instead of asking their"
+            " sources."
+        )
+        print(
+            "OPTION --ref-cache-ttl SECONDS stores the references advertised by"
+            " each source in the root repository's Git directory, and reuses"
+            " those that were queried less than SECONDS ago instead of querying"
+            " the source again."
+        )
+        print(
+            "OPTION --timeout SECONDS stops any network operation (clone,"
+            " fetch, ls-remote...) taking longer than SECONDS. Operations"
+            " limited this way (or by --deadline) cannot ask for credentials."
+        )
+        print(
+            "OPTION --retries N retries network operations that timed out or"
+            " failed for a possibly temporary reason (e.g. connection reset)"
+            " up to N times, waiting about 1, 2, 4... seconds (up to 30) in"
+            " between."
+        )
+        print(
+            "OPTION --deadline SECONDS does not start (or retry) any network"
+            " operation once SECONDS have passed since the start, and stops"
+            " those still running. Operations given up on because of a timeout"
+            " or of the deadline are listed at the end."
+        )
         print("EXAMPLE status /my/src/local_clone")
+        print("EXAMPLE status --jobs 8")
+        print("EXAMPLE status --locked")
         print("ALIASES " + ', '.join(aliases['status']) + ".")
 
         return
@@ -1743,7 +5883,91 @@ def handle_help_command (invocation, parameters):
 
     if (command in aliases['up-dir']):
         # TODO
+        print(
+            "OPTION --cache-dir DIR keeps a bare mirror of each remote source"
+            " in DIR, updated once per run, and clones with it as a reference"
+            " so that only the objects it lacks are downloaded. Clones keep"
+            " relying on the mirror's objects, so DIR must not be removed."
+            " Defaults to the SNSM_CACHE_DIR environment variable, if set."
+        )
+        print(
+            "OPTION --declared-order tries the sources of each submodule in the"
+            " order of the description file. Otherwise, the sources that"
+            " failed the least, then the quickest, in previous runs (as"
+            " recorded in the root repository's Git directory) are tried"
+            " first."
+        )
+        print(
+            "OPTION --from-bundles DIR populates or updates the submodules from"
+            " the bundles written in DIR by 'export-bundles', checking out"
+            " the commits they were exported at, then points their remotes to"
+            " the sources of the description. Nothing is fetched from the"
+            " sources. Submodules without a bundle cannot be updated. Official"
+            " Git submodules of the submodules are not bundled, and are thus"
+            " left uninitialized."
+        )
+        print(
+            "OPTION --incremental leaves alone the submodules whose local copy"
+            " is already on the commit (or tag) to check out and has all of"
+            " the named sources as remotes. Their own submodules are still"
+            " handled. Submodules following a branch are always updated."
+        )
+        print(
+            "OPTION --jobs N clones up to N submodules in parallel. The output"
+            " of each submodule is printed as a single block once it is done,"
+            " and a submodule failing does not stop the others."
+        )
+        print(
+            "OPTION --locked checks out, for submodules whose target overrides"
+            " their commit, the commit this target is locked on in the"
+            " .gitsubmodules.lock file (see 'lock') instead of asking their"
+            " sources what it currently is. Targets missing from the lock file"
+            " are reported, then resolved as usual."
+        )
+        print(
+            "OPTION --race-sources asks all of a submodule's sources for their"
+            " references at the same time before cloning or fetching, then"
+            " tries first those that have what is to be checked out, quickest"
+            " first, the declared order only breaking ties."
+        )
+        print(
+            "OPTION --share-fetches fetches each remote source only once, into"
+            " a mirror in the root repository's Git directory (or in the"
+            " --cache-dir directory), then clones every submodule using that"
+            " source from the mirror, before pointing its 'origin' remote back"
+            " to the source. Mirrors in the root repository's Git directory"
+            " are removed once the command is done."
+        )
+        print(
+            "OPTION --timeout SECONDS stops any network operation (clone,"
+            " fetch, ls-remote...) taking longer than SECONDS. Operations"
+            " limited this way (or by --deadline) cannot ask for credentials."
+        )
+        print(
+            "OPTION --retries N retries network operations that timed out or"
+            " failed for a possibly temporary reason (e.g. connection reset)"
+            " up to N times, waiting about 1, 2, 4... seconds (up to 30) in"
+            " between."
+        )
+        print(
+            "OPTION --deadline SECONDS does not start (or retry) any network"
+            " operation once SECONDS have passed since the start, and stops"
+            " those still running. Operations given up on because of a timeout"
+            " or of the deadline are listed at the end."
+        )
+        print(
+            "OPTION --use-worktrees clones only once the submodules using the"
+            " same sources (and source names), even in different description"
+            " files, and adds the others as worktrees of that clone, on a"
+            " detached HEAD. Shallow and partial clones are not shared. The"
+            " clone must be kept, as the worktrees depend on it."
+        )
         print("EXAMPLE update-directory /my/src/local_clone")
+        print("EXAMPLE update-directory --jobs 8")
+        print("EXAMPLE update-directory --cache-dir ~/.cache/git-submodules")
+        print("EXAMPLE update-directory --locked --incremental")
+        print("EXAMPLE update-directory --from-bundles /media/usb/bundles")
+        print("EXAMPLE update-directory --jobs 8 --use-worktrees")
         print("ALIASES " + ', '.join(aliases['up-dir']) + ".")
 
         return
@@ -1788,10 +6012,123 @@ def handle_add_command (paths):
         root_directory
     )
 
+################################################################################
+##### EXPORT ###################################################################
+################################################################################
+def handle_export_command (parameters):
+    (options, paths) = extract_options(
+        parameters,
+        ['--cache-dir', '--jobs'],
+        ['--tar']
+    )
+    jobs = get_positive_integer_option(options, '--jobs', 1)
+
+    if (len(paths) != 1):
+        print(
+            "[F] This command requires a single parameter.",
+            file = sys.stderr
+        )
+        sys.exit(-1)
+
+    root_directory = git_find_root_path()
+    cache_directory = (
+        get_clone_options(options, root_directory).get_cache_directory()
+    )
+
+    (submodule_list, submodule_dictionary) = get_submodules_of(root_directory)
+
+    if ('--tar' not in options):
+        directory = os.path.abspath(paths[0])
+
+        ensure_directory_exists(directory)
+
+        failed_paths = apply_export_to(
+            submodule_dictionary,
+            root_directory,
+            TreeExport(directory, None, cache_directory),
+            jobs
+        )
+    else:
+        real_stdout = sys.stdout
+
+        if (paths[0] == "-"):
+            output_stream = sys.stdout.buffer
+            # Messages would otherwise end up in the archive.
+            sys.stdout = sys.stderr
+        else:
+            output_stream = open(paths[0], 'wb')
+
+        try:
+            with tarfile.open(
+                fileobj = output_stream,
+                mode = 'w|',
+                format = tarfile.PAX_FORMAT
+            ) as tar_stream:
+                failed_paths = apply_export_to(
+                    submodule_dictionary,
+                    root_directory,
+                    TreeExport(None, tar_stream, cache_directory),
+                    jobs
+                )
+        finally:
+            sys.stdout = real_stdout
+
+            if (output_stream is sys.stdout.buffer):
+                output_stream.flush()
+            else:
+                output_stream.close()
+
+    if (len(failed_paths) > 0):
+        report_failed_tasks(failed_paths)
+        sys.exit(-1)
+
+################################################################################
+##### EXPORT BUNDLES ###########################################################
+################################################################################
+def handle_export_bundles_command (parameters):
+    (options, paths) = extract_options(parameters, ['--jobs'], [])
+    jobs = get_positive_integer_option(options, '--jobs', 1)
+
+    if (len(paths) != 1):
+        print(
+            "[F] This command requires a single parameter.",
+            file = sys.stderr
+        )
+        sys.exit(-1)
+
+    directory = os.path.abspath(paths[0])
+    root_directory = git_find_root_path()
+
+    (submodule_list, submodule_dictionary) = get_submodules_of(root_directory)
+
+    failed_paths = apply_export_bundles_to(
+        submodule_dictionary,
+        root_directory,
+        directory,
+        jobs
+    )
+
+    print(
+        "Bundles index written to \""
+        + get_bundle_index_file(directory)
+        + "\"."
+    )
+
+    if (len(failed_paths) > 0):
+        report_failed_tasks(failed_paths)
+        sys.exit(-1)
+
 ################################################################################
 ##### FOREACH ##################################################################
 ################################################################################
 def handle_foreach_command (parameters, is_recursive, is_enabled_only):
+    (options, parameters) = extract_options(
+        parameters,
+        ['--jobs'],
+        ['--persistent-shells', '--unordered']
+    )
+    jobs = get_positive_integer_option(options, '--jobs', 1)
+
     if (len(parameters) == 0):
         print(
             "[F] This command requires at least one parameter.",
@@ -1818,15 +6155,33 @@ def handle_foreach_command (parameters, is_recursive, is_enabled_only):
 
     submodule_dictionary = restrict_dictionary_to(submodule_dictionary, paths)
 
-    apply_foreach_to(
+    failed_commands = apply_foreach_to(
         submodule_dictionary,
         is_recursive,
         is_enabled_only,
-        [root_directory], # = traversed_submodules
         foreach_command,
-        root_directory
+        ('--persistent-shells' in options), # = use_persistent_shells
+        root_directory,
+        jobs,
+        ('--unordered' not in options) # = is_ordered
     )
 
+    for (path, exit_code) in failed_commands:
+        if (exit_code is None):
+            report_failed_tasks([path])
+        else:
+            print(
+                "[E] Command exited with code "
+                + str(exit_code)
+                + " for \""
+                + path
+                + "\".",
+                file = sys.stderr
+            )
+
+    if (len(failed_commands) > 0):
+        sys.exit(-1)
+
 ################################################################################
 ##### FROM OFFICIAL ############################################################
 ################################################################################
@@ -1963,7 +6318,15 @@ def handle_remove_directory_command (paths):
 ################################################################################
 ##### SEEK #####################################################################
 ################################################################################
-def handle_seek_command (paths):
+def handle_seek_command (parameters):
+    (options, paths) = extract_options(
+        parameters,
+        ['--jobs', '--max-depth'],
+        []
+    )
+    jobs = get_positive_integer_option(options, '--jobs', None)
+    max_depth = get_positive_integer_option(options, '--max-depth', None)
+
     current_directory = os.getcwd()
     root_directory = git_find_root_path()
 
@@ -1981,21 +6344,45 @@ def handle_seek_command (paths):
     ]
 
     if (len(paths) == 0):
-        paths = get_path_of_direct_subdirectories(root_directory, [".git"])
+        search_paths = [
+            (path, 1) for path in scan_directory(root_directory)[1]
+        ]
+    else:
+        search_paths = [(path, 0) for path in paths]
 
     list_all_non_submodule_subrepositories(
         submodule_dictionary,
-        paths,
-        root_directory
+        search_paths,
+        root_directory,
+        max_depth,
+        jobs
     )
 
 ################################################################################
 ##### STATUS ###################################################################
 ################################################################################
-def handle_status_command (paths):
+def handle_status_command (parameters):
+    (options, paths) = extract_options(
+        parameters,
+        ['--deadline', '--jobs', '--ref-cache-ttl', '--retries', '--timeout'],
+        ['--locked']
+    )
+    jobs = get_positive_integer_option(options, '--jobs', 1)
+
+    set_network_limits(options)
+
     current_directory = os.getcwd()
     root_directory = git_find_root_path()
 
+    if ('--ref-cache-ttl' in options):
+        load_remote_references_cache(
+            root_directory,
+            get_positive_integer_option(options, '--ref-cache-ttl', 0)
+        )
+
+    if ('--locked' in options):
+        load_lock_file(root_directory)
+
     (submodule_list, submodule_dictionary) = get_submodules_of(root_directory)
 
     paths = [
@@ -2008,7 +6395,16 @@ def handle_status_command (paths):
 
     submodule_dictionary = restrict_dictionary_to(submodule_dictionary, paths)
 
-    apply_check_to(submodule_dictionary, root_directory)
+    failed_paths = apply_check_to(submodule_dictionary, root_directory, jobs)
+
+    if ('--ref-cache-ttl' in options):
+        save_remote_references_cache(root_directory)
+
+    has_abandoned_operations = report_abandoned_operations()
+
+    if ((len(failed_paths) > 0) or has_abandoned_operations):
+        report_failed_tasks(failed_paths)
+        sys.exit(-1)
 
 ################################################################################
 ##### LIST #####################################################################
@@ -2035,10 +6431,66 @@ def handle_list_command (paths):
             if (submodule_path.startswith(path)):
                 print(submodule_path)
 
+################################################################################
+##### LOCK #####################################################################
+################################################################################
+def handle_lock_command (parameters):
+    (options, paths) = extract_options(
+        parameters,
+        ['--deadline', '--jobs', '--retries', '--timeout'],
+        []
+    )
+    # Only sources are queried, each of them once, so lookups are always run in
+    # parallel.
+    jobs = get_positive_integer_option(options, '--jobs', 8)
+
+    if (len(paths) > 0):
+        print(
+            "[F] This command locks the whole tree of submodules, and takes no"
+            + " path.",
+            file = sys.stderr
+        )
+        sys.exit(-1)
+
+    set_network_limits(options)
+
+    root_directory = git_find_root_path()
+
+    (submodule_list, submodule_dictionary) = get_submodules_of(root_directory)
+
+    failed_paths = apply_lock_to(submodule_dictionary, root_directory, jobs)
+
+    has_abandoned_operations = report_abandoned_operations()
+
+    if (len(failed_paths) > 0):
+        report_failed_tasks(failed_paths)
+        print("[E] The lock file was left as it was.", file = sys.stderr)
+        sys.exit(-1)
+
+    print("Lock file written.")
+
+    if (has_abandoned_operations):
+        sys.exit(-1)
+
 ################################################################################
 ##### MATCH TARGET #############################################################
 ################################################################################
-def handle_match_target_command (paths):
+def handle_match_target_command (parameters):
+    (options, paths) = extract_options(
+        parameters,
+        ['--cache-dir', '--deadline', '--jobs', '--retries', '--timeout'],
+        [
+            '--declared-order',
+            '--incremental',
+            '--race-sources',
+            '--share-fetches',
+            '--use-worktrees'
+        ]
+    )
+    jobs = get_positive_integer_option(options, '--jobs', 1)
+
+    set_network_limits(options)
+
     current_directory = os.getcwd()
     root_directory = git_find_root_path()
 
@@ -2054,11 +6506,27 @@ def handle_match_target_command (paths):
 
     submodule_dictionary = restrict_dictionary_to(submodule_dictionary, paths)
 
-    apply_clone_to(
-        submodule_dictionary,
-        True, # = force_target
-        root_directory
-    )
+    load_source_statistics(root_directory)
+
+    clone_options = get_clone_options(options, root_directory)
+
+    # Failing to clone is fatal with a single job.
+    try:
+        failed_paths = apply_clone_to(
+            submodule_dictionary,
+            True, # = force_target
+            root_directory,
+            jobs,
+            clone_options
+        )
+    finally:
+        remove_staging_mirrors(clone_options)
+        save_source_statistics(root_directory)
+        has_abandoned_operations = report_abandoned_operations()
+
+    for path in failed_paths:
+        if (path in submodule_dictionary):
+            del submodule_dictionary[path]
 
     apply_update_desc_to(submodule_dictionary, root_directory)
     update_submodules_desc_file(root_directory, submodule_dictionary, [])
@@ -2068,6 +6536,10 @@ def handle_match_target_command (paths):
         root_directory
     )
 
+    if ((len(failed_paths) > 0) or has_abandoned_operations):
+        report_failed_tasks(failed_paths)
+        sys.exit(-1)
+
 ################################################################################
 ##### TO OFFICIAL ##############################################################
 ################################################################################
@@ -2108,10 +6580,36 @@ def handle_update_description_command (paths):
 ################################################################################
 ##### UPDATE DIRECTORY #########################################################
 ################################################################################
-def handle_update_directory_command (paths):
+def handle_update_directory_command (parameters):
+    (options, paths) = extract_options(
+        parameters,
+        [
+            '--cache-dir',
+            '--deadline',
+            '--from-bundles',
+            '--jobs',
+            '--retries',
+            '--timeout'
+        ],
+        [
+            '--declared-order',
+            '--incremental',
+            '--locked',
+            '--race-sources',
+            '--share-fetches',
+            '--use-worktrees'
+        ]
+    )
+    jobs = get_positive_integer_option(options, '--jobs', 1)
+
+    set_network_limits(options)
+
     current_directory = os.getcwd()
     root_directory = git_find_root_path()
 
+    if ('--locked' in options):
+        load_lock_file(root_directory)
+
     (submodule_list, submodule_dictionary) = get_submodules_of(root_directory)
 
     paths = [
@@ -2124,94 +6622,123 @@ def handle_update_directory_command (paths):
 
     submodule_dictionary = restrict_dictionary_to(submodule_dictionary, paths)
 
-    apply_clone_to(
-        submodule_dictionary,
-        False, # = force_target,
-        root_directory
-    )
+    load_source_statistics(root_directory)
+
+    clone_options = get_clone_options(options, root_directory)
+
+    # Failing to clone is fatal with a single job.
+    try:
+        failed_paths = apply_clone_to(
+            submodule_dictionary,
+            False, # = force_target,
+            root_directory,
+            jobs,
+            clone_options
+        )
+    finally:
+        remove_staging_mirrors(clone_options)
+        save_source_statistics(root_directory)
+        has_abandoned_operations = report_abandoned_operations()
 
     git_add_to_gitignore(
         set([path for path in submodule_dictionary]),
         root_directory
     )
 
+    if ((len(failed_paths) > 0) or has_abandoned_operations):
+        report_failed_tasks(failed_paths)
+        sys.exit(-1)
+
 ################################################################################
 ##### MAIN #####################################################################
 ################################################################################
-if (len(sys.argv) < 2):
-    handle_generic_help(sys.argv[0])
-    sys.exit(-1)
+if (__name__ == "__main__"):
+    if (len(sys.argv) < 2):
+        handle_generic_help(sys.argv[0])
+        sys.exit(-1)
+
+    command = sys.argv[1]
+
+    if (command in aliases['help']):
+        handle_help_command(sys.argv[0], sys.argv[2:])
+        sys.exit(0)
 
-command = sys.argv[1]
+    if (command in aliases['add']):
+        handle_add_command(sys.argv[2:])
+        sys.exit(0)
+
+    if (command in aliases['export']):
+        handle_export_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['help']):
-    handle_help_command(sys.argv[0], sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['export-bundles']):
+        handle_export_bundles_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['add']):
-    handle_add_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['foreach']):
+        handle_foreach_command(sys.argv[2:], False, False)
+        sys.exit(0)
 
-if (command in aliases['foreach']):
-    handle_foreach_command(sys.argv[2:], False, False)
-    sys.exit(0)
+    if (command in aliases['foreach-enabled']):
+        handle_foreach_command(sys.argv[2:], False, True)
+        sys.exit(0)
 
-if (command in aliases['foreach-enabled']):
-    handle_foreach_command(sys.argv[2:], True, False)
-    sys.exit(0)
+    if (command in aliases['foreach-enabled-recursive']):
+        handle_foreach_command(sys.argv[2:], True, True)
+        sys.exit(0)
 
-if (command in aliases['foreach-enabled-recursive']):
-    handle_foreach_command(sys.argv[2:], True, True)
-    sys.exit(0)
+    if (command in aliases['foreach-recursive']):
+        handle_foreach_command(sys.argv[2:], True, False)
+        sys.exit(0)
 
-if (command in aliases['foreach-recursive']):
-    handle_foreach_command(sys.argv[2:], False, True)
-    sys.exit(0)
+    if (command in aliases['from-official']):
+        handle_from_official_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['from-official']):
-    handle_from_official_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['list']):
+        handle_list_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['list']):
-    handle_list_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['lock']):
+        handle_lock_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['match-target']):
-    handle_match_target_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['match-target']):
+        handle_match_target_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['rm']):
-    handle_remove_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['rm']):
+        handle_remove_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['rm-desc']):
-    handle_remove_description_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['rm-desc']):
+        handle_remove_description_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['rm-dir']):
-    handle_remove_directory_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['rm-dir']):
+        handle_remove_directory_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['seek']):
-    handle_seek_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['seek']):
+        handle_seek_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['status']):
-    handle_status_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['status']):
+        handle_status_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['to-official']):
-    handle_to_official_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['to-official']):
+        handle_to_official_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['up-desc']):
-    handle_update_description_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['up-desc']):
+        handle_update_description_command(sys.argv[2:])
+        sys.exit(0)
 
-if (command in aliases['up-dir']):
-    handle_update_directory_command(sys.argv[2:])
-    sys.exit(0)
+    if (command in aliases['up-dir']):
+        handle_update_directory_command(sys.argv[2:])
+        sys.exit(0)
 
-print("[F] Unknown command \"" + command + "\".", file = sys.stderr)
-handle_generic_help(sys.argv[0])
-sys.exit(-1)
+    print("[F] Unknown command \"" + command + "\".", file = sys.stderr)
+    handle_generic_help(sys.argv[0])
+    sys.exit(-1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Checks that network operations given a timeout are stopped in time, along
+# with the processes Git starts for them, when a remote never answers.
+# Usage: test_network_timeout.py (or through pytest)
+
+import importlib.util
+import os
+import socket
+import tempfile
+import time
+import unittest
+
+script_path = (
+    os.path.dirname(os.path.abspath(__file__))
+    + os.sep
+    + ".."
+    + os.sep
+    + "git-submodules.py"
+)
+
+spec = importlib.util.spec_from_file_location("git_submodules", script_path)
+git_submodules = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(git_submodules)
+
+timeout = 2
+# Time given to the processes to stop, on top of the timeout.
+margin = 8
+
+class UnresponsiveRemoteTest (unittest.TestCase):
+    # Connections are accepted (by the system) but never answered.
+    def setUp (self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(8)
+        self.url = (
+            "http://127.0.0.1:"
+            + str(self.server.getsockname()[1])
+            + "/repository.git"
+        )
+        self.directory = tempfile.TemporaryDirectory()
+
+        git_submodules.network_limits = git_submodules.NetworkLimits()
+        git_submodules.network_limits.set_timeout(timeout)
+
+    def tearDown (self):
+        self.server.close()
+        self.directory.cleanup()
+
+    def test_run_network_command (self):
+        start_time = time.monotonic()
+        result = git_submodules.run_network_command(
+            ['git', 'ls-remote', self.url],
+            self.directory.name
+        )
+
+        self.assertEqual(result, git_submodules.command_timeout_exit_code)
+        self.assertLess(time.monotonic() - start_time, timeout + margin)
+
+    def test_run_network_command_with_buffered_output (self):
+        start_time = time.monotonic()
+        result = git_submodules.run_with_output_block(
+            lambda: git_submodules.run_network_command(
+                ['git', 'ls-remote', self.url],
+                self.directory.name
+            ),
+            []
+        )
+
+        self.assertEqual(result, git_submodules.command_timeout_exit_code)
+        self.assertLess(time.monotonic() - start_time, timeout + margin)
+
+    def test_git_list_remote_references (self):
+        start_time = time.monotonic()
+        result = git_submodules.git_list_remote_references(
+            self.directory.name,
+            self.url,
+            timeout,
+            []
+        )
+
+        self.assertIs(result, False)
+        self.assertLess(time.monotonic() - start_time, timeout + margin)
+
+if (__name__ == "__main__"):
+    unittest.main()